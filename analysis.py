@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+"""
+Summarize the localization error in one or more tlogs.
+
+Each tlog is converted once into NumPy arrays per message type (see tlog_columns.py). The EKF output
+(GLOBAL_POSITION_INT) is compared to the most recent reference position to get the horizontal error. The reference is
+the ground truth that sim_sensors.py logs as HIL_STATE_QUATERNION, which ArduSub never sends. Tlogs without it, e.g.,
+from real dives, fall back to the UGPS fixes (GPS_INPUT), which are noisy, and missing in DVL-only runs.
+Convergence time is the time from the first EKF output until the error stays below --threshold for the rest of the run.
+
+Example:
+    python analysis.py /tmp/mode_*.tlog
+"""
+
+import argparse
+import math
+from typing import NamedTuple
+
+import numpy as np
+
+import tlog_columns
+
+EARTH_RADIUS = 6371000.0  # m
+
+EKF_MSG = 'GLOBAL_POSITION_INT'
+REFERENCE_MSG = 'GPS_INPUT'
+
+# Ground truth, logged but never sent to ArduSub, see SimRunner.log_msg()
+TRUTH_MSG = 'HIL_STATE_QUATERNION'
+
+
+class Metrics(NamedTuple):
+    name: str
+    samples: int
+    duration: float  # s
+    rms: float  # m
+    mean: float  # m
+    max: float  # m
+    convergence: float | None  # s, None if the error never settles
+
+
+def load_columns(path: str, types: list[str]) -> dict[str, dict[str, np.ndarray]]:
+    """
+    Load several message types from a tlog as columns, see tlog_columns.py.
+    """
+    columns = tlog_columns.TlogColumns(path)
+    try:
+        return {msg_type: columns.columns(msg_type) for msg_type in types}
+    finally:
+        columns.close()
+
+
+def horizontal_error(lat: np.ndarray, lon: np.ndarray, ref_lat: np.ndarray, ref_lon: np.ndarray) -> np.ndarray:
+    """
+    Distance in meters between positions in degE7, using an equirectangular approximation.
+    """
+    scale = math.radians(1e-7) * EARTH_RADIUS
+    dn = (lat.astype(np.float64) - ref_lat) * scale
+    de = (lon.astype(np.float64) - ref_lon) * scale * np.cos(np.radians(ref_lat * 1e-7))
+    return np.hypot(dn, de)
+
+
+def error_vs_reference(ekf: dict[str, np.ndarray], ref: dict[str, np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Return (t, error) for each EKF sample that has a reference sample at or before it.
+    """
+    i = np.searchsorted(ref['timestamp'], ekf['timestamp'], side='right') - 1
+    valid = i >= 0
+    i = i[valid]
+    t = ekf['timestamp'][valid]
+    error = horizontal_error(ekf['lat'][valid], ekf['lon'][valid], ref['lat'][i], ref['lon'][i])
+    return t, error
+
+
+def convergence_time(t: np.ndarray, error: np.ndarray, threshold: float) -> float | None:
+    """
+    Seconds from t[0] until the error stays below threshold, or None if the last sample is above threshold.
+    """
+    above = np.flatnonzero(error >= threshold)
+    if len(above) == 0:
+        return 0.0
+    if above[-1] == len(error) - 1:
+        return None
+    return float(t[above[-1] + 1] - t[0])
+
+
+def reference(columns: dict[str, dict[str, np.ndarray]]) -> dict[str, np.ndarray]:
+    """
+    The ground truth if there is any, otherwise GPS_INPUT.
+    """
+    truth = columns.get(TRUTH_MSG)
+    return truth if truth is not None and len(truth['timestamp']) else columns[REFERENCE_MSG]
+
+
+def compute_metrics(name: str, columns: dict[str, dict[str, np.ndarray]], threshold: float) -> Metrics:
+    t, error = error_vs_reference(columns[EKF_MSG], reference(columns))
+    if len(error) == 0:
+        return Metrics(name, 0, 0.0, math.nan, math.nan, math.nan, None)
+    return Metrics(name, len(error), float(t[-1] - t[0]), float(np.sqrt(np.mean(error ** 2))), float(error.mean()),
+                   float(error.max()), convergence_time(t, error, threshold))
+
+
+def analyze(path: str, threshold: float = 2.0) -> Metrics:
+    return compute_metrics(path, load_columns(path, [EKF_MSG, TRUTH_MSG, REFERENCE_MSG]), threshold)
+
+
+def format_table(results: list[Metrics]) -> list[str]:
+    width = max([len(m.name) for m in results] + [4])
+    lines = [f'{"name" :<{width}} {"samples" :>8} {"time s" :>8} {"rms m" :>7} {"mean m" :>7} {"max m" :>7} '
+             f'{"conv s" :>7}']
+    for m in results:
+        convergence = f'{m.convergence :7.1f}' if m.convergence is not None else f'{"never" :>7}'
+        lines.append(f'{m.name :<{width}} {m.samples :8d} {m.duration :8.1f} {m.rms :7.2f} {m.mean :7.2f} '
+                     f'{m.max :7.2f} {convergence}')
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--threshold', type=float, default=2.0, help='convergence threshold in meters')
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+
+    results = [analyze(path, args.threshold) for path in args.paths]
+    for line in format_table(results):
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
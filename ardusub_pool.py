@@ -0,0 +1,95 @@
+"""
+Keep ArduSub SITL instances booted and hand them out to runs.
+
+Starting SITL, waiting for a HEARTBEAT and fetching the params takes a while, and for short runs this dominates. A
+pool boots its instances once. A run borrows an instance with acquire(), passes it to SimRunner (ardusub=...) and gives
+it back with release(). When SimRunner gets an instance that has been used before, it restores any params the previous
+runs changed and reboots ArduSub to reset the EKF, see SimRunner.__init__(). An instance is replaced by a freshly
+booted one after max_uses runs, or if it died.
+
+Example:
+    pool = WarmPool(20.0, [0, 1], '/tmp/pool', max_uses=10)
+    ardusub = pool.acquire()
+    runner = SimSensors(..., ardusub=ardusub)
+    try:
+        runner.run()
+    finally:
+        runner.close()
+        pool.release(ardusub)
+    pool.close()
+"""
+
+import os
+
+import sim_runner
+
+
+class WarmPool:
+    def __init__(self, speedup: float, instances: list[int], out_dir: str | None = None, max_uses: int = 10,
+                 connect_only: bool = False):
+        self.speedup = speedup
+        self.instances = instances
+        self.out_dir = out_dir
+        self.max_uses = max_uses
+
+        # Connect to something that is already listening, e.g., FakeArduSub, see ArduSubInstance
+        self.connect_only = connect_only
+
+        # Booted and not in use, keyed by instance number
+        self.idle: dict[int, sim_runner.ArduSubInstance] = {}
+
+        # Lent out by acquire()
+        self.busy: dict[int, sim_runner.ArduSubInstance] = {}
+
+    def cwd(self, instance: int) -> str | None:
+        return os.path.join(self.out_dir, f'instance_{instance}') if self.out_dir else None
+
+    def start(self, instance: int):
+        self.idle[instance] = sim_runner.ArduSubInstance(self.speedup, instance, self.cwd(instance), self.connect_only)
+
+    def boot(self):
+        """
+        Boot every instance that isn't running yet.
+        """
+        for instance in self.instances:
+            if instance not in self.idle and instance not in self.busy:
+                self.start(instance)
+
+    def acquire(self) -> sim_runner.ArduSubInstance:
+        """
+        Lend out an idle instance, booting one if none are idle.
+        """
+        if not self.idle:
+            for instance in self.instances:
+                if instance not in self.busy:
+                    self.start(instance)
+                    break
+        if not self.idle:
+            raise RuntimeError(f'all {len(self.instances)} ArduSub instances are in use')
+
+        instance, ardusub = self.idle.popitem()
+        self.busy[instance] = ardusub
+        return ardusub
+
+    def release(self, ardusub: sim_runner.ArduSubInstance, discard: bool = False):
+        """
+        Take back an instance. It is replaced by a fresh one if it has been used max_uses times, if it died, or if
+        discard is set (e.g., the run failed and the instance might be in a bad state).
+        """
+        del self.busy[ardusub.instance]
+        ardusub.uses += 1
+        if discard or not ardusub.alive() or ardusub.uses >= self.max_uses:
+            print(f'SIM RUNNER: recycling ArduSub instance {ardusub.instance} after {ardusub.uses} runs')
+            ardusub.close()
+            self.start(ardusub.instance)
+        else:
+            self.idle[ardusub.instance] = ardusub
+
+    def close(self):
+        """
+        Stop every instance, including any that are still lent out.
+        """
+        for ardusub in list(self.idle.values()) + list(self.busy.values()):
+            ardusub.close()
+        self.idle = {}
+        self.busy = {}
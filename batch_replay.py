@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+
+"""
+Replay a set of dives with one or more param files on a pool of processes, and compare the results.
+
+The dives are tlogs, given as paths, directories (every *.tlog in the directory) or glob patterns. Every dive is
+replayed with every param file, each replay on one of the workers' ArduSub SITL instances, see matrix.py. The tlog and
+console output for each replay are written to --out as <dive>_<params>.tlog and .txt.
+
+Replays are cached (see cache.py), by default in ~/.cache/ardusub_localization. A dive whose result is current, i.e.,
+the dive, the parsed params, the options and the ArduSub binary haven't changed, is not replayed again; its tlog is
+copied from the cache. Use --no-cache to replay everything.
+
+At the end a table compares the horizontal error (see analysis.py) of each dive across the param files. Use --csv to
+also write every result to a CSV file.
+
+Example, replay a season of dives with two param files on 8 workers:
+    python batch_replay.py --params params/lutris.params params/fusion.params --speedup 10.0 --out /tmp/batch \
+        --csv /tmp/batch/results.csv ~/dives/2024
+"""
+
+import argparse
+import contextlib
+import csv
+import glob
+import math
+import os
+import time
+from typing import NamedTuple
+
+import analysis
+import cache
+import matrix
+import sim_replay
+import stop_conditions
+import tlog_columns
+
+
+class ReplayJob(NamedTuple):
+    name: str
+    dive: str
+    replay_path: str
+    params_name: str
+    params_path: str
+
+
+class Options(NamedTuple):
+    """
+    Settings shared by every replay.
+    """
+    speedup: float = 1.0
+    start: float | None = None
+    end: float | None = None
+    cache_dir: str | None = cache.DEFAULT_DIR
+    max_uses: int = 0  # Reuse each worker's ArduSub instance this many times, 0 to start a new one for every replay
+    dataflash: bool = False  # Copy ArduSub's DataFlash log next to each tlog
+    lockstep: bool = False  # Pace each replay by ArduSub's clock
+    sim_timestamps: bool = False  # Stamp the tlogs with sim time rather than wall time
+    stop: tuple[str, ...] = ()  # End each replay early when one of these holds, see stop_conditions.py
+
+
+def find_tlogs(sources: list[str]) -> list[str]:
+    """
+    Expand directories and glob patterns to a sorted list of tlogs, without duplicates.
+    """
+    paths = set()
+    for source in sources:
+        source = os.path.expanduser(source)
+        if os.path.isdir(source):
+            paths.update(glob.glob(os.path.join(source, '*.tlog')))
+        else:
+            paths.update(p for p in glob.glob(source) if os.path.isfile(p))
+    return sorted(paths)
+
+
+def stem(path: str) -> str:
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def build_jobs(replay_paths: list[str], params_paths: list[str]) -> list[ReplayJob]:
+    """
+    Build the list of replays, one per dive per param file. Names are <dive>_<params>, e.g., dive7_fusion.
+    """
+    dives = [stem(path) for path in replay_paths]
+    duplicates = {dive for dive in dives if dives.count(dive) > 1}
+    if duplicates:
+        raise ValueError(f'dives with the same name: {", ".join(sorted(duplicates))}')
+
+    return [ReplayJob(f'{dive}_{stem(params_path)}', dive, replay_path, stem(params_path), params_path)
+            for dive, replay_path in zip(dives, replay_paths)
+            for params_path in params_paths]
+
+
+def job_key(job: ReplayJob, options: Options) -> str:
+    # Same key as sim_replay.py --cache, so the two share entries
+    return cache.replay_key(job.params_path, job.replay_path, speedup=options.speedup, start=options.start,
+                            end=options.end, lockstep=options.lockstep, sim_timestamps=options.sim_timestamps,
+                            stop=list(options.stop))
+
+
+def log_path(job: ReplayJob, out_dir: str) -> str:
+    return os.path.join(out_dir, f'{job.name}.tlog')
+
+
+def run_replay(job: ReplayJob, options: Options, out_dir: str) -> matrix.Result:
+    """
+    Run a single replay in this worker's ArduSub instance, or copy the results from the cache.
+    """
+    path = log_path(job, out_dir)
+    cwd = os.path.join(out_dir, f'instance_{matrix._instance}')
+    start = time.time()
+
+    def run():
+        with open(os.path.join(out_dir, f'{job.name}.txt'), 'w') as out, contextlib.redirect_stdout(out):
+            ardusub = matrix._pool.acquire() if matrix._pool else None
+            failed = True
+            try:
+                runner = sim_replay.SimReplay(job.replay_path, job.params_path, path, options.speedup,
+                                              matrix._instance, cwd, options.start, options.end, ardusub,
+                                              options.dataflash, options.lockstep, options.sim_timestamps)
+                if options.stop:
+                    runner.add_listener(stop_conditions.StopMonitor(
+                        runner, stop_conditions.parse_conditions(options.stop)))
+                try:
+                    runner.run()
+                    failed = False
+                finally:
+                    runner.close()
+            finally:
+                if ardusub is not None:
+                    matrix._pool.release(ardusub, discard=failed)
+
+    result_cache = cache.ResultCache(options.cache_dir) if options.cache_dir else None
+    metrics = cache.run_cached(result_cache, job_key(job, options), path, run,
+                               lambda p: analysis.analyze(p)._asdict(), options.dataflash)
+
+    return matrix.Result(job.name, matrix._instance, path, time.time() - start, metrics)
+
+
+def current_results(jobs: list[ReplayJob], options: Options, out_dir: str) -> dict[str, matrix.Result]:
+    """
+    Look up every job in the cache, without starting any workers. Returns {name: result} for the hits.
+    """
+    if not options.cache_dir:
+        return {}
+    os.makedirs(out_dir, exist_ok=True)
+    result_cache = cache.ResultCache(options.cache_dir)
+    results = {}
+    for job in jobs:
+        path = log_path(job, out_dir)
+        metrics = result_cache.get(job_key(job, options), path, options.dataflash)
+        if metrics is not None:
+            results[job.name] = matrix.Result(job.name, -1, path, 0.0, metrics)
+    return results
+
+
+def prepare_dives(jobs: list[ReplayJob]):
+    """
+    Index each dive and convert the types that are replayed (see tlog_columns.py) once, before the workers start.
+    Jobs are ordered by dive, so otherwise the first workers would all convert the same dive at the same time.
+    """
+    for replay_path in dict.fromkeys(job.replay_path for job in jobs):
+        try:
+            columns = tlog_columns.TlogColumns(replay_path)
+            try:
+                for msg_type in sim_replay.SimReplay.REPLAY_MSGS:
+                    columns.arrays(msg_type)
+            finally:
+                columns.close()
+        except (OSError, ValueError) as e:
+            # The replays of this dive will fail and say why
+            print(f'BATCH: could not convert {replay_path}: {e}')
+
+
+def run_batch(jobs: list[ReplayJob], options: Options, out_dir: str, workers: int,
+              first_instance: int = 0) -> list[matrix.Result]:
+    """
+    Run every job that isn't current, at most `workers` at a time. Results are in the same order as jobs, failed
+    replays are left out.
+    """
+    results = current_results(jobs, options, out_dir)
+    stale = [job for job in jobs if job.name not in results]
+    print(f'BATCH: {len(results)} of {len(jobs)} replays are current, running {len(stale)}')
+    if stale:
+        prepare_dives(stale)
+        for result in matrix.run_pool(run_replay, stale, options, out_dir, workers, first_instance, label='BATCH'):
+            results[result.name] = result
+    return [results[job.name] for job in jobs if job.name in results]
+
+
+def format_comparison(jobs: list[ReplayJob], results: list[matrix.Result], metric: str = 'rms') -> list[str]:
+    """
+    One row per dive, one column per param file, with the mean across dives at the bottom.
+    """
+    by_name = {result.name: result.metrics for result in results}
+    dives = list(dict.fromkeys(job.dive for job in jobs))
+    params_names = list(dict.fromkeys(job.params_name for job in jobs))
+    cells = {(job.dive, job.params_name): by_name.get(job.name, {}).get(metric) for job in jobs}
+
+    def cell(value: float | None, width: int) -> str:
+        return f'{value :{width}.2f}' if value is not None and not math.isnan(value) else f'{"-" :>{width}}'
+
+    dive_width = max([len(dive) for dive in dives] + [len(metric) + 2, len('mean')])
+    widths = [max(len(name), 7) for name in params_names]
+    lines = [f'{metric + " m" :<{dive_width}} ' + ' '.join(f'{name :>{w}}' for name, w in zip(params_names, widths))]
+    for dive in dives:
+        lines.append(f'{dive :<{dive_width}} ' + ' '.join(cell(cells[dive, name], w)
+                                                           for name, w in zip(params_names, widths)))
+
+    means = []
+    for name in params_names:
+        values = [cells[dive, name] for dive in dives if cells[dive, name] is not None]
+        values = [v for v in values if not math.isnan(v)]
+        means.append(sum(values) / len(values) if values else None)
+    lines.append(f'{"mean" :<{dive_width}} ' + ' '.join(cell(mean, w) for mean, w in zip(means, widths)))
+    return lines
+
+
+def write_csv(path: str, jobs: list[ReplayJob], results: list[matrix.Result]):
+    by_name = {result.name: result for result in results}
+    fields = ['dive', 'params', 'tlog'] + [f for f in analysis.Metrics._fields if f != 'name'] + ['wall_time']
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(fields)
+        for job in jobs:
+            if job.name in by_name:
+                result = by_name[job.name]
+                writer.writerow([job.dive, job.params_name, result.log_path] +
+                                [result.metrics.get(field) for field in fields[3:]])
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--params', type=str, nargs='+', required=True, help='paths of parameter files')
+    parser.add_argument('--speedup', type=float, default=1.0, help='SIM_SPEEDUP value')
+    parser.add_argument('--start', type=float, default=None, help='start replay this many seconds into each tlog')
+    parser.add_argument('--end', type=float, default=None, help='stop replay this many seconds into each tlog')
+    parser.add_argument('--lockstep', action='store_true', help="pace each replay by ArduSub's clock")
+    parser.add_argument('--sim-timestamps', action='store_true', help='stamp the tlogs with sim time')
+    parser.add_argument('--cache', type=str, default=cache.DEFAULT_DIR, help='result cache directory')
+    parser.add_argument('--no-cache', action='store_true', help='replay every dive, even if the result is current')
+    parser.add_argument('--out', type=str, default='/tmp', help='directory for tlogs, console output and SITL files')
+    parser.add_argument('--csv', type=str, default=None, help='write every result to this CSV file')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of replays to run at once')
+    parser.add_argument('--first-instance', type=int, default=0, help='lowest ArduSub SITL instance number to use')
+    parser.add_argument('--max-uses', type=int, default=10,
+                        help='reuse each ArduSub instance for up to this many replays, 0 to start a new one each')
+    parser.add_argument('--dataflash', action='store_true', help="copy ArduSub's DataFlash logs next to the tlogs")
+    parser.add_argument('--stop', type=str, action='append', default=[],
+                        help='end each replay early when this condition holds, see stop_conditions.py')
+    parser.add_argument('dives', nargs='+', help='tlogs, directories of tlogs, or glob patterns')
+    args = parser.parse_args()
+    try:
+        stop_conditions.parse_conditions(args.stop, ranking=True)
+    except ValueError as e:
+        parser.error(str(e))
+
+    replay_paths = find_tlogs(args.dives)
+    if not replay_paths:
+        print('BATCH: no tlogs found')
+        exit(1)
+
+    jobs = build_jobs(replay_paths, args.params)
+    options = Options(args.speedup, args.start, args.end, None if args.no_cache else args.cache, args.max_uses,
+                      args.dataflash, args.lockstep, args.sim_timestamps, tuple(args.stop))
+    print(f'BATCH: {len(replay_paths)} dives x {len(args.params)} param files on up to {args.jobs} workers')
+    start = time.time()
+    results = run_batch(jobs, options, args.out, args.jobs, args.first_instance)
+    print(f'BATCH: {len(results)} of {len(jobs)} replays finished in {time.time() - start :.1f}s')
+
+    table = [analysis.Metrics(result.name, *[result.metrics.get(f) for f in analysis.Metrics._fields[1:]])
+             for result in results]
+    for line in analysis.format_table(table):
+        print(line)
+    print()
+    for metric in ['rms', 'max']:
+        for line in format_comparison(jobs, results, metric):
+            print(line)
+        print()
+
+    if args.csv:
+        write_csv(args.csv, jobs, results)
+        print(f'BATCH: wrote {args.csv}')
+
+
+if __name__ == '__main__':
+    main()
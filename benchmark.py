@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark the SimRunner send, receive and log paths and the sensor loop, without SITL.
+
+Each benchmark runs against FakeArduSub (see fake_ardusub.py) on --instance:
+    encode      pack GPS_INPUT with a MessageTemplate and with pymavlink, messages/s
+    log         LogWriter.write_buf() to a temp file, including the final flush, messages/s
+    send        SimRunner.send_to_ardusub() with logging, until FakeArduSub has received them all, messages/s
+    recv        SimRunner receiving and logging a burst of LOCAL_POSITION_NED, messages/s, both logged as raw frames
+                and decoded for a listener
+    loop        SimSensors at doubling speedups for --wall-time seconds each, fraction of sensor ticks missed
+                or skipped; max_speedup is the highest speedup that misses at most --miss-threshold
+
+With --history, the results are appended to a JSON lines file along with the git commit, and compared with the last
+entry from a different commit. A metric that got worse by more than --tolerance is a regression, and the exit status
+is 1.
+
+Example:
+    python benchmark.py --history benchmarks.jsonl
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Use MAVLink2 wire protocol, must include this before importing pymavlink.mavutil
+os.environ['MAVLINK20'] = '1'
+
+import fake_ardusub
+import log_writer
+import msg_template
+import sim_runner
+import sim_sensors
+
+# {metric: (unit, higher is better)}
+METRICS = {
+    'encode_template': ('msg/s', True),
+    'encode_pymavlink': ('msg/s', True),
+    'log': ('msg/s', True),
+    'send': ('msg/s', True),
+    'recv_raw': ('msg/s', True),
+    'recv_decoded': ('msg/s', True),
+    'max_speedup': ('x', True),
+}
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def connect(instance: int, speedup: float, telemetry_rate: float):
+    """
+    Start a FakeArduSub and connect to it.
+    """
+    fake = fake_ardusub.FakeArduSub(instance, speedup, telemetry_rate)
+    return fake, sim_runner.ArduSubInstance(speedup, instance, connect_only=True)
+
+
+class Counter:
+    """
+    A SimRunner listener that counts received messages of one type.
+    """
+
+    def __init__(self, msg_type: str):
+        self.msg_type = msg_type
+        self.recv_types = [msg_type]
+        self.count = 0
+
+    def on_send(self, msg, wall: float):
+        pass
+
+    def on_recv(self, msg, wall: float):
+        if msg.get_type() == self.msg_type:
+            self.count += 1
+
+    def report(self) -> list[str]:
+        return []
+
+
+def bench_encode(n: int) -> dict[str, float]:
+    mav = sim_runner.apm2.MAVLink(None, 255, 0)
+    template = msg_template.MessageTemplate(sim_sensors.default_gps_input_msg())
+    msg = sim_sensors.default_gps_input_msg()
+    results = {}
+    for name, m in [('encode_template', template), ('encode_pymavlink', msg)]:
+        start = time.perf_counter()
+        for i in range(n):
+            m.lat = i
+            m.pack(mav)
+        results[name] = n / (time.perf_counter() - start)
+    return results
+
+
+def bench_log(n: int, tmp_dir: str) -> dict[str, float]:
+    template = msg_template.MessageTemplate(sim_sensors.default_gps_input_msg())
+    msg_buf = template.pack(sim_runner.apm2.MAVLink(None, 255, 0))
+    start = time.perf_counter()
+    writer = log_writer.LogWriter(os.path.join(tmp_dir, 'log.tlog'))
+    for _ in range(n):
+        writer.write_buf(msg_buf)
+    writer.close()
+    return {'log': n / (time.perf_counter() - start)}
+
+
+def bench_send(n: int, instance: int, tmp_dir: str) -> dict[str, float]:
+    fake, ardusub = connect(instance, 1.0, 0.0)
+    runner = sim_runner.SimRunner(None, os.path.join(tmp_dir, 'send.tlog'), 1.0, ardusub=ardusub)
+    try:
+        template = msg_template.MessageTemplate(sim_sensors.default_gps_input_msg())
+        start = time.perf_counter()
+        for i in range(n):
+            template.lat = i
+            runner.send_to_ardusub(template)
+        deadline = time.time() + 30.0
+        while fake.recv_counts['GPS_INPUT'] < n and time.time() < deadline:
+            runner.wait_for_messages(0.001)
+        return {'send': fake.recv_counts['GPS_INPUT'] / (time.perf_counter() - start)}
+    finally:
+        runner.close()
+        ardusub.close()
+        fake.close()
+
+
+def bench_recv(n: int, instance: int, tmp_dir: str, decode: bool) -> float:
+    """
+    Receive and log n messages. If decode is set a listener asks for them, otherwise they're logged as raw frames.
+    """
+    fake, ardusub = connect(instance, 1.0, 0.0)
+    runner = sim_runner.SimRunner(None, os.path.join(tmp_dir, 'recv.tlog'), 1.0, ardusub=ardusub)
+    counter = Counter('LOCAL_POSITION_NED')
+    if decode:
+        runner.add_listener(counter)
+    try:
+        flood = threading.Thread(target=fake.flood, args=(fake.burst(n),))
+        start = time.perf_counter()
+        flood.start()
+        deadline = time.time() + 60.0
+        while counter.count + runner.recv_raw < n and time.time() < deadline:
+            runner.wait_for_messages(0.1)
+        elapsed = time.perf_counter() - start
+        flood.join()
+        return (counter.count + runner.recv_raw) / elapsed
+    finally:
+        runner.close()
+        ardusub.close()
+        fake.close()
+
+
+def bench_loop(speedup: float, wall_time: float, rates: sim_sensors.SensorRates, instance: int,
+               tmp_dir: str) -> float:
+    """
+    Run SimSensors for wall_time seconds at speedup, return the fraction of sensor ticks that were missed or skipped.
+    """
+    # Real ArduSub sends 3 telemetry messages at SimRunner.REQUEST_MSG_RATE in sim time
+    fake, ardusub = connect(instance, speedup, sim_runner.SimRunner.REQUEST_MSG_RATE * speedup)
+    try:
+        runner = sim_sensors.SimSensors(None, os.path.join(tmp_dir, 'loop.tlog'), speedup,
+                                        max(1, int(wall_time * speedup)), False, sim_sensors.SensorMode.UGPS_AND_DVL,
+                                        instance, rates=rates, ardusub=ardusub)
+        try:
+            runner.run()
+        finally:
+            runner.close()
+        tasks = runner.scheduler.tasks
+        ticks = sum(task.runs + task.skipped for task in tasks)
+        return sum(task.misses + task.skipped for task in tasks) / ticks if ticks else 1.0
+    finally:
+        ardusub.close()
+        fake.close()
+
+
+def bench_max_speedup(max_speedup: float, wall_time: float, threshold: float, rates: sim_sensors.SensorRates,
+                      instance: int, tmp_dir: str) -> dict[str, float]:
+    best = 0.0
+    speedup = 1.0
+    while speedup <= max_speedup:
+        missed = bench_loop(speedup, wall_time, rates, instance, tmp_dir)
+        print(f'BENCHMARK: loop at {speedup :g}x missed {missed * 100 :.2f}% of sensor ticks', file=sys.stderr)
+        if missed > threshold:
+            break
+        best = speedup
+        speedup *= 2.0
+    return {'max_speedup': best}
+
+
+def compare(previous: dict, current: dict, tolerance: float) -> list[str]:
+    """
+    Return a line for each metric that got worse by more than tolerance (a fraction).
+    """
+    regressions = []
+    for name, (unit, higher_is_better) in METRICS.items():
+        old, new = previous['results'].get(name), current['results'].get(name)
+        if not old or new is None:
+            continue
+        change = (new - old) / old if higher_is_better else (old - new) / old
+        if change < -tolerance:
+            regressions.append(f'{name}: {old :.1f} -> {new :.1f} {unit} ({change * 100 :+.1f}%), '
+                               f'was commit {previous["commit"]}')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--instance', type=int, default=50, help='SITL instance number, sets the fake port')
+    parser.add_argument('--messages', type=int, default=20000, help='messages per throughput benchmark')
+    parser.add_argument('--wall-time', type=float, default=2.0, help='wall time per loop benchmark')
+    parser.add_argument('--max-speedup', type=float, default=256.0, help='highest speedup to try')
+    parser.add_argument('--miss-threshold', type=float, default=0.01, help='max fraction of sensor ticks missed')
+    parser.add_argument('--dvl-rate', type=float, default=5.0, help='DVL rate in Hz')
+    parser.add_argument('--gps-rate', type=float, default=1.0, help='UGPS rate in Hz')
+    parser.add_argument('--history', type=str, default=None, help='append results to this JSON lines file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='regression threshold, a fraction')
+    args = parser.parse_args()
+
+    rates = sim_sensors.SensorRates(args.dvl_rate, args.gps_rate)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir, contextlib.redirect_stdout(open(os.devnull, 'w')):
+        results.update(bench_encode(args.messages))
+        results.update(bench_log(args.messages, tmp_dir))
+        results.update(bench_send(args.messages, args.instance, tmp_dir))
+        results['recv_raw'] = bench_recv(args.messages, args.instance, tmp_dir, False)
+        results['recv_decoded'] = bench_recv(args.messages, args.instance, tmp_dir, True)
+        results.update(bench_max_speedup(args.max_speedup, args.wall_time, args.miss_threshold, rates, args.instance,
+                                         tmp_dir))
+
+    for name, value in results.items():
+        print(f'BENCHMARK: {name :<18} {value :12.1f} {METRICS[name][0]}')
+
+    if args.history:
+        entry = {'commit': git_commit(), 'time': time.time(), 'results': results}
+        history = []
+        if os.path.exists(args.history):
+            with open(args.history) as f:
+                history = [json.loads(line) for line in f if line.strip()]
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+        previous = [h for h in history if h['commit'] != entry['commit']]
+        if previous:
+            regressions = compare(previous[-1], entry, args.tolerance)
+            for line in regressions:
+                print(f'BENCHMARK: regression {line}')
+            if regressions:
+                exit(1)
+            print(f'BENCHMARK: no regressions since commit {previous[-1]["commit"]}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Cache simulation results by the hash of everything that determines them.
+
+An entry is a directory named by the key that holds the tlog, the DataFlash log if there was one, and a metrics.json
+file. Entries are evicted least recently used first when the cache grows past its size limit. Runs without a seed are
+not reproducible, so they are not cached.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import dataflash
+import param
+
+DEFAULT_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ardusub_localization')
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+TLOG_NAME = 'run.tlog'
+BIN_NAME = 'run.bin'
+METRICS_NAME = 'metrics.json'
+
+# Part of every key. Bump it when what a run logs or how it is measured changes, so older entries aren't used
+KEY_VERSION = 2
+
+# {(path, size, mtime_ns): sha256}
+_file_hashes = {}
+
+
+def file_hash(path: str | None) -> str | None:
+    """
+    sha256 of a file, remembered for as long as its size and mtime don't change.
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while chunk := f.read(1 << 20):
+                h.update(chunk)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+
+def ardusub_hash() -> str | None:
+    ardupilot_home = os.environ.get('ARDUPILOT_HOME')
+    return file_hash(f'{ardupilot_home}/build/sitl/bin/ardusub') if ardupilot_home else None
+
+
+def params_key(params_path: str | None) -> list | None:
+    """
+    The parsed params, so comments and formatting don't change the key.
+    """
+    if params_path is None:
+        return None
+    return [[p.id.decode('ascii'), p.value, p.type] for p in param.parse_params(params_path)]
+
+
+def make_key(**parts) -> str:
+    parts['ardusub'] = ardusub_hash()
+    parts['version'] = KEY_VERSION
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def sensors_key(params_path: str | None, mode: int, duration: int, seed: int, **settings) -> str:
+    """
+    Key for a SimSensors run. settings are any other options that change the results (speedup, rates, ...).
+    """
+    return make_key(tool='sensors', params=params_key(params_path), mode=int(mode), duration=duration, seed=seed,
+                    **settings)
+
+
+def replay_key(params_path: str | None, replay_path: str, **settings) -> str:
+    """
+    Key for a SimReplay run. settings are any other options that change the results (speedup, start, end, ...).
+    """
+    return make_key(tool='replay', params=params_key(params_path), source=file_hash(replay_path), **settings)
+
+
+class ResultCache:
+    def __init__(self, root: str = DEFAULT_DIR, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+
+    def entry(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    def get(self, key: str, log_path: str | None, with_dataflash: bool = False) -> dict | None:
+        """
+        On a hit, copy the cached tlog to log_path (if set) and return the metrics. If with_dataflash is set, an entry
+        without a DataFlash log is a miss, otherwise the DataFlash log is copied next to log_path.
+        """
+        entry = self.entry(key)
+        metrics_path = os.path.join(entry, METRICS_NAME)
+        entry_bin = os.path.join(entry, BIN_NAME)
+        if not os.path.exists(metrics_path) or (with_dataflash and not os.path.exists(entry_bin)):
+            return None
+
+        # Mark as recently used
+        os.utime(entry)
+
+        if log_path:
+            shutil.copyfile(os.path.join(entry, TLOG_NAME), log_path)
+            if with_dataflash:
+                shutil.copyfile(entry_bin, dataflash.bin_path(log_path))
+        with open(metrics_path) as f:
+            return json.load(f)
+
+    def put(self, key: str, log_path: str, metrics: dict, with_dataflash: bool = False):
+        """
+        Store a finished run, and its DataFlash log if with_dataflash is set. The metrics file is written last, so a
+        partial entry is never a hit.
+        """
+        entry = self.entry(key)
+        os.makedirs(entry, exist_ok=True)
+        shutil.copyfile(log_path, os.path.join(entry, TLOG_NAME))
+        if with_dataflash and os.path.exists(dataflash.bin_path(log_path)):
+            shutil.copyfile(dataflash.bin_path(log_path), os.path.join(entry, BIN_NAME))
+        tmp_path = os.path.join(entry, METRICS_NAME + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(metrics, f)
+        os.replace(tmp_path, os.path.join(entry, METRICS_NAME))
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        total = 0
+        for key in os.listdir(self.root):
+            entry = self.entry(key)
+            if not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            print(f'CACHE: evicting {entry}')
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+def run_cached(result_cache: ResultCache | None, key: str | None, log_path: str | None, run, analyze,
+               with_dataflash: bool = False) -> dict:
+    """
+    Return cached metrics for this key, or call run() to produce log_path and analyze(log_path) to get the metrics.
+    A run is cached only if there is a cache, a key and a log. If with_dataflash is set the run must also produce a
+    DataFlash log, see ResultCache.get().
+    """
+    if result_cache is not None and key is not None and log_path:
+        metrics = result_cache.get(key, log_path, with_dataflash)
+        if metrics is not None:
+            print(f'CACHE: hit {key[:12]}, copied tlog to {log_path}')
+            return metrics
+
+    start = time.time()
+    run()
+    if not log_path:
+        return {}
+
+    metrics = analyze(log_path)
+    metrics['wall_time'] = time.time() - start
+    if result_cache is not None and key is not None:
+        result_cache.put(key, log_path, metrics, with_dataflash)
+    return metrics
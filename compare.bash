@@ -6,14 +6,9 @@
 #     DVL_ONLY = 2
 #     UGPS_AND_DVL = 3
 
-# DVL-only parameters:
-source run_sensors.bash params/lutris.params mode_0_lutris 20.0 400 0
-source run_sensors.bash params/lutris.params mode_1_lutris 20.0 400 1
-source run_sensors.bash params/lutris.params mode_2_lutris 20.0 400 2
-source run_sensors.bash params/lutris.params mode_3_lutris 20.0 400 3
+# Run all 8 combinations of DVL-only parameters (lutris) and fusion parameters x sensor modes in parallel.
+# Each run gets its own ArduSub instance, see matrix.py.
+python matrix.py --params params/lutris.params params/fusion.params --modes 0 1 2 3 --speedup 20.0 --time 400 --out /tmp
 
-# Fusion parameters:
-source run_sensors.bash params/fusion.params mode_0_fusion 20.0 400 0
-source run_sensors.bash params/fusion.params mode_1_fusion 20.0 400 1
-source run_sensors.bash params/fusion.params mode_2_fusion 20.0 400 2
-source run_sensors.bash params/fusion.params mode_3_fusion 20.0 400 3
+# Summarize the EKF error for all 8 runs
+python analysis.py /tmp/mode_?_lutris.tlog /tmp/mode_?_fusion.tlog
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+"""
+Read ArduPilot DataFlash logs (.bin) into NumPy arrays, one per field, without parsing them message by message.
+
+ArduSub writes its DataFlash log at the full rate of each table: EKF states (XKF1), innovations (XKF3), variances
+(XKF4), visual odometry (VISO) and so on. The tlog only has what ArduSub streams over MAVLink, at
+SimRunner.REQUEST_MSG_RATE.
+
+Each record is a 3 byte header (0xA3 0x95, type) followed by a fixed-length payload. The layout of each type is given
+by an FMT record, which ArduPilot writes before the first record of that type. The reader finds every header with
+NumPy, and keeps the ones that are followed by another header (or the end of the file) at the length the FMT gives.
+Stray bytes and a truncated record at the end, e.g., from a SITL that was stopped, are skipped.
+
+Values are scaled the same way as pymavlink: centi-units (format c, C, e, E) are divided by 100 and lat/lon (L) are
+in degrees. 'timestamp' is TimeUS in seconds.
+
+Example, summarize the EKF innovations in a log collected with sim_sensors.py --dataflash:
+    python dataflash.py --types XKF3 /tmp/fusion.bin
+"""
+
+import argparse
+import mmap
+import os
+import struct
+from typing import NamedTuple
+
+import numpy as np
+
+HEAD1 = 0xA3
+HEAD2 = 0x95
+HEADER_LEN = 3
+
+FMT_TYPE = 128
+FMT_LEN = 89
+FMT_STRUCT = struct.Struct('<BB4s16s64s')
+
+# Map DataFlash format codes to NumPy types
+NUMPY_TYPES = {
+    'a': ('<i2', (32,)), 'b': 'i1', 'B': 'u1', 'h': '<i2', 'H': '<u2', 'i': '<i4', 'I': '<u4', 'f': '<f4', 'd': '<f8',
+    'n': 'S4', 'N': 'S16', 'Z': 'S64', 'c': '<i2', 'C': '<u2', 'e': '<i4', 'E': '<u4', 'L': '<i4', 'M': 'u1',
+    'q': '<i8', 'Q': '<u8',
+}
+
+# {format code: multiplier}
+SCALES = {'c': 0.01, 'C': 0.01, 'e': 0.01, 'E': 0.01, 'L': 1e-7}
+
+
+class Format(NamedTuple):
+    type: int
+    length: int  # Including the header
+    name: str
+    format: str
+    columns: list[str]
+
+
+def bin_path(log_path: str) -> str:
+    """
+    Where the DataFlash log of a run is kept, next to its tlog.
+    """
+    return os.path.splitext(log_path)[0] + '.bin'
+
+
+def format_dtype(fmt: Format) -> np.dtype | None:
+    """
+    Build a packed NumPy dtype matching the payload of one type, or None if the FMT doesn't add up.
+    """
+    if len(fmt.format) != len(fmt.columns) or any(code not in NUMPY_TYPES for code in fmt.format):
+        return None
+    fields = []
+    for name, code in zip(fmt.columns, fmt.format):
+        numpy_type = NUMPY_TYPES[code]
+        fields.append((name, *numpy_type) if isinstance(numpy_type, tuple) else (name, numpy_type))
+    try:
+        dtype = np.dtype(fields)
+    except (TypeError, ValueError):
+        # E.g., a repeated column name
+        return None
+    return dtype if dtype.itemsize == fmt.length - HEADER_LEN else None
+
+
+def scan_formats(buf: np.ndarray, heads: np.ndarray) -> dict[int, Format]:
+    """
+    Parse every FMT record. heads are the offsets of all candidate headers.
+    """
+    formats = {}
+    for offset in heads[(buf[np.minimum(heads + 2, len(buf) - 1)] == FMT_TYPE) & (heads + FMT_LEN <= len(buf))]:
+        msg_type, length, name, fmt, columns = FMT_STRUCT.unpack_from(buf, offset + HEADER_LEN)
+        if msg_type in formats or length < HEADER_LEN:
+            continue
+        try:
+            fmt = Format(msg_type, length, name.rstrip(b'\0').decode('ascii'), fmt.rstrip(b'\0').decode('ascii'),
+                         columns.rstrip(b'\0').decode('ascii').split(','))
+        except UnicodeDecodeError:
+            # Not really an FMT record
+            continue
+        formats[msg_type] = fmt
+    return formats
+
+
+def scan_dataflash(buf: np.ndarray) -> tuple[dict[int, Format], np.ndarray, np.ndarray]:
+    """
+    Find every record in a DataFlash buffer. Returns (formats, offsets, types).
+    """
+    if len(buf) < HEADER_LEN:
+        return {}, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+
+    heads = np.flatnonzero((buf[:-2] == HEAD1) & (buf[1:-1] == HEAD2)).astype(np.int64)
+    formats = scan_formats(buf, heads)
+
+    lengths = np.zeros(256, dtype=np.int64)
+    for fmt in formats.values():
+        lengths[fmt.type] = fmt.length
+
+    types = buf[heads + 2]
+    ends = heads + lengths[types]
+    known = (lengths[types] > 0) & (ends <= len(buf))
+    heads, types, ends = heads[known], types[known], ends[known]
+
+    # A real record is followed by another header, or by the end of the file
+    last = len(buf) - 1
+    next_head = (buf[np.minimum(ends, last)] == HEAD1) & (buf[np.minimum(ends + 1, last)] == HEAD2)
+    followed = (ends == len(buf)) | next_head
+    heads, types, ends = heads[followed], types[followed], ends[followed]
+
+    # Drop headers that turned up inside the payload of an earlier record
+    previous_end = np.concatenate([[0], np.maximum.accumulate(ends)[:-1]])
+    outside = heads >= previous_end
+    return formats, heads[outside], types[outside]
+
+
+class DataflashReader:
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, 'rb')
+        # mmap can't map an empty file
+        if os.path.getsize(path):
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.buf = np.frombuffer(self.mmap, dtype=np.uint8)
+        else:
+            self.mmap = None
+            self.buf = np.zeros(0, dtype=np.uint8)
+        self.formats, self.offsets, self.types = scan_dataflash(self.buf)
+        self.by_name = {fmt.name: fmt for fmt in self.formats.values()}
+
+    def names(self) -> list[str]:
+        """
+        Names of the types that have at least one record, other than FMT.
+        """
+        present = set(np.unique(self.types).tolist()) - {FMT_TYPE}
+        return sorted(self.formats[t].name for t in present)
+
+    def count(self, name: str) -> int:
+        fmt = self.by_name.get(name)
+        return int(np.count_nonzero(self.types == fmt.type)) if fmt else 0
+
+    def rows(self, name: str) -> np.ndarray:
+        """
+        Copy every record of one type into a structured array, fields unscaled.
+        """
+        fmt = self.by_name[name]
+        dtype = format_dtype(fmt)
+        if dtype is None:
+            raise ValueError(f'cannot decode {name}, format {fmt.format}')
+        offsets = self.offsets[self.types == fmt.type] + HEADER_LEN
+        if not len(offsets):
+            return np.zeros(0, dtype=dtype)
+        # Index a sliding window over the file, which copies just the records
+        windows = np.lib.stride_tricks.sliding_window_view(self.buf, dtype.itemsize)
+        return windows[offsets].view(dtype).reshape(len(offsets))
+
+    def columns(self, name: str, fields: list[str] | None = None, start: float | None = None,
+                end: float | None = None) -> dict[str, np.ndarray]:
+        """
+        Decode every record of one type into a dict of field name -> array, scaled. 'timestamp' is TimeUS in seconds.
+        start and end are seconds of TimeUS, i.e., since ArduSub booted.
+        """
+        fmt = self.by_name[name]
+        rows = self.rows(name)
+        if 'TimeUS' in fmt.columns:
+            timestamp = rows['TimeUS'] * 1e-6
+            mask = np.ones(len(rows), dtype=bool)
+            if start is not None:
+                mask &= timestamp >= start
+            if end is not None:
+                mask &= timestamp <= end
+            rows, timestamp = rows[mask], timestamp[mask]
+            result = {'timestamp': timestamp}
+        else:
+            result = {}
+
+        codes = dict(zip(fmt.columns, fmt.format))
+        for field in fields if fields is not None else fmt.columns:
+            column = rows[field]
+            if codes[field] in SCALES:
+                column = column * SCALES[codes[field]]
+            result[field] = column
+        return result
+
+    def close(self):
+        # The array must be released before the mmap can be closed
+        self.buf = None
+        if self.mmap is not None:
+            self.mmap.close()
+        self.file.close()
+
+
+def summarize(reader: DataflashReader, name: str) -> list[str]:
+    """
+    Rate of one type, and the range of each numeric field.
+    """
+    columns = reader.columns(name)
+    n = reader.count(name)
+    lines = []
+    if 'timestamp' in columns and n > 1:
+        t = columns['timestamp']
+        lines.append(f'{name}: {n} records, {t[-1] - t[0] :.1f}s, {(n - 1) / (t[-1] - t[0]) :.1f}Hz')
+    else:
+        lines.append(f'{name}: {n} records')
+    for field, column in columns.items():
+        if field == 'timestamp' or field == 'TimeUS' or not len(column) or column.dtype.kind not in 'iuf':
+            continue
+        lines.append(f'    {field :<8} min {np.min(column) :12.4g} mean {np.mean(column) :12.4g} '
+                     f'max {np.max(column) :12.4g}')
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--types', type=str, nargs='+', default=None,
+                        help='summarize these types, default list every type and its count')
+    parser.add_argument('path')
+    args = parser.parse_args()
+
+    reader = DataflashReader(args.path)
+    try:
+        if args.types:
+            for name in args.types:
+                if name not in reader.by_name:
+                    print(f'DATAFLASH: no {name} records')
+                    continue
+                for line in summarize(reader, name):
+                    print(line)
+        else:
+            for name in reader.names():
+                print(f'{name :<6} {reader.count(name) :8d}')
+    finally:
+        reader.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+"""
+A stand-in for ArduSub SITL, for tests and benchmarks that shouldn't need a SITL build.
+
+FakeArduSub listens on the SITL port for an instance and talks just enough MAVLink for a SimRunner:
+* HEARTBEAT at heartbeat_rate, and STATUSTEXT "ArduPilot Ready" when the connection is made
+* GLOBAL_POSITION_INT, LOCAL_POSITION_NED and SYSTEM_TIME at telemetry_rate, with time_boot_ms running at speedup
+* PARAM_VALUE in reply to PARAM_REQUEST_LIST, PARAM_REQUEST_READ and PARAM_SET
+* COMMAND_ACK in reply to COMMAND_LONG, and for MAV_CMD_PREFLIGHT_REBOOT_SHUTDOWN a reboot: time_boot_ms starts over
+  and STATUSTEXT "ArduPilot Ready" is sent again, unless reboot_ok is False
+
+It counts what it receives, and flood() sends a burst of telemetry as fast as the socket takes it. Use it with
+SimRunner(ardusub=sim_runner.ArduSubInstance(speedup, instance, connect_only=True)).
+"""
+
+import collections
+import select
+import socket
+import threading
+import time
+
+from pymavlink.dialects.v20 import ardupilotmega as apm2
+
+import position
+import sim_runner
+
+
+class FakeArduSub:
+    # Fake param table, big enough that fetching it takes a realistic number of messages
+    PARAM_COUNT = 500
+
+    def __init__(self, instance: int = 0, speedup: float = 1.0, telemetry_rate: float = 10.0,
+                 heartbeat_rate: float = 1.0):
+        self.instance = instance
+        self.speedup = speedup
+        self.telemetry_period = 1.0 / telemetry_rate if telemetry_rate > 0.0 else None
+        self.heartbeat_period = 1.0 / heartbeat_rate
+
+        self.params: dict[str, float] = {f'FAKE_{i}': float(i) for i in range(FakeArduSub.PARAM_COUNT)}
+
+        # {msg_type: count} of messages received from the SimRunner
+        self.recv_counts = collections.Counter()
+        self.recv_bytes = 0
+        self.sent = 0
+        self.reboots = 0
+
+        # Set to False to play an instance that doesn't come back after a reboot
+        self.reboot_ok = True
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', sim_runner.ardusub_port(instance)))
+        self.server.listen(1)
+        self.conn = None
+        self.start = time.time()
+        self.mav = apm2.MAVLink(self, srcSystem=1, srcComponent=1)
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name='FakeArduSub', daemon=True)
+        self.thread.start()
+
+    def write(self, buf: bytes):
+        """
+        File interface for self.mav.
+        """
+        self.conn.sendall(buf)
+        self.sent += 1
+
+    def time_boot_ms(self) -> int:
+        return int((time.time() - self.start) * self.speedup * 1e3)
+
+    def send(self, msg):
+        with self.lock:
+            self.mav.send(msg)
+
+    def send_param(self, name: str):
+        names = list(self.params)
+        self.send(apm2.MAVLink_param_value_message(name.encode(), self.params[name], apm2.MAV_PARAM_TYPE_REAL32,
+                                                   len(names), names.index(name)))
+
+    def send_telemetry(self):
+        t = self.time_boot_ms()
+        lat, lon = position.Position.origin_int()
+        self.send(apm2.MAVLink_global_position_int_message(t, lat, lon, 0, 0, 0, 0, 0, 0))
+        self.send(apm2.MAVLink_local_position_ned_message(t, 0, 0, 0, 0, 0, 0))
+        self.send(apm2.MAVLink_system_time_message(int(time.time() * 1e6), t))
+
+    def burst(self, n: int) -> bytes:
+        """
+        Pack n LOCAL_POSITION_NED messages for flood().
+        """
+        mav = apm2.MAVLink(None, srcSystem=1, srcComponent=1)
+        buf = bytearray()
+        for i in range(n):
+            buf += apm2.MAVLink_local_position_ned_message(i, 0, 0, 0, 0, 0, 0).pack(mav)
+            mav.seq = (mav.seq + 1) % 256
+        return bytes(buf)
+
+    def flood(self, buf: bytes):
+        """
+        Send a burst in one write. Call from another thread once a SimRunner is connected.
+        """
+        with self.lock:
+            self.conn.sendall(buf)
+
+    def handle(self, msg):
+        msg_type = msg.get_type()
+        self.recv_counts[msg_type] += 1
+        if msg_type == 'PARAM_REQUEST_LIST':
+            for name in list(self.params):
+                self.send_param(name)
+        elif msg_type == 'PARAM_REQUEST_READ':
+            names = list(self.params)
+            if 0 <= msg.param_index < len(names):
+                self.send_param(names[msg.param_index])
+            elif msg.param_id in self.params:
+                self.send_param(msg.param_id)
+        elif msg_type == 'PARAM_SET':
+            self.params[msg.param_id] = msg.param_value
+            self.send_param(msg.param_id)
+        elif msg_type == 'COMMAND_LONG':
+            self.send(apm2.MAVLink_command_ack_message(msg.command, apm2.MAV_RESULT_ACCEPTED))
+            if msg.command == apm2.MAV_CMD_PREFLIGHT_REBOOT_SHUTDOWN and self.reboot_ok:
+                self.reboots += 1
+                self.start = time.time()
+                self.send(apm2.MAVLink_statustext_message(apm2.MAV_SEVERITY_INFO, b'ArduPilot Ready'))
+
+    def run(self):
+        # Wait for the SimRunner to connect
+        while not self.stopping:
+            ready, _, _ = select.select([self.server], [], [], 0.1)
+            if ready:
+                self.conn, _ = self.server.accept()
+                # Like SITL, don't hold back small writes
+                self.conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                break
+        if self.conn is None:
+            return
+
+        rx = apm2.MAVLink(None)
+        self.start = time.time()
+        self.send(apm2.MAVLink_heartbeat_message(apm2.MAV_TYPE_SUBMARINE, apm2.MAV_AUTOPILOT_ARDUPILOTMEGA,
+                                                 0, 0, 0, 3))
+        self.send(apm2.MAVLink_statustext_message(apm2.MAV_SEVERITY_INFO, b'ArduPilot Ready'))
+        next_heartbeat = self.start + self.heartbeat_period
+        next_telemetry = self.start if self.telemetry_period else None
+
+        try:
+            while not self.stopping:
+                now = time.time()
+                deadline = min(t for t in [next_heartbeat, next_telemetry, now + 0.1] if t is not None)
+                ready, _, _ = select.select([self.conn], [], [], max(deadline - now, 0.0))
+                if ready:
+                    data = self.conn.recv(65536)
+                    if not data:
+                        break
+                    self.recv_bytes += len(data)
+                    for msg in rx.parse_buffer(data) or []:
+                        self.handle(msg)
+
+                now = time.time()
+                if now >= next_heartbeat:
+                    self.send(apm2.MAVLink_heartbeat_message(apm2.MAV_TYPE_SUBMARINE,
+                                                             apm2.MAV_AUTOPILOT_ARDUPILOTMEGA, 0, 0, 0, 3))
+                    next_heartbeat += self.heartbeat_period
+                if next_telemetry is not None and now >= next_telemetry:
+                    self.send_telemetry()
+                    # Skip ahead rather than bursting if we fell behind
+                    next_telemetry = max(next_telemetry + self.telemetry_period, now)
+        except OSError:
+            # The SimRunner hung up
+            pass
+
+    def close(self):
+        self.stopping = True
+        self.thread.join()
+        if self.conn is not None:
+            self.conn.close()
+        self.server.close()
@@ -0,0 +1,116 @@
+"""
+Measure the latency from sensor messages sent to ArduSub to the ArduSub messages that reflect them.
+
+Stages:
+    GPS_INPUT -> GPS_RAW_INT                matched by lat/lon, ArduSub copies them
+    GPS_RAW_INT -> GLOBAL_POSITION_INT      first EKF output after the GPS_RAW_INT
+    GPS_INPUT -> GLOBAL_POSITION_INT        first EKF output after the GPS_RAW_INT
+    GPS_INPUT -> LOCAL_POSITION_NED         first EKF output after the GPS_RAW_INT
+    VISION_POSITION_DELTA -> GLOBAL_POSITION_INT    first EKF output after the send
+    VISION_POSITION_DELTA -> LOCAL_POSITION_NED     first EKF output after the send
+
+The EKF stages can't be better than the EKF output period (see SimRunner.REQUEST_MSG_RATE), so request a higher rate
+if you need finer resolution. Latency is measured in both wall time and sim time.
+"""
+
+from collections import deque
+from typing import Callable
+
+import numpy as np
+
+EKF_MSGS = ['GLOBAL_POSITION_INT', 'LOCAL_POSITION_NED']
+
+# Don't let unmatched GPS_INPUT messages pile up
+MAX_PENDING_GPS = 100
+
+# Don't let sends pile up if an EKF message isn't streamed, keep the newest
+MAX_PENDING_EKF = 100
+
+
+class Stage:
+    def __init__(self, name: str):
+        self.name = name
+        self.wall = []
+        self.sim = []
+
+    def add(self, wall: float, sim: float):
+        self.wall.append(wall)
+        self.sim.append(sim)
+
+    def report(self, bins: int) -> list[str]:
+        if not self.wall:
+            return [f'{self.name}: no samples']
+
+        lines = [f'{self.name}: {len(self.wall)} samples']
+        for clock, samples in [('wall', self.wall), ('sim', self.sim)]:
+            ms = np.array(samples) * 1e3
+            p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+            lines.append(f'  {clock} ms: min {ms.min() :.1f} p50 {p50 :.1f} p90 {p90 :.1f} p99 {p99 :.1f} '
+                         f'max {ms.max() :.1f}')
+
+        # Histogram of sim time latency
+        counts, edges = np.histogram(np.array(self.sim) * 1e3, bins=bins)
+        scale = 40.0 / counts.max()
+        for count, lo, hi in zip(counts, edges[:-1], edges[1:]):
+            lines.append(f'  {lo :8.1f} - {hi :8.1f} ms {count :6d} {"#" * int(round(count * scale))}')
+
+        return lines
+
+
+class LatencyTracker:
+    """
+    A SimRunner listener, see SimRunner.add_listener().
+    """
+
+    recv_types = ['GPS_RAW_INT'] + EKF_MSGS
+
+    def __init__(self, clock: Callable[[], float], bins: int = 10):
+        self.clock = clock
+        self.bins = bins
+        self.stages: dict[str, Stage] = {}
+
+        # GPS_INPUT sends waiting for GPS_RAW_INT, keyed by (lat, lon)
+        self.pending_gps: dict[tuple[int, int], tuple[float, float]] = {}
+
+        # Sends waiting for each EKF output: {ekf_msg: [(source, wall, sim)]}
+        self.pending_ekf: dict[str, deque[tuple[str, float, float]]] = {
+            msg_type: deque(maxlen=MAX_PENDING_EKF) for msg_type in EKF_MSGS}
+
+    def stage(self, name: str) -> Stage:
+        if name not in self.stages:
+            self.stages[name] = Stage(name)
+        return self.stages[name]
+
+    def wait_for_ekf(self, source: str, wall: float, sim: float):
+        for pending in self.pending_ekf.values():
+            pending.append((source, wall, sim))
+
+    def on_send(self, msg, wall: float):
+        msg_type = msg.get_type()
+        if msg_type == 'GPS_INPUT':
+            if len(self.pending_gps) >= MAX_PENDING_GPS:
+                self.pending_gps.pop(next(iter(self.pending_gps)))
+            self.pending_gps[(msg.lat, msg.lon)] = (wall, self.clock())
+        elif msg_type == 'VISION_POSITION_DELTA':
+            self.wait_for_ekf(msg_type, wall, self.clock())
+
+    def on_recv(self, msg, wall: float):
+        msg_type = msg.get_type()
+        if msg_type == 'GPS_RAW_INT':
+            sent = self.pending_gps.pop((msg.lat, msg.lon), None)
+            if sent is not None:
+                sim = self.clock()
+                self.stage('GPS_INPUT -> GPS_RAW_INT').add(wall - sent[0], sim - sent[1])
+                self.wait_for_ekf('GPS_INPUT', *sent)
+                self.wait_for_ekf('GPS_RAW_INT', wall, sim)
+        elif msg_type in self.pending_ekf:
+            sim = self.clock()
+            for source, sent_wall, sent_sim in self.pending_ekf[msg_type]:
+                self.stage(f'{source} -> {msg_type}').add(wall - sent_wall, sim - sent_sim)
+            self.pending_ekf[msg_type].clear()
+
+    def report(self) -> list[str]:
+        lines = ['latency:']
+        for name in sorted(self.stages):
+            lines.extend(self.stages[name].report(self.bins))
+        return lines
@@ -0,0 +1,279 @@
+#!/usr/bin/env python3
+
+"""
+Follow the localization error while a run is in progress, rather than after it finishes.
+
+LiveAnalyzer takes the reference and EKF output (GLOBAL_POSITION_INT) positions in time order and keeps the same
+statistics as analysis.py: samples, RMS, mean and max error, and convergence time. As in analysis.py the reference is
+the ground truth (HIL_STATE_QUATERNION) once there is any, otherwise GPS_INPUT. Each update is O(1), so it can run for
+hours. Every --interval seconds (of log time) it prints a summary of the run so far and of the last interval.
+
+There are two ways to feed it:
+* In the run: LiveListener is a SimRunner listener, add it with sim_sensors.py --live or sim_replay.py --live.
+* From a tlog that LogWriter is still writing: follow() reads new records as they are flushed. Compressed tlogs
+  can't be followed.
+
+The final numbers match analysis.py for the same tlog.
+
+Example, watch a long replay from another terminal:
+    python live_analysis.py --follow --interval 120 /tmp/fusion.tlog
+"""
+
+import argparse
+import math
+import os
+import struct
+import time
+from typing import Callable
+
+import analysis
+import mav_frame
+import tlog_index
+
+# Scale from degE7 to meters, see analysis.horizontal_error()
+DEGE7_TO_M = math.radians(1e-7) * analysis.EARTH_RADIUS
+
+
+def horizontal_error(lat: int, lon: int, ref_lat: int, ref_lon: int) -> float:
+    """
+    Same as analysis.horizontal_error(), for one sample.
+    """
+    dn = (lat - ref_lat) * DEGE7_TO_M
+    de = (lon - ref_lon) * DEGE7_TO_M * math.cos(math.radians(ref_lat * 1e-7))
+    return math.hypot(dn, de)
+
+
+class ErrorStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.max = 0.0
+
+    def add(self, error: float):
+        self.count += 1
+        self.total += error
+        self.total_sq += error * error
+        if error > self.max:
+            self.max = error
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else math.nan
+
+    def rms(self) -> float:
+        return math.sqrt(self.total_sq / self.count) if self.count else math.nan
+
+
+class LiveAnalyzer:
+    def __init__(self, name: str = '', threshold: float = 2.0, interval: float | None = 60.0,
+                 output: Callable[[str], None] = print):
+        self.name = name
+        self.threshold = threshold
+        self.interval = interval
+        self.output = output
+
+        # Most recent reference position (lat, lon), and True once it is the ground truth
+        self.reference = None
+        self.truth = False
+
+        self.total = ErrorStats()
+        self.window = ErrorStats()
+        self.t_first = None
+        self.t_last = None
+        self.next_summary = None
+
+        # Time of the first sample after the error last went above threshold, None while it is above
+        self.settled = None
+
+        self.last_error = math.nan
+
+    def add_reference(self, lat: int, lon: int, truth: bool = False):
+        """
+        Set the reference position. GPS_INPUT is ignored once there is ground truth.
+        """
+        if truth:
+            self.truth = True
+        elif self.truth:
+            return
+        self.reference = (lat, lon)
+
+    def add_estimate(self, t: float, lat: int, lon: int):
+        """
+        Compare an EKF output to the most recent reference. Samples before the first reference are ignored.
+        """
+        if self.reference is None:
+            return
+        error = horizontal_error(lat, lon, *self.reference)
+        self.last_error = error
+
+        if self.t_first is None:
+            self.t_first = t
+            self.settled = t
+            if self.interval:
+                self.next_summary = t + self.interval
+        self.t_last = t
+
+        self.total.add(error)
+        self.window.add(error)
+        if error >= self.threshold:
+            self.settled = None
+        elif self.settled is None:
+            self.settled = t
+
+        if self.next_summary is not None and t >= self.next_summary:
+            self.output(self.summary())
+            self.window = ErrorStats()
+            self.next_summary += self.interval * math.floor((t - self.next_summary) / self.interval + 1.0)
+
+    def convergence(self) -> float | None:
+        """
+        Seconds from the first sample until the error went below threshold for good, or None if it is above now.
+        """
+        return None if self.settled is None else self.settled - self.t_first
+
+    def duration(self) -> float:
+        return self.t_last - self.t_first if self.t_first is not None else 0.0
+
+    def metrics(self) -> analysis.Metrics:
+        if not self.total.count:
+            return analysis.Metrics(self.name, 0, 0.0, math.nan, math.nan, math.nan, None)
+        return analysis.Metrics(self.name, self.total.count, self.duration(), self.total.rms(), self.total.mean(),
+                                self.total.max, self.convergence())
+
+    def summary(self) -> str:
+        convergence = self.convergence()
+        converged = f'converged at {convergence :.1f}s' if convergence is not None else 'not converged'
+        return (f'live: {self.duration() :.0f}s, {self.total.count} samples, rms {self.total.rms() :.2f}m '
+                f'max {self.total.max :.2f}m, last {self.window.count} rms {self.window.rms() :.2f}m, {converged}')
+
+
+class LiveListener(LiveAnalyzer):
+    """
+    A SimRunner listener, see SimRunner.add_listener(). Times are sim time. Like the tlog, EKF output is only counted
+    once ArduSub has an origin.
+    """
+
+    recv_types = ['GLOBAL_POSITION_INT']
+
+    def __init__(self, runner, threshold: float = 2.0, interval: float | None = 60.0):
+        super().__init__(threshold=threshold, interval=interval, output=runner.print)
+        self.runner = runner
+
+    def on_send(self, msg, wall: float):
+        msg_type = msg.get_type()
+        if msg_type == analysis.TRUTH_MSG:
+            self.add_reference(msg.lat, msg.lon, truth=True)
+        elif msg_type == analysis.REFERENCE_MSG:
+            self.add_reference(msg.lat, msg.lon)
+
+    def on_recv(self, msg, wall: float):
+        if msg.get_type() == 'GLOBAL_POSITION_INT' and self.runner.ardusub_origin:
+            self.add_estimate(self.runner.sim_time(), msg.lat, msg.lon)
+
+    def report(self) -> list[str]:
+        return [self.summary()]
+
+
+class TlogFollower:
+    """
+    Read the reference and EKF output from a tlog as it grows. Only those message types are decoded.
+    """
+
+    MSGS = [analysis.TRUTH_MSG, analysis.REFERENCE_MSG, analysis.EKF_MSG]
+
+
+    def __init__(self, path: str, analyzer: LiveAnalyzer):
+        self.file = open(path, 'rb')
+        self.analyzer = analyzer
+        self.buf = bytearray()
+        self.truth_id = tlog_index.msg_class(analysis.TRUTH_MSG).id
+        self.estimate_id = tlog_index.msg_class(analysis.EKF_MSG).id
+        self.lat_lon = struct.Struct('<ii')
+
+        # {msg_id: offset of lat in the payload}, lon follows it
+        self.offsets = {tlog_index.msg_class(msg_type).id:
+                        tlog_index.payload_dtype(tlog_index.msg_class(msg_type)).fields['lat'][1]
+                        for msg_type in TlogFollower.MSGS}
+        self.payload_len = max(tlog_index.msg_class(msg_type).unpacker.size for msg_type in TlogFollower.MSGS)
+
+    def payload(self, i: int) -> bytes:
+        """
+        The payload of the frame at buf[i], with the trailing zeros that MAVLink2 drops put back.
+        """
+        header_len = mav_frame.HEADER_LEN_V2 if self.buf[i] == mav_frame.MAGIC_V2 else mav_frame.HEADER_LEN_V1
+        return bytes(self.buf[i + header_len:i + header_len + self.buf[i + 1]]).ljust(self.payload_len, b'\0')
+
+    def read(self) -> int:
+        """
+        Process every complete record that has been written since the last call. Returns the number of new bytes.
+        """
+        data = self.file.read()
+        self.buf += data
+        buf = self.buf
+        i = 0
+        end = len(buf)
+        while end - i >= tlog_index.TIMESTAMP_LEN + mav_frame.MIN_HEADER_LEN:
+            frame = i + tlog_index.TIMESTAMP_LEN
+            length = mav_frame.frame_length(buf, frame)
+            if length == 0:
+                # Resync
+                i += 1
+                continue
+            if frame + length > end:
+                # Wait for the rest of the record
+                break
+            msg_id = mav_frame.msg_id(buf, frame)
+            if msg_id in self.offsets and mav_frame.crc_ok(buf, frame, msg_id):
+                lat, lon = self.lat_lon.unpack_from(self.payload(frame), self.offsets[msg_id])
+                if msg_id == self.estimate_id:
+                    self.analyzer.add_estimate(int.from_bytes(buf[i:frame], 'big') * 1e-6, lat, lon)
+                else:
+                    self.analyzer.add_reference(lat, lon, truth=msg_id == self.truth_id)
+            i = frame + length
+        del buf[:i]
+        return len(data)
+
+    def close(self):
+        self.file.close()
+
+
+def follow(path: str, analyzer: LiveAnalyzer, poll: float = 1.0, idle_timeout: float | None = None):
+    """
+    Read the tlog to the end, then keep reading as it grows until it hasn't grown for idle_timeout seconds. With
+    idle_timeout=None just read to the end.
+    """
+    follower = TlogFollower(path, analyzer)
+    try:
+        last_data = time.time()
+        while True:
+            if follower.read():
+                last_data = time.time()
+            elif idle_timeout is None or time.time() - last_data > idle_timeout:
+                break
+            else:
+                time.sleep(poll)
+    finally:
+        follower.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--threshold', type=float, default=2.0, help='convergence threshold in meters')
+    parser.add_argument('--interval', type=float, default=60.0, help='seconds of log time between summaries')
+    parser.add_argument('--follow', action='store_true', help='keep reading as the tlog grows')
+    parser.add_argument('--idle', type=float, default=30.0, help='with --follow, stop after this many idle seconds')
+    parser.add_argument('path')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.path):
+        print(f'{args.path} does not exist')
+        exit(1)
+
+    analyzer = LiveAnalyzer(args.path, args.threshold, args.interval)
+    follow(args.path, analyzer, idle_timeout=args.idle if args.follow else None)
+    for line in analysis.format_table([analyzer.metrics()]):
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
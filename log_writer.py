@@ -1,27 +1,141 @@
 """
 Write MAVLink messages to a tlog file.
+
+Messages are batched on the caller's thread and written to disk by a background thread. Call close() to write what is
+left; a writer that is still open when the interpreter exits is closed then, so the tlog is never cut short. If the
+path ends in .gz or .zst the tlog is compressed as it is written; decompress it (gunzip, unzstd) before using the
+pymavlink tools.
+
+Each message is stamped with time.time(), or with another clock, e.g., SimRunner stamps messages with sim time so a
+run at --speedup 20 doesn't produce a tlog that is compressed 20x.
 """
 
+import atexit
+import gzip
+import queue
 import struct
+import threading
 import time
 
 
+def open_log(path: str, compression: str | None):
+    """
+    Open a log file for writing, optionally wrapped in a streaming compressor.
+    """
+    if compression is None:
+        return open(path, 'wb')
+    elif compression == 'gzip':
+        return gzip.open(path, 'wb', compresslevel=6)
+    elif compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError('zstd compression requires the zstandard package: pip install zstandard')
+        return zstandard.ZstdCompressor(level=3).stream_writer(open(path, 'wb'), closefd=True)
+    else:
+        raise ValueError(f'unknown compression {compression}')
+
+
+def compression_for_path(path: str) -> str | None:
+    if path.endswith('.gz'):
+        return 'gzip'
+    elif path.endswith('.zst'):
+        return 'zstd'
+    else:
+        return None
+
+
 class LogWriter:
-    def __init__(self, path: str):
+    # Hand a batch to the writer thread when it has this many messages...
+    BATCH_SIZE = 256
+
+    # ... or when the oldest message in the batch is this old, so the file doesn't lag too far behind
+    BATCH_USEC = 500_000
+
+    # Max batches waiting for the writer thread, write() blocks if the disk can't keep up
+    QUEUE_SIZE = 64
+
+    def __init__(self, path: str, compression: str | None = None, clock=None):
+        """
+        clock returns the timestamp for each message in seconds since the epoch, default time.time().
+        """
         self.path = path
-        self.file = open(path, 'wb')
+        self.clock = clock
+        if compression is None:
+            compression = compression_for_path(path)
+        self.file = open_log(path, compression)
+
+        self.batch = []
+        self.batch_usec = 0
+        self.queue = queue.Queue(maxsize=LogWriter.QUEUE_SIZE)
+        self.error = None
+        self.thread = threading.Thread(target=self.writer_thread, name='LogWriter', daemon=True)
+        self.thread.start()
+        self.closed = False
+        atexit.register(self.close)
 
     def write(self, msg):
         """
         Write a 64-bit unsigned timestamp, followed by the packed MAVLink message.
         """
-        usec = int(time.time() * 1.0e6)
-        usec_buf = bytearray(struct.pack('>Q', usec))
-        self.file.write(usec_buf)
-
         msg_buf = msg.get_msgbuf()
         if msg_buf is None or len(msg_buf) == 0:
             raise "TODO not implemented yet"
 
-        self.file.write(msg_buf)
-        self.file.flush()
+        self.write_buf(msg_buf)
+
+    def write_buf(self, msg_buf: bytes):
+        """
+        Write a frame that is already packed. msg_buf must not change after this call, the writer thread holds on to it.
+        """
+        # The batch age is always measured in wall time
+        now = int(time.time() * 1.0e6)
+        usec = now if self.clock is None else int(self.clock() * 1.0e6)
+        if not self.batch:
+            self.batch_usec = now
+        self.batch.append((usec, msg_buf))
+
+        if len(self.batch) >= LogWriter.BATCH_SIZE or now - self.batch_usec > LogWriter.BATCH_USEC:
+            self.flush()
+
+    def flush(self):
+        """
+        Hand the current batch to the writer thread.
+        """
+        if self.error:
+            raise self.error
+        if self.batch:
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def writer_thread(self):
+        pack_usec = struct.Struct('>Q').pack
+        while (batch := self.queue.get()) is not None:
+            if self.error:
+                continue
+            try:
+                block = bytearray()
+                for usec, msg_buf in batch:
+                    block += pack_usec(usec)
+                    block += msg_buf
+                self.file.write(block)
+                self.file.flush()
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        """
+        Write the rest of the messages and close the file. Safe to call more than once.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        if self.batch and not self.error:
+            self.queue.put(self.batch)
+            self.batch = []
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        if self.error:
+            raise self.error
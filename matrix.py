@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+"""
+Run a matrix of SimSensors experiments (param files x sensor modes x durations) on a pool of processes.
+
+Each worker process owns one ArduSub SITL instance number, and therefore its own port set and working directory,
+so the experiments can run side-by-side. The tlog and console output for each experiment are written to --out.
+
+With --max-uses N each worker keeps its ArduSub instance booted and reuses it for up to N experiments (see
+ardusub_pool.py), which saves the SITL startup time on every run but the first.
+
+Example, run the 8 experiments in compare.bash on 8 workers:
+    python matrix.py --params params/lutris.params params/fusion.params --modes 0 1 2 3 --time 400 --out /tmp
+"""
+
+import argparse
+import contextlib
+import multiprocessing
+import multiprocessing.util
+import os
+import time
+from typing import NamedTuple
+
+import analysis
+import ardusub_pool
+import cache
+import position
+import sim_sensors
+import stop_conditions
+
+
+class Experiment(NamedTuple):
+    name: str
+    params_path: str
+    mode: int
+    duration: int
+
+
+class Options(NamedTuple):
+    """
+    Settings shared by every experiment in the matrix.
+    """
+    speedup: float = 1.0
+    switch: bool = False
+    lockstep: bool = False
+    trajectory: str = 'circle'
+    seed: int | None = None
+    rates: sim_sensors.SensorRates = sim_sensors.SensorRates()
+    cache_dir: str | None = None  # See cache.py, only runs with a seed are cached
+    max_uses: int = 0  # Reuse each worker's ArduSub instance this many times, 0 to start a new one for every run
+    dataflash: bool = False  # Copy ArduSub's DataFlash log next to each tlog
+    sim_timestamps: bool = False  # Stamp the tlogs with sim time rather than wall time
+    stop: tuple[str, ...] = ()  # End each run early when one of these holds, see stop_conditions.py
+
+
+class Result(NamedTuple):
+    name: str
+    instance: int
+    log_path: str
+    wall_time: float
+    metrics: dict  # See analysis.Metrics
+
+
+def build_matrix(params_paths: list[str], modes: list[int], durations: list[int]) -> list[Experiment]:
+    """
+    Build the list of experiments. Names match run_sensors.bash, e.g., mode_0_fusion.
+    If there are several durations the duration is appended to the name, e.g., mode_0_fusion_400s.
+    """
+    experiments = []
+    for params_path in params_paths:
+        params_name = os.path.splitext(os.path.basename(params_path))[0]
+        for mode in modes:
+            for duration in durations:
+                name = f'mode_{mode}_{params_name}'
+                if len(durations) > 1:
+                    name += f'_{duration}s'
+                experiments.append(Experiment(name, params_path, mode, duration))
+    return experiments
+
+
+# Set in each worker process by init_worker()
+_instance = 0
+_pool: ardusub_pool.WarmPool | None = None
+
+
+def init_worker(instances: multiprocessing.Queue, options: Options | None = None, out_dir: str | None = None):
+    """
+    Claim an ArduSub instance number for this worker process. If options.max_uses is set, boot the instance now and
+    keep it for the life of the worker.
+
+    This must not raise: the pool would start a new worker, which would wait forever for an instance number. If the
+    instance can't be booted the worker runs without a warm pool, and each run fails on its own.
+    """
+    global _instance, _pool
+    _instance = instances.get()
+    if options is not None and options.max_uses > 0:
+        pool = ardusub_pool.WarmPool(options.speedup, [_instance], out_dir, options.max_uses)
+        try:
+            pool.boot()
+        except Exception as e:
+            print(f'MATRIX: could not boot ArduSub instance {_instance}: {e}')
+            pool.close()
+            return
+        _pool = pool
+        # Stop SITL when the worker exits, run_matrix() closes the pool so this happens
+        multiprocessing.util.Finalize(_pool, _pool.close, exitpriority=10)
+
+
+def experiment_key(experiment: Experiment, options: Options) -> str | None:
+    if options.seed is None:
+        return None
+    return cache.sensors_key(experiment.params_path, experiment.mode, experiment.duration, options.seed,
+                             speedup=options.speedup, switch=options.switch, lockstep=options.lockstep,
+                             trajectory=cache.file_hash(options.trajectory) or options.trajectory,
+                             rates=options.rates, sim_timestamps=options.sim_timestamps, stop=list(options.stop))
+
+
+def run_experiment(experiment: Experiment, options: Options, out_dir: str) -> Result:
+    """
+    Run a single experiment in this worker's ArduSub instance, or copy the results from the cache.
+    """
+    log_path = os.path.join(out_dir, f'{experiment.name}.tlog')
+    cwd = os.path.join(out_dir, f'instance_{_instance}')
+    start = time.time()
+
+    def run():
+        with open(os.path.join(out_dir, f'{experiment.name}.txt'), 'w') as out, contextlib.redirect_stdout(out):
+            ardusub = _pool.acquire() if _pool else None
+            failed = True
+            try:
+                runner = sim_sensors.SimSensors(experiment.params_path, log_path, options.speedup,
+                                                experiment.duration, options.switch,
+                                                sim_sensors.SensorMode(experiment.mode), _instance, cwd,
+                                                options.lockstep, options.trajectory, options.seed, options.rates,
+                                                ardusub, options.dataflash, options.sim_timestamps)
+                if options.stop:
+                    runner.add_listener(stop_conditions.StopMonitor(
+                        runner, stop_conditions.parse_conditions(options.stop)))
+                try:
+                    runner.run()
+                    failed = False
+                finally:
+                    runner.close()
+            finally:
+                if ardusub is not None:
+                    _pool.release(ardusub, discard=failed)
+
+    result_cache = cache.ResultCache(options.cache_dir) if options.cache_dir else None
+    metrics = cache.run_cached(result_cache, experiment_key(experiment, options), log_path, run,
+                               lambda path: analysis.analyze(path)._asdict(), options.dataflash)
+
+    return Result(experiment.name, _instance, log_path, time.time() - start, metrics)
+
+
+class WorkerPool:
+    """
+    A pool of `jobs` worker processes, each with its own ArduSub instance, see init_worker(). Instance numbers are
+    first_instance .. first_instance + jobs - 1. The workers, and their warm instances, last until close(), so several
+    batches can be run on one pool, e.g., the rounds of a Monte Carlo study.
+    """
+
+    def __init__(self, options, out_dir: str, jobs: int, first_instance: int = 0, label: str = 'MATRIX'):
+        os.makedirs(out_dir, exist_ok=True)
+        self.options = options
+        self.out_dir = out_dir
+        self.label = label
+
+        instances = multiprocessing.Queue()
+        for instance in range(first_instance, first_instance + jobs):
+            instances.put(instance)
+        self.pool = multiprocessing.Pool(jobs, initializer=init_worker, initargs=(instances, options, out_dir))
+
+    def run(self, target, items: list) -> list[Result]:
+        """
+        Call target(item, options, out_dir) for each item. Each item needs a name, and target returns a Result.
+        Failed items are left out.
+        """
+        results = []
+        pending = [self.pool.apply_async(target, (item, self.options, self.out_dir)) for item in items]
+        for item, future in zip(items, pending):
+            try:
+                result = future.get()
+                print(f'{self.label}: {result.name} finished on instance {result.instance} in '
+                      f'{result.wall_time :.1f}s')
+                results.append(result)
+            except Exception as e:
+                print(f'{self.label}: {item.name} failed: {e}')
+        return results
+
+    def close(self):
+        # Let the workers exit normally so they stop their warm ArduSub instances
+        self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.pool.terminate()
+
+
+def run_pool(target, items: list, options, out_dir: str, jobs: int, first_instance: int = 0,
+             label: str = 'MATRIX') -> list[Result]:
+    """
+    Call target(item, options, out_dir) for each item on a pool of at most `jobs` worker processes, see WorkerPool.
+    """
+    with WorkerPool(options, out_dir, max(1, min(jobs, len(items))), first_instance, label) as pool:
+        return pool.run(target, items)
+
+
+def run_matrix(experiments: list[Experiment], options: Options, out_dir: str, jobs: int,
+               first_instance: int = 0) -> list[Result]:
+    """
+    Run all experiments, at most `jobs` at a time. Instance numbers are first_instance .. first_instance + jobs - 1.
+    """
+    return run_pool(run_experiment, experiments, options, out_dir, jobs, first_instance)
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--params', type=str, nargs='+', required=True, help='paths of parameter files')
+    parser.add_argument('--modes', type=int, nargs='+', default=[0], help='sensor modes, see sim_sensors.py')
+    parser.add_argument('--time', type=int, nargs='+', default=[60], help='how long to run each simulation')
+    parser.add_argument('--speedup', type=float, default=1.0, help='SIM_SPEEDUP value')
+    parser.add_argument('--switch', action='store_true', help='switch EKF sources when DVL goes on/off')
+    parser.add_argument('--lockstep', action='store_true', help="drive the sensors from ArduSub's clock")
+    parser.add_argument('--sim-timestamps', action='store_true', help='stamp the tlogs with sim time')
+    parser.add_argument('--trajectory', type=str, default='circle',
+                        help='circle, lawnmower, or path of a waypoint file')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the sensor noise, same for every experiment')
+    parser.add_argument('--dvl-rate', type=float, default=5.0, help='DVL rate in Hz')
+    parser.add_argument('--gps-rate', type=float, default=1.0, help='UGPS rate in Hz')
+    parser.add_argument('--cache', type=str, default=None,
+                        help='result cache directory, e.g., ~/.cache/ardusub_localization (requires --seed)')
+    parser.add_argument('--out', type=str, default='/tmp', help='directory for tlogs, console output and SITL files')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of simulations to run at once')
+    parser.add_argument('--first-instance', type=int, default=0, help='lowest ArduSub SITL instance number to use')
+    parser.add_argument('--max-uses', type=int, default=0,
+                        help='reuse each ArduSub instance for up to this many experiments, 0 to start a new one each')
+    parser.add_argument('--dataflash', action='store_true', help="copy ArduSub's DataFlash logs next to the tlogs")
+    parser.add_argument('--stop', type=str, action='append', default=[],
+                        help='end each run early when this condition holds, see stop_conditions.py')
+    args = parser.parse_args()
+    try:
+        stop_conditions.parse_conditions(args.stop, ranking=True)
+        position.make_trajectory(args.trajectory)
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+
+    experiments = build_matrix(args.params, args.modes, args.time)
+    print(f'MATRIX: running {len(experiments)} experiments on up to {args.jobs} workers')
+    start = time.time()
+    rates = sim_sensors.SensorRates(args.dvl_rate, args.gps_rate)
+    options = Options(args.speedup, args.switch, args.lockstep, args.trajectory, args.seed, rates, args.cache,
+                      args.max_uses, args.dataflash, args.sim_timestamps, tuple(args.stop))
+    results = run_matrix(experiments, options, args.out, args.jobs, args.first_instance)
+    print(f'MATRIX: {len(results)} of {len(experiments)} experiments finished in {time.time() - start :.1f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Read MAVLink frame headers without decoding the message.
+
+MAVLink1: magic(0xFE) len seq sysid compid msgid payload crc(2)
+MAVLink2: magic(0xFD) len incompat compat seq sysid compid msgid(3) payload crc(2) [signature(13)]
+"""
+
+from pymavlink.dialects.v20 import ardupilotmega as apm2
+
+MAGIC_V1 = apm2.PROTOCOL_MARKER_V1
+MAGIC_V2 = apm2.PROTOCOL_MARKER_V2
+
+HEADER_LEN_V1 = 6
+HEADER_LEN_V2 = 10
+CRC_LEN = 2
+SIGNATURE_LEN = 13
+
+# The longest possible frame, a signed MAVLink2 frame with a 255 byte payload
+MAX_FRAME_LEN = HEADER_LEN_V2 + 255 + CRC_LEN + SIGNATURE_LEN
+
+# Enough bytes to call frame_length() and msg_id()
+MIN_HEADER_LEN = HEADER_LEN_V2
+
+
+def frame_length(buf, i: int) -> int:
+    """
+    Return the length of the frame that starts at buf[i], or 0 if buf[i] is not a magic byte.
+    buf must hold at least 3 bytes starting at i.
+    """
+    magic = buf[i]
+    if magic == MAGIC_V2:
+        length = HEADER_LEN_V2 + buf[i + 1] + CRC_LEN
+        if buf[i + 2] & apm2.MAVLINK_IFLAG_SIGNED:
+            length += SIGNATURE_LEN
+        return length
+    elif magic == MAGIC_V1:
+        return HEADER_LEN_V1 + buf[i + 1] + CRC_LEN
+    else:
+        return 0
+
+
+def msg_id(buf, i: int) -> int:
+    """
+    Return the message id of the frame that starts at buf[i].
+    buf must hold at least MIN_HEADER_LEN bytes starting at i.
+    """
+    if buf[i] == MAGIC_V2:
+        return buf[i + 7] | buf[i + 8] << 8 | buf[i + 9] << 16
+    else:
+        return buf[i + 5]
+
+
+def msg_ids(names) -> set[int]:
+    """
+    Map message names, e.g., 'GPS_INPUT', to message ids.
+    """
+    return {getattr(apm2, f'MAVLINK_MSG_ID_{name}') for name in names}
+
+
+def frame_crc(buf, i: int, payload_end: int, crc_extra: bytes) -> int:
+    """
+    CRC of the frame that starts at buf[i]: everything after the magic byte up to payload_end, then the CRC extra byte.
+    """
+    if apm2.mcrf4xx is not None:
+        # fastcrc is installed, skip the x25crc wrapper
+        return apm2.mcrf4xx(crc_extra, apm2.mcrf4xx(memoryview(buf)[i + 1:payload_end], 0xFFFF))
+    crc = apm2.x25crc(memoryview(buf)[i + 1:payload_end])
+    crc.accumulate(crc_extra)
+    return crc.crc
+
+
+# {msg id: CRC extra byte}
+CRC_EXTRA = {msg_id: bytes([msg_class.crc_extra]) for msg_id, msg_class in apm2.mavlink_map.items()}
+
+
+def crc_ok(buf, i: int, frame_msg_id: int) -> bool:
+    """
+    Check the CRC of the complete frame that starts at buf[i]. Frames with unknown message ids fail.
+    """
+    crc_extra = CRC_EXTRA.get(frame_msg_id)
+    if crc_extra is None:
+        return False
+    payload_end = i + (HEADER_LEN_V2 if buf[i] == MAGIC_V2 else HEADER_LEN_V1) + buf[i + 1]
+    return frame_crc(buf, i, payload_end, crc_extra) == buf[payload_end] | buf[payload_end + 1] << 8
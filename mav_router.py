@@ -0,0 +1,301 @@
+"""
+Forward MAVLink between ArduSub and ground control stations, so QGC, MAVProxy or pymavlink scripts can attach to a
+run without a mavproxy process in the middle.
+
+SimRunner hands every frame it receives from ArduSub to Router.forward(), as the bytes it already has: frames are not
+decoded or re-encoded. Each endpoint queues them and flush() writes what the socket takes, so one slow or stalled
+ground station never blocks the sensor loop. A queue holds at most max_bytes; frames that arrive while it is full are
+dropped for that endpoint only, and counted. Frames from the ground stations are split on the raw header and passed
+back to SimRunner, which writes them to ArduSub between its own messages.
+
+Endpoints:
+    udpout:HOST:PORT    send to a ground station listening on HOST:PORT, e.g., udpout:127.0.0.1:14550 for QGC
+    udpin:HOST:PORT     listen on HOST:PORT, send to whoever sent the most recent datagram
+    tcpin:HOST:PORT     listen for TCP connections, any number of clients, each with its own queue
+
+Add endpoints with --route on sim_sensors.py or sim_replay.py, e.g.:
+    python sim_sensors.py --params params/fusion.params --time 600 --route udpout:127.0.0.1:14550
+"""
+
+import collections
+import socket
+
+import mav_frame
+
+DEFAULT_MAX_BYTES = 256 * 1024
+
+# Pack frames into UDP datagrams up to this size, small enough to avoid IP fragmentation on a typical MTU
+MAX_DATAGRAM = 1400
+
+# Read at most this many bytes per socket per poll()
+RECV_MAX_BYTES = 1 << 16
+
+
+def parse_address(spec: str) -> tuple[str, str, int]:
+    """
+    Split an endpoint spec into (kind, host, port). Raises ValueError if it doesn't make sense.
+    """
+    try:
+        kind, host, port = spec.split(':')
+        if kind in ['udpout', 'udpin', 'tcpin'] and 0 < int(port) < 65536:
+            return kind, host, int(port)
+    except ValueError:
+        pass
+    raise ValueError(f'bad route {spec}, expected udpout:HOST:PORT, udpin:HOST:PORT or tcpin:HOST:PORT')
+
+
+def split_frames(buf: bytearray) -> list[bytes]:
+    """
+    Remove the complete frames from the front of buf and return them. Bytes that can't start a frame are dropped, a
+    partial frame at the end is left in buf.
+    """
+    frames = []
+    i = 0
+    end = len(buf)
+    while end - i >= 3:
+        length = mav_frame.frame_length(buf, i)
+        if length == 0:
+            i += 1
+            continue
+        if i + length > end:
+            break
+        frames.append(bytes(buf[i:i + length]))
+        i += length
+    del buf[:i]
+    return frames
+
+
+class Endpoint:
+    """
+    A bounded queue of frames for one ground station, and a buffer for what it sends.
+    """
+
+    def __init__(self, name: str, sock: socket.socket, max_bytes: int):
+        self.name = name
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.max_bytes = max_bytes
+        self.queue = collections.deque()
+        self.queued_bytes = 0
+        self.recv_buf = bytearray()
+        self.closed = False
+
+        self.sent_frames = 0
+        self.dropped_frames = 0
+        self.recv_frames = 0
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def ready(self) -> bool:
+        """
+        True if there is somewhere to send to.
+        """
+        return True
+
+    def queue_frame(self, frame: bytes):
+        if self.queued_bytes + len(frame) > self.max_bytes:
+            self.dropped_frames += 1
+            return
+        self.queue.append(frame)
+        self.queued_bytes += len(frame)
+
+    def take(self, max_len: int) -> list[bytes]:
+        """
+        Remove whole frames from the front of the queue, up to max_len bytes but at least one frame.
+        """
+        frames = [self.queue.popleft()]
+        size = len(frames[0])
+        while self.queue and size + len(self.queue[0]) <= max_len:
+            frames.append(self.queue.popleft())
+            size += len(frames[-1])
+        self.queued_bytes -= size
+        return frames
+
+    def flush(self):
+        raise NotImplementedError
+
+    def recv(self) -> list[bytes]:
+        raise NotImplementedError
+
+    def report(self) -> str:
+        return (f'route {self.name}: {self.sent_frames} frames sent, {self.dropped_frames} dropped, '
+                f'{self.recv_frames} received')
+
+    def close(self):
+        self.closed = True
+        self.sock.close()
+
+
+class UdpEndpoint(Endpoint):
+    def __init__(self, name: str, sock: socket.socket, max_bytes: int, peer: tuple[str, int] | None):
+        super().__init__(name, sock, max_bytes)
+        # udpout sends to a fixed address, udpin to the most recent sender
+        self.peer = peer
+        self.follow_sender = peer is None
+
+    def ready(self) -> bool:
+        return self.peer is not None
+
+    def flush(self):
+        while self.queue:
+            frames = self.take(MAX_DATAGRAM)
+            try:
+                self.sock.sendto(b''.join(frames), self.peer)
+            except OSError:
+                # The socket buffer is full, or nobody is listening on the port yet. Let these go rather than wait
+                self.dropped_frames += len(frames)
+                return
+            self.sent_frames += len(frames)
+
+    def recv(self) -> list[bytes]:
+        frames = []
+        for _ in range(RECV_MAX_BYTES // MAX_DATAGRAM):
+            try:
+                data, peer = self.sock.recvfrom(65536)
+            except OSError:
+                # Nothing to read, or an ICMP error from a send to a closed port
+                break
+            if self.follow_sender:
+                self.peer = peer
+            self.recv_buf += data
+            frames += split_frames(self.recv_buf)
+        self.recv_frames += len(frames)
+        return frames
+
+
+class TcpClient(Endpoint):
+    def __init__(self, name: str, sock: socket.socket, max_bytes: int):
+        super().__init__(name, sock, max_bytes)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # The part of a frame that the socket didn't take, sent before anything else so the stream stays aligned
+        self.pending = b''
+
+    def flush(self):
+        while self.pending or self.queue:
+            if not self.pending:
+                frames = self.take(RECV_MAX_BYTES)
+                self.sent_frames += len(frames)
+                self.pending = b''.join(frames)
+            try:
+                sent = self.sock.send(self.pending)
+            except BlockingIOError:
+                return
+            except OSError:
+                self.close()
+                return
+            self.pending = self.pending[sent:]
+
+    def recv(self) -> list[bytes]:
+        try:
+            data = self.sock.recv(RECV_MAX_BYTES)
+        except BlockingIOError:
+            return []
+        except OSError:
+            data = b''
+        if not data:
+            # The client hung up
+            self.close()
+            return []
+        self.recv_buf += data
+        frames = split_frames(self.recv_buf)
+        self.recv_frames += len(frames)
+        return frames
+
+
+class TcpServer:
+    def __init__(self, name: str, host: str, port: int):
+        self.name = name
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(4)
+        self.sock.setblocking(False)
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def accept(self) -> socket.socket | None:
+        try:
+            sock, _ = self.sock.accept()
+        except BlockingIOError:
+            return None
+        return sock
+
+    def close(self):
+        self.sock.close()
+
+
+class Router:
+    def __init__(self, specs: list[str], max_bytes: int = DEFAULT_MAX_BYTES, output=print):
+        self.max_bytes = max_bytes
+        self.output = output
+        self.endpoints: list[Endpoint] = []
+        self.servers: list[TcpServer] = []
+        # Endpoints that have closed, kept for the report
+        self.closed: list[Endpoint] = []
+        self.clients = 0
+
+        for spec in specs:
+            kind, host, port = parse_address(spec)
+            if kind == 'tcpin':
+                self.servers.append(TcpServer(spec, host, port))
+            else:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                if kind == 'udpin':
+                    sock.bind((host, port))
+                    self.endpoints.append(UdpEndpoint(spec, sock, max_bytes, None))
+                else:
+                    self.endpoints.append(UdpEndpoint(spec, sock, max_bytes, (host, port)))
+            self.output(f'route: {spec}')
+
+    def sockets(self) -> list:
+        """
+        Everything to select() on for input from the ground stations.
+        """
+        return self.servers + self.endpoints
+
+    def forward(self, frame: bytes):
+        """
+        Queue a frame from ArduSub for every endpoint that has somewhere to send it.
+        """
+        for endpoint in self.endpoints:
+            if endpoint.ready():
+                endpoint.queue_frame(frame)
+
+    def flush(self):
+        for endpoint in self.endpoints:
+            if endpoint.queue:
+                endpoint.flush()
+        self.remove_closed()
+
+    def poll(self) -> list[bytes]:
+        """
+        Accept new TCP clients, and return the complete frames that the ground stations have sent.
+        """
+        for server in self.servers:
+            while (sock := server.accept()) is not None:
+                self.clients += 1
+                client = TcpClient(f'{server.name} client {self.clients}', sock, self.max_bytes)
+                self.endpoints.append(client)
+                self.output(f'route: {client.name} connected')
+        frames = []
+        for endpoint in self.endpoints:
+            frames += endpoint.recv()
+        self.remove_closed()
+        return frames
+
+    def remove_closed(self):
+        for endpoint in [e for e in self.endpoints if e.closed]:
+            self.endpoints.remove(endpoint)
+            self.closed.append(endpoint)
+            self.output(f'route: {endpoint.name} disconnected')
+
+    def report(self) -> list[str]:
+        return [endpoint.report() for endpoint in self.closed + self.endpoints]
+
+    def close(self):
+        for endpoint in self.endpoints:
+            endpoint.close()
+        for server in self.servers:
+            server.close()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+"""
+Run many seeded repetitions of each configuration (param file x sensor mode) and report the localization error with
+confidence intervals.
+
+The sensor noise of a SimSensors run comes from its seed, see position.py, so a single run can be lucky or unlucky.
+Here each configuration is run with seeds --first-seed, --first-seed + 1, ..., on a pool of ArduSub instances (see
+matrix.py), in rounds. All configurations use the same seeds, so two configurations can be compared run by run: the
+confidence interval of the difference is built from the paired differences, which removes most of the noise that both
+runs share.
+
+After --min-runs runs, a configuration stops getting new runs when either:
+* its interval is tight: the half width is at most --precision meters, or
+* it is separated: the interval of its difference to every other configuration excludes zero, i.e., its rank is known,
+* or there is no data: every run failed or had no EKF output, so more runs won't help.
+The study stops when every configuration has stopped, or after --max-runs runs. The worker pool, and the warm ArduSub
+instances, are kept for the whole study.
+
+The intervals use Student's t at --confidence. Checking after every round makes a false separation somewhat more likely
+than 1 - confidence; raise --min-runs or --confidence if that matters.
+
+Runs with a seed are cached (see cache.py), so a study can be extended with a higher --max-runs or a tighter
+--precision without repeating the runs it already has.
+
+Example, is fusion.params better than lutris.params in mode 0?
+    python monte_carlo.py --params params/lutris.params params/fusion.params --modes 0 --time 400 --speedup 10.0 \\
+        --out /tmp/monte_carlo
+"""
+
+import argparse
+import csv
+import itertools
+import math
+import os
+import statistics
+import time
+from typing import NamedTuple
+
+import cache
+import matrix
+import position
+import sim_sensors
+import stop_conditions
+
+METRICS = ['rms', 'mean', 'max']
+
+
+class Replication(NamedTuple):
+    name: str
+    experiment: matrix.Experiment
+    seed: int
+
+
+class Summary(NamedTuple):
+    name: str
+    n: int
+    mean: float
+    std: float
+    half_width: float  # Of the confidence interval, nan if n < 2
+
+    def low(self) -> float:
+        return self.mean - self.half_width
+
+    def high(self) -> float:
+        return self.mean + self.half_width
+
+
+def t_quantile(p: float, df: int) -> float:
+    """
+    Quantile of Student's t distribution. Exact for df 1 and 2, otherwise from the normal quantile by a Cornish-Fisher
+    expansion (Abramowitz and Stegun 26.7.5), within 1% of the exact value for p <= 0.995.
+    """
+    if df == 1:
+        return math.tan(math.pi * (p - 0.5))
+    if df == 2:
+        return (2 * p - 1) / math.sqrt(2 * p * (1 - p))
+    z = statistics.NormalDist().inv_cdf(p)
+    g1 = (z ** 3 + z) / 4
+    g2 = (5 * z ** 5 + 16 * z ** 3 + 3 * z) / 96
+    g3 = (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / 384
+    g4 = (79 * z ** 9 + 776 * z ** 7 + 1482 * z ** 5 - 1920 * z ** 3 - 945 * z) / 92160
+    return z + g1 / df + g2 / df ** 2 + g3 / df ** 3 + g4 / df ** 4
+
+
+def summarize(name: str, values: list[float], confidence: float) -> Summary:
+    n = len(values)
+    if n == 0:
+        return Summary(name, 0, math.nan, math.nan, math.nan)
+    mean = statistics.fmean(values)
+    if n < 2:
+        return Summary(name, 1, mean, math.nan, math.nan)
+    std = statistics.stdev(values)
+    return Summary(name, n, mean, std, t_quantile(0.5 + confidence / 2, n - 1) * std / math.sqrt(n))
+
+
+def paired_difference(a: dict[int, float], b: dict[int, float], confidence: float) -> Summary:
+    """
+    Summarize a - b over the seeds that both have a value for.
+    """
+    return summarize('difference', [a[seed] - b[seed] for seed in sorted(a.keys() & b.keys())], confidence)
+
+
+def is_separated(difference: Summary) -> bool:
+    return difference.n >= 2 and (difference.low() > 0.0 or difference.high() < 0.0)
+
+
+def replication_name(experiment: matrix.Experiment, seed: int) -> str:
+    return f'{experiment.name}_seed_{seed}'
+
+
+def run_replication(replication: Replication, options: matrix.Options, out_dir: str) -> matrix.Result:
+    """
+    Run one experiment with one seed in this worker's ArduSub instance, see matrix.run_experiment().
+    """
+    experiment = replication.experiment._replace(name=replication.name)
+    return matrix.run_experiment(experiment, options._replace(seed=replication.seed), out_dir)
+
+
+class Study:
+    def __init__(self, experiments: list[matrix.Experiment], options: matrix.Options, out_dir: str, jobs: int,
+                 metric: str = 'rms', confidence: float = 0.95, precision: float = 0.1, min_runs: int = 5,
+                 max_runs: int = 50, first_seed: int = 0, first_instance: int = 0):
+        # Raises ValueError if the runs would be scored on different windows, see stop_conditions.py
+        stop_conditions.parse_conditions(list(options.stop), ranking=True)
+
+        self.experiments = experiments
+        self.options = options
+        self.out_dir = out_dir
+        self.jobs = jobs
+        self.metric = metric
+        self.confidence = confidence
+        self.precision = precision
+        self.min_runs = max(2, min_runs)
+        self.max_runs = max(self.min_runs, max_runs)
+        self.first_seed = first_seed
+        self.first_instance = first_instance
+
+        # {experiment name: {seed: metric}}, failed runs and runs without EKF output are left out
+        self.values: dict[str, dict[int, float]] = {e.name: {} for e in experiments}
+        self.runs = {e.name: 0 for e in experiments}
+        self.results: list[tuple[Replication, matrix.Result]] = []
+        self.stopped: dict[str, str] = {}
+
+    def summary(self, name: str) -> Summary:
+        return summarize(name, [self.values[name][seed] for seed in sorted(self.values[name])], self.confidence)
+
+    def difference(self, a: str, b: str) -> Summary:
+        return paired_difference(self.values[a], self.values[b], self.confidence)
+
+    def stop_reason(self, name: str) -> str | None:
+        """
+        Why this experiment needs no more runs, or None if it does.
+        """
+        if self.runs[name] >= self.min_runs:
+            if not self.values[name]:
+                return 'no data'
+            if self.summary(name).half_width <= self.precision:
+                return 'tight'
+            others = [e.name for e in self.experiments if e.name != name]
+            if others and all(is_separated(self.difference(name, other)) for other in others):
+                return 'separated'
+        if self.runs[name] >= self.max_runs:
+            return 'max runs'
+        return None
+
+    def run_round(self, pool: matrix.WorkerPool, count: int, label: str):
+        """
+        Run the next `count` seeds of every experiment that hasn't stopped.
+        """
+        replications = []
+        for experiment in self.experiments:
+            if experiment.name in self.stopped:
+                continue
+            for seed in range(self.first_seed + self.runs[experiment.name],
+                              self.first_seed + min(self.runs[experiment.name] + count, self.max_runs)):
+                replications.append(Replication(replication_name(experiment, seed), experiment, seed))
+        if not replications:
+            return
+
+        print(f'MONTE CARLO: {label}: {len(replications)} runs')
+        results = {result.name: result for result in pool.run(run_replication, replications)}
+        for replication in replications:
+            name = replication.experiment.name
+            self.runs[name] += 1
+            result = results.get(replication.name)
+            if result is None:
+                continue
+            self.results.append((replication, result))
+            value = result.metrics.get(self.metric)
+            if value is not None and not math.isnan(value):
+                self.values[name][replication.seed] = value
+
+    def run(self) -> dict[str, str]:
+        """
+        Run rounds until every experiment has stopped. Returns {experiment name: stop reason}.
+        """
+        jobs = max(1, min(self.jobs, len(self.experiments) * self.max_runs))
+        with matrix.WorkerPool(self.options, self.out_dir, jobs, self.first_instance, 'MONTE CARLO') as pool:
+            count = self.min_runs
+            for n in itertools.count():
+                self.run_round(pool, count, f'round {n}')
+                for experiment in self.experiments:
+                    if experiment.name not in self.stopped:
+                        reason = self.stop_reason(experiment.name)
+                        if reason is not None:
+                            self.stopped[experiment.name] = reason
+                            print(f'MONTE CARLO: {experiment.name} stopped after {self.runs[experiment.name]} runs, '
+                                  f'{reason}')
+
+                active = len(self.experiments) - len(self.stopped)
+                if not active:
+                    return self.stopped
+                # Enough runs per experiment to keep every worker busy
+                count = max(1, math.ceil(jobs / active))
+
+
+def format_summaries(study: Study) -> list[str]:
+    width = max([len(e.name) for e in study.experiments] + [4])
+    pct = f'{study.confidence * 100 :g}%'
+    lines = [f'{"name" :<{width}} {"runs" :>5} {"n" :>5} {study.metric + " m" :>8} {"std" :>7} {pct + " low" :>9} '
+             f'{pct + " high" :>9}  stopped']
+    for experiment in study.experiments:
+        s = study.summary(experiment.name)
+        lines.append(f'{s.name :<{width}} {study.runs[s.name] :5d} {s.n :5d} {s.mean :8.3f} {s.std :7.3f} '
+                     f'{s.low() :9.3f} {s.high() :9.3f}  {study.stopped.get(s.name, "")}')
+    return lines
+
+
+def format_differences(study: Study) -> list[str]:
+    """
+    The paired difference of every pair of experiments, a - b, negative if a has the lower error.
+    """
+    lines = []
+    for a, b in itertools.combinations([e.name for e in study.experiments], 2):
+        d = study.difference(a, b)
+        verdict = ('lower' if d.high() < 0.0 else 'higher') if is_separated(d) else 'not separated'
+        lines.append(f'{a} - {b}: {d.mean :+.3f}m [{d.low() :+.3f}, {d.high() :+.3f}] over {d.n} seeds, '
+                     f'{a} is {verdict}')
+    return lines
+
+
+def write_csv(path: str, study: Study):
+    fields = ['name', 'seed', 'tlog', 'samples', 'duration', 'rms', 'mean', 'max', 'convergence', 'wall_time']
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(fields)
+        for replication, result in study.results:
+            writer.writerow([replication.experiment.name, replication.seed, result.log_path] +
+                            [result.metrics.get(field) for field in fields[3:]])
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--params', type=str, nargs='+', required=True, help='paths of parameter files')
+    parser.add_argument('--modes', type=int, nargs='+', default=[0], help='sensor modes, see sim_sensors.py')
+    parser.add_argument('--time', type=int, default=400, help='how long to run each simulation')
+    parser.add_argument('--metric', choices=METRICS, default='rms', help='horizontal error metric, see analysis.py')
+    parser.add_argument('--confidence', type=float, default=0.95, help='confidence level of the intervals')
+    parser.add_argument('--precision', type=float, default=0.1, help='stop when the interval half width is this small')
+    parser.add_argument('--min-runs', type=int, default=5, help='runs per configuration before checking')
+    parser.add_argument('--max-runs', type=int, default=50, help='most runs per configuration')
+    parser.add_argument('--first-seed', type=int, default=0, help='seed of the first run')
+    parser.add_argument('--speedup', type=float, default=1.0, help='SIM_SPEEDUP value')
+    parser.add_argument('--lockstep', action='store_true', help="drive the sensors from ArduSub's clock")
+    parser.add_argument('--trajectory', type=str, default='circle',
+                        help='circle, lawnmower, or path of a waypoint file')
+    parser.add_argument('--dvl-rate', type=float, default=5.0, help='DVL rate in Hz')
+    parser.add_argument('--gps-rate', type=float, default=1.0, help='UGPS rate in Hz')
+    parser.add_argument('--cache', type=str, default=cache.DEFAULT_DIR, help='result cache directory')
+    parser.add_argument('--no-cache', action='store_true', help='run everything, even if the result is current')
+    parser.add_argument('--out', type=str, default='/tmp/monte_carlo', help='directory for tlogs and console output')
+    parser.add_argument('--csv', type=str, default=None, help='write every run to this CSV file')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of simulations to run at once')
+    parser.add_argument('--first-instance', type=int, default=0, help='lowest ArduSub SITL instance number to use')
+    parser.add_argument('--max-uses', type=int, default=10,
+                        help='reuse each ArduSub instance for up to this many runs, 0 to start a new one each')
+    args = parser.parse_args()
+    try:
+        position.make_trajectory(args.trajectory)
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+
+    experiments = matrix.build_matrix(args.params, args.modes, [args.time])
+    rates = sim_sensors.SensorRates(args.dvl_rate, args.gps_rate)
+    options = matrix.Options(args.speedup, lockstep=args.lockstep, trajectory=args.trajectory, rates=rates,
+                             cache_dir=None if args.no_cache else args.cache, max_uses=args.max_uses)
+    study = Study(experiments, options, args.out, args.jobs, args.metric, args.confidence, args.precision,
+                  args.min_runs, args.max_runs, args.first_seed, args.first_instance)
+
+    print(f'MONTE CARLO: {len(experiments)} configurations, {study.min_runs} to {study.max_runs} runs each, '
+          f'on up to {args.jobs} workers')
+    start = time.time()
+    study.run()
+    print(f'MONTE CARLO: {sum(study.runs.values())} runs finished in {time.time() - start :.1f}s')
+
+    for line in format_summaries(study):
+        print(line)
+    print()
+    for line in format_differences(study):
+        print(line)
+
+    if args.csv:
+        write_csv(args.csv, study)
+        print(f'MONTE CARLO: wrote {args.csv}')
+
+
+if __name__ == '__main__':
+    main()
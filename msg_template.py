@@ -0,0 +1,98 @@
+"""
+Send the same MAVLink message over and over, with a few fields changed each time, without re-encoding it.
+
+A MessageTemplate holds a complete MAVLink2 frame in a reusable buffer. Setting a field writes it straight into the
+payload, and pack() only patches the sequence number and the CRC. The template quacks like a pymavlink message, so it
+can be passed to SimRunner.send_to_ardusub(): mav.send() calls pack(), and the LogWriter logs the same bytes via
+get_msgbuf().
+
+Unlike pymavlink, trailing zeros are not stripped from the payload, so the frame length never changes. Both forms are
+valid MAVLink2. Signing is not supported.
+"""
+
+import re
+import struct
+
+from pymavlink.dialects.v20 import ardupilotmega as apm2
+
+import mav_frame
+import tlog_index
+
+
+class MessageTemplate:
+    def __init__(self, msg=None, msg_class=None):
+        """
+        Build a template from a pymavlink message, which supplies the message type and the initial field values, or
+        from a message class, with all fields zero.
+        """
+        if msg_class is None:
+            msg_class = type(msg)
+        dtype = tlog_index.payload_dtype(msg_class)
+        payload_len = msg_class.unpacker.size
+
+        self._type = msg_class.msgname
+        self._crc_extra = bytes([msg_class.crc_extra])
+        self._payload_end = mav_frame.HEADER_LEN_V2 + payload_len
+        self._buf = bytearray(self._payload_end + mav_frame.CRC_LEN)
+        self._buf[0] = mav_frame.MAGIC_V2
+        self._buf[1] = payload_len
+        self._buf[7:10] = msg_class.id.to_bytes(3, 'little')
+        self._frame = None
+
+        # {name: (offset in the frame, struct, is array)}
+        self._fields = {}
+        codes = re.findall(r'(\d*)([a-zA-Z])', msg_class.unpacker.format)
+        for name, (count, code) in zip(msg_class.ordered_fieldnames, codes):
+            offset = mav_frame.HEADER_LEN_V2 + dtype.fields[name][1]
+            self._fields[name] = (offset, struct.Struct(f'<{count}{code}'), bool(count) and code != 's')
+            if msg is not None:
+                setattr(self, name, getattr(msg, name))
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+            return
+        offset, packer, is_array = self._fields[name]
+        if is_array:
+            packer.pack_into(self._buf, offset, *value)
+        else:
+            packer.pack_into(self._buf, offset, value)
+
+    def __getattr__(self, name):
+        # Only called for names that aren't regular attributes, i.e., the message fields
+        if name.startswith('_') or name not in self._fields:
+            raise AttributeError(name)
+        offset, packer, is_array = self._fields[name]
+        values = packer.unpack_from(self._buf, offset)
+        return list(values) if is_array else values[0]
+
+    def set_payload(self, payload: bytes):
+        """
+        Replace all fields at once, e.g., with a row from tlog_columns. payload is in the payload_dtype() layout.
+        """
+        self._buf[mav_frame.HEADER_LEN_V2:self._payload_end] = payload
+
+    def get_type(self) -> str:
+        return self._type
+
+    def pack(self, mav: apm2.MAVLink, force_mavlink1: bool = False) -> bytes:
+        """
+        Patch the header and CRC and return the frame, see MAVLink.send().
+        """
+        buf = self._buf
+        buf[4] = mav.seq
+        buf[5] = mav.srcSystem
+        buf[6] = mav.srcComponent
+        crc = mav_frame.frame_crc(buf, 0, self._payload_end, self._crc_extra)
+        buf[self._payload_end] = crc & 0xFF
+        buf[self._payload_end + 1] = crc >> 8
+
+        # The LogWriter holds on to the frame until its thread writes it, so hand out a snapshot
+        self._frame = bytes(buf)
+        return self._frame
+
+    def get_msgbuf(self) -> bytes | None:
+        """
+        The frame returned by the last pack(), for the LogWriter.
+        """
+        return self._frame
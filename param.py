@@ -87,3 +87,32 @@ def parse_params(path) -> list[Param]:
             if param is not None:
                 result.append(param)
     return result
+
+
+def apply_overrides(params: list[Param], overrides: dict[str, float]) -> list[Param]:
+    """
+    Return a copy of params with some values replaced. New params are added as MAV_PARAM_TYPE_REAL32.
+    """
+    result = []
+    remaining = dict(overrides)
+    for p in params:
+        name = p.id.decode('ascii')
+        if name in remaining:
+            result.append(p._replace(value=float(remaining.pop(name))))
+        else:
+            result.append(p)
+    for name, value in remaining.items():
+        result.append(Param(bytes(name, 'ascii'), float(value), apm2.MAV_PARAM_TYPE_REAL32))
+    return result
+
+
+def write_params(path, params: list[Param], comment: str | None = None):
+    """
+    Write params in the same format that parse_params() reads.
+    """
+    with open(path, 'w') as file:
+        if comment:
+            file.write(f'# {comment}\n')
+        for p in params:
+            value = f'{p.value :g}' if p.type != apm2.MAV_PARAM_TYPE_REAL32 else repr(p.value)
+            file.write(f'1\t1\t{p.id.decode("ascii")}\t{value}\t{p.type}\n')
@@ -0,0 +1,144 @@
+"""
+Upload parameters to ArduSub and confirm every value.
+
+1. Fetch all current values once with PARAM_REQUEST_LIST, re-requesting any that were missed by index.
+2. Send PARAM_SET only for params that differ, keeping up to WINDOW sets in flight.
+3. A set is confirmed when ArduSub replies with a matching PARAM_VALUE. Sets that time out or come back with a
+   different value are re-sent up to RETRIES times, then reported as failed.
+"""
+
+import time
+
+import numpy as np
+from pymavlink.dialects.v20 import ardupilotmega as apm2
+
+import param
+
+
+def same_value(a: float, b: float) -> bool:
+    """
+    PARAM_VALUE carries a float32, so compare at float32 precision.
+    """
+    return np.float32(a) == np.float32(b)
+
+
+class InFlight:
+    def __init__(self, p: param.Param):
+        self.param = p
+        self.sent = 0.0
+        self.tries = 0
+
+
+class ParamUploader:
+    WINDOW = 8  # PARAM_SETs in flight
+    TIMEOUT = 1.0  # s wall time before a PARAM_SET or a fetch is retried
+    RETRIES = 5
+
+    def __init__(self, runner):
+        self.runner = runner
+        self.values: dict[str, float] = {}
+        self.types: dict[str, int] = {}
+        self.fetched: dict[str, float] = {}  # Values before the upload
+        self.param_count = None
+        self.indexes = set()
+        self.last_value = time.time()
+        self.in_flight: dict[str, InFlight] = {}
+        self.confirmed: list[str] = []
+        self.failed: list[str] = []
+
+    # Listener interface, see SimRunner.add_listener()
+
+    recv_types = ['PARAM_VALUE']
+
+    def on_send(self, msg, wall: float):
+        pass
+
+    def on_recv(self, msg, wall: float):
+        if msg.get_type() != 'PARAM_VALUE':
+            return
+
+        self.last_value = wall
+        self.values[msg.param_id] = msg.param_value
+        self.types[msg.param_id] = msg.param_type
+        self.param_count = msg.param_count
+        if msg.param_index < msg.param_count:
+            self.indexes.add(msg.param_index)
+
+        pending = self.in_flight.get(msg.param_id)
+        if pending is not None:
+            if same_value(msg.param_value, pending.param.value):
+                del self.in_flight[msg.param_id]
+                self.confirmed.append(msg.param_id)
+            else:
+                # Rejected or clamped, send it again
+                pending.sent = 0.0
+
+    def report(self) -> list[str]:
+        return []
+
+    def fetch(self):
+        """
+        Fetch all params. Missing indexes are requested one at a time after the list stops arriving.
+        """
+        self.runner.send_to_ardusub(apm2.MAVLink_param_request_list_message(1, 1))
+        tries = 0
+        while self.param_count is None or len(self.indexes) < self.param_count:
+            self.runner.wait_for_messages(0.1)
+            if time.time() - self.last_value > ParamUploader.TIMEOUT:
+                tries += 1
+                if tries > ParamUploader.RETRIES:
+                    self.runner.print(f'fetched {len(self.indexes)} of {self.param_count} params, giving up')
+                    return
+                if self.param_count is None:
+                    self.runner.send_to_ardusub(apm2.MAVLink_param_request_list_message(1, 1))
+                else:
+                    for index in sorted(set(range(self.param_count)) - self.indexes):
+                        self.runner.send_to_ardusub(apm2.MAVLink_param_request_read_message(1, 1, b'', index))
+                self.last_value = time.time()
+
+    def upload(self, params: list[param.Param]) -> bool:
+        """
+        Set params, return True if every value was confirmed.
+        """
+        self.runner.add_listener(self)
+        self.runner.print_params = False
+        start = time.time()
+        try:
+            self.fetch()
+            self.fetched = dict(self.values)
+            self.runner.print(f'fetched {len(self.values)} params in {time.time() - start :.2f}s')
+
+            todo = [p for p in params
+                    if p.id.decode('ascii') not in self.values or
+                    not same_value(self.values[p.id.decode('ascii')], p.value)]
+            self.runner.print(f'{len(params) - len(todo)} params already set, {len(todo)} to set')
+            todo.reverse()
+
+            while todo or self.in_flight:
+                # Fill the window
+                while todo and len(self.in_flight) < ParamUploader.WINDOW:
+                    p = todo.pop()
+                    self.in_flight[p.id.decode('ascii')] = InFlight(p)
+
+                # Send new sets and retry timed-out or rejected ones
+                now = time.time()
+                for name, pending in list(self.in_flight.items()):
+                    if now - pending.sent > ParamUploader.TIMEOUT:
+                        if pending.tries > ParamUploader.RETRIES:
+                            del self.in_flight[name]
+                            self.failed.append(name)
+                            self.runner.print(f'failed to set {name} = {pending.param.value}, '
+                                              f'ArduSub has {self.values.get(name)}')
+                            continue
+                        pending.tries += 1
+                        pending.sent = now
+                        self.runner.send_to_ardusub(pending.param.get_set_param_msg())
+
+                self.runner.wait_for_messages(0.05)
+        finally:
+            self.runner.listeners.remove(self)
+            self.runner.print_params = True
+
+        self.runner.print(f'confirmed {len(self.confirmed)} params, {len(self.failed)} failed, '
+                          f'{time.time() - start :.2f}s')
+        return not self.failed
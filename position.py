@@ -14,14 +14,153 @@ class LLI(NamedTuple):
     lon: int
 
 
+def wrap_angle(a: np.ndarray) -> np.ndarray:
+    """
+    Wrap angles to [-pi, pi).
+    """
+    return (a + np.pi) % (2.0 * np.pi) - np.pi
+
+
+class Trajectory:
+    """
+    A closed path in the NED world frame, traversed at a constant velocity. Subclasses implement sample().
+    """
+    period = 0.0
+
+    def sample(self, t: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return x (north), y (east) and yaw at times t.
+        """
+        raise NotImplementedError
+
+
+class Circle(Trajectory):
+    """
+    Move in a circle clockwise at a constant velocity. Start at (r, 0) pointing east.
+    """
+
+    def __init__(self, radius: float = 10.0, velocity: float = 0.5):
+        self.radius = radius
+        self.theta_v = velocity / radius  # r/s
+        self.period = 2.0 * math.pi * radius / velocity
+
+    def sample(self, t: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        theta = self.theta_v * (t % self.period)
+        yaw = wrap_angle(theta + math.pi / 2.0)  # Facing the direction of motion
+        return np.cos(theta) * self.radius, np.sin(theta) * self.radius, yaw
+
+
+class Polyline(Trajectory):
+    """
+    Follow a closed polyline at a constant velocity, facing the direction of motion. Raises ValueError if the points
+    don't make a path.
+    """
+
+    def __init__(self, points: np.ndarray, velocity: float = 0.5):
+        points = np.asarray(points, dtype=np.float64)
+        if not np.array_equal(points[0], points[-1]):
+            points = np.vstack([points, points[:1]])
+        segments = np.diff(points, axis=0)
+        lengths = np.hypot(segments[:, 0], segments[:, 1])
+        keep = lengths > 0.0
+        if not keep.any():
+            raise ValueError('trajectory needs at least two distinct points')
+        self.points = np.vstack([points[:1], points[1:][keep]])
+        self.segment_yaw = np.arctan2(segments[keep, 1], segments[keep, 0])
+        self.s = np.concatenate([[0.0], np.cumsum(lengths[keep])])
+        self.velocity = velocity
+        self.period = self.s[-1] / velocity
+
+    def sample(self, t: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        s = (t % self.period) * self.velocity
+        x = np.interp(s, self.s, self.points[:, 0])
+        y = np.interp(s, self.s, self.points[:, 1])
+        segment = np.clip(np.searchsorted(self.s, s, side='right') - 1, 0, len(self.segment_yaw) - 1)
+        return x, y, self.segment_yaw[segment]
+
+
+class Lawnmower(Polyline):
+    """
+    Survey pattern: legs running north and south, stepping east between legs, then return to the start.
+    """
+
+    def __init__(self, leg: float = 20.0, spacing: float = 4.0, legs: int = 4, velocity: float = 0.5):
+        points = []
+        for i in range(legs):
+            north = [0.0, leg] if i % 2 == 0 else [leg, 0.0]
+            points.append([north[0], i * spacing])
+            points.append([north[1], i * spacing])
+        super().__init__(np.array(points), velocity)
+
+
+class Waypoints(Polyline):
+    """
+    Closed Catmull-Rom spline through waypoints loaded from a file.
+    The file has one "north east" pair (meters) per line; lines starting with # are ignored.
+    """
+
+    SAMPLES_PER_SEGMENT = 20
+
+    def __init__(self, path: str, velocity: float = 0.5):
+        p = np.loadtxt(path, comments='#', ndmin=2)[:, :2]
+        u = np.linspace(0.0, 1.0, Waypoints.SAMPLES_PER_SEGMENT, endpoint=False)[:, None, None]
+        p0, p1, p2, p3 = np.roll(p, 1, axis=0), p, np.roll(p, -1, axis=0), np.roll(p, -2, axis=0)
+        spline = 0.5 * (2.0 * p1 + (p2 - p0) * u + (2.0 * p0 - 5.0 * p1 + 4.0 * p2 - p3) * u ** 2 +
+                        (3.0 * p1 - p0 - 3.0 * p2 + p3) * u ** 3)
+        # spline is (sample, segment, xy), walk segment by segment
+        super().__init__(spline.transpose(1, 0, 2).reshape(-1, 2), velocity)
+
+
+def make_trajectory(name: str) -> Trajectory:
+    """
+    Build a trajectory from a name: circle, lawnmower, or the path of a waypoint file. Raises ValueError if the file
+    doesn't make a path, or OSError if it can't be read.
+    """
+    if name == 'circle':
+        return Circle()
+    elif name == 'lawnmower':
+        return Lawnmower()
+    else:
+        return Waypoints(name)
+
+
+class Track(NamedTuple):
+    """
+    Precomputed ground truth and sensor data for each tick of a run.
+    """
+    t: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+    yaw: np.ndarray
+    phase: np.ndarray  # Fraction of the trajectory period, [0, 1)
+    angle_delta: np.ndarray  # (n, 3), change since the previous tick
+    position_delta: np.ndarray  # (n, 3), change since the previous tick
+    gps_noise: np.ndarray  # (n, 2)
+
+
+def precompute_track(trajectory: Trajectory, dt: float, start: int, steps: int, gps_noise: float,
+                     rng: np.random.Generator) -> Track:
+    """
+    Compute ticks start .. start + steps - 1. Tick 0 has zero deltas.
+    """
+    t = (np.arange(start - 1, start + steps) * dt).clip(min=0.0)
+    x, y, yaw = trajectory.sample(t)
+
+    angle_delta = np.zeros((steps, 3))
+    angle_delta[:, 2] = wrap_angle(np.diff(yaw))
+    position_delta = np.zeros((steps, 3))
+    position_delta[:, 0] = np.diff(x)
+    position_delta[:, 1] = np.diff(y)
+
+    return Track(t[1:], x[1:], y[1:], yaw[1:], (t[1:] % trajectory.period) / trajectory.period,
+                 angle_delta, position_delta, rng.normal(0.0, gps_noise, (steps, 2)))
+
+
 class Position:
     """
-    NED world frame. Moves in a circle clockwise at a constant velocity. Start at (r, 0) pointing east.
+    NED world frame. Step through a precomputed track, one tick per update().
+    The track is extended in chunks if the run goes longer than expected.
     """
-    RADIUS = 10.0
-    VELOCITY = 0.5  # m/s
-    PERIOD = 2.0 * math.pi * RADIUS / VELOCITY
-    THETA_V = VELOCITY / RADIUS  # r/s
     ORIGIN = LL(47.607886, -122.344324)
     GPS_NOISE = 1.0  # m
 
@@ -33,50 +172,94 @@ class Position:
     def origin_int() -> LLI:
         return Position.gps_int(Position.ORIGIN)
 
-    def __init__(self):
-        self.t = 0.0
-        self.theta = 0.0
-        self.x = math.cos(self.theta) * Position.RADIUS
-        self.y = math.sin(self.theta) * Position.RADIUS
-        self.yaw = self.theta + math.pi / 2.0  # Facing the direction of motion (east)
-        self.angle_delta = [0.0, 0.0, 0.0]
-        self.position_delta = [0.0, 0.0, 0.0]
+    @staticmethod
+    def xy_gps(x: float, y: float) -> LLI:
+        """
+        Convert a position in the world frame to degE7.
+        """
+        # Approximate
+        dlat = x * 180.0 / math.pi / 6371000.0
+        dlon = y / 74900.0
 
-    def update(self, dt: float):
-        new_t = self.t + dt
+        return Position.gps_int(LL(Position.ORIGIN.lat + dlat, Position.ORIGIN.lon + dlon))
 
-        # Wrap around
-        if new_t > Position.PERIOD:
-            new_t -= Position.PERIOD
+    def __init__(self, trajectory: Trajectory | None = None, dt: float = 0.2, duration: float = 60.0,
+                 seed: int | None = None):
+        self.trajectory = trajectory if trajectory is not None else Circle()
+        self.dt = dt
+        self.rng = np.random.default_rng(seed)
+        self.chunk = int(math.ceil(duration / dt)) + 1
+        self.track = precompute_track(self.trajectory, dt, 0, self.chunk, Position.GPS_NOISE, self.rng)
+        self.i = 0
 
-        new_theta = Position.THETA_V * new_t
+    def extend(self):
+        more = precompute_track(self.trajectory, self.dt, len(self.track.t), self.chunk, Position.GPS_NOISE, self.rng)
+        self.track = Track(*(np.concatenate([a, b]) for a, b in zip(self.track, more)))
 
-        new_x = math.cos(new_theta) * Position.RADIUS
-        new_y = math.sin(new_theta) * Position.RADIUS
+    def update(self):
+        self.seek(self.i + 1)
 
-        new_yaw = new_theta + math.pi / 2.0  # Facing the direction of motion
-        if new_yaw > math.pi * 2.0:
-            new_yaw -= math.pi * 2.0
+    def seek(self, i: int):
+        """
+        Move to tick i, extending the track if needed.
+        """
+        while i >= len(self.track.t):
+            self.extend()
+        self.i = i
 
-        self.angle_delta = [0.0, 0.0, new_yaw - self.yaw]
-        self.position_delta = [new_x - self.x, new_y - self.y, 0.0]
+    def index(self, t: float) -> int:
+        """
+        Return the tick nearest to time t.
+        """
+        return int(round(t / self.dt))
 
-        self.t = new_t
-        self.theta = new_theta
-        self.x = new_x
-        self.y = new_y
-        self.yaw = new_yaw
+    def deltas_since(self, i0: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Return (angle_delta, position_delta) from tick i0 to the current tick.
+        """
+        if i0 == self.i - 1:
+            return self.angle_delta, self.position_delta
+        track = self.track
+        return (np.array([0.0, 0.0, wrap_angle(track.yaw[self.i] - track.yaw[i0])]),
+                np.array([track.x[self.i] - track.x[i0], track.y[self.i] - track.y[i0], 0.0]))
 
-    def noisy_xy(self) -> tuple[float, float]:
-        return self.x + np.random.normal(0, Position.GPS_NOISE), self.y + np.random.normal(0, Position.GPS_NOISE)
+    @property
+    def t(self) -> float:
+        return self.track.t[self.i]
 
-    def noisy_gps(self) -> tuple[float, float]:
-        nx, ny = self.noisy_xy()
+    @property
+    def x(self) -> float:
+        return self.track.x[self.i]
 
-        # Approximate
-        dlat = nx * 180.0 / math.pi / 6371000.0
-        dlon = ny / 74900.0
+    @property
+    def y(self) -> float:
+        return self.track.y[self.i]
 
-        return Position.gps_int(LL(Position.ORIGIN.lat + dlat, Position.ORIGIN.lon + dlon))
+    @property
+    def yaw(self) -> float:
+        return self.track.yaw[self.i]
+
+    @property
+    def phase(self) -> float:
+        return self.track.phase[self.i]
+
+    @property
+    def angle_delta(self) -> np.ndarray:
+        return self.track.angle_delta[self.i]
+
+    @property
+    def position_delta(self) -> np.ndarray:
+        return self.track.position_delta[self.i]
+
+    def noisy_xy(self) -> tuple[float, float]:
+        nx, ny = self.track.gps_noise[self.i]
+        return self.x + nx, self.y + ny
 
+    def noisy_gps(self) -> LLI:
+        return Position.xy_gps(*self.noisy_xy())
 
+    def true_gps(self) -> LLI:
+        """
+        The ground truth in degE7, converted the same way as noisy_gps().
+        """
+        return Position.xy_gps(self.x, self.y)
@@ -0,0 +1,103 @@
+"""
+Find out where the time goes in a run.
+
+Profiler splits wall time into phases. The code calls enter(phase) when it starts something and exit() when it is done,
+and the time in between is charged to that phase only. A phase entered inside another one, e.g., logging a frame while
+receiving, is taken out of the outer phase, so the phases add up to the wall time. Time outside every phase is 'other':
+sensor and replay code, the scheduler, Python overhead.
+
+Phases charged by SimRunner and its subclasses:
+    send        pack a message and write it to the ArduSub socket
+    recv        read from the ArduSub socket and split it into frames
+    decode      decode the frames that SimRunner or a listener needs, and react to them
+    log         hand frames to the LogWriter
+    listeners   listener callbacks
+    route       forward frames to and from ground stations, see mav_router.py
+    wait        blocked in select() waiting for ArduSub or a deadline
+    task <name> a scheduler task, see scheduler.py
+
+Samples are values with a count, mean and max, e.g., how long a wait overshot its deadline.
+
+enter() and exit() cost two perf_counter() calls, and the runner skips them entirely if profiling is off.
+
+Use --profile on sim_sensors.py or sim_replay.py to print the breakdown at the end of the run. Use --cprofile <path> to
+also run under cProfile, write the stats to path (open them with snakeviz or pstats), and print the top functions.
+"""
+
+import collections
+import cProfile
+import io
+import pstats
+import time
+
+
+class Sample:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+
+class Profiler:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.since = self.start
+        self.phase = 'other'
+        self.stack = []
+        self.totals = collections.defaultdict(float)
+        self.counts = collections.Counter()
+        self.samples: dict[str, Sample] = collections.defaultdict(Sample)
+
+    def enter(self, phase: str):
+        now = time.perf_counter()
+        self.totals[self.phase] += now - self.since
+        self.since = now
+        self.stack.append(self.phase)
+        self.phase = phase
+        self.counts[phase] += 1
+
+    def exit(self):
+        now = time.perf_counter()
+        self.totals[self.phase] += now - self.since
+        self.since = now
+        self.phase = self.stack.pop()
+
+    def sample(self, name: str, value: float):
+        self.samples[name].add(value)
+
+    def report(self) -> list[str]:
+        now = time.perf_counter()
+        totals = dict(self.totals)
+        totals[self.phase] = totals.get(self.phase, 0.0) + now - self.since
+        elapsed = now - self.start
+
+        lines = [f'profile: {elapsed :.2f}s wall time']
+        for phase, total in sorted(totals.items(), key=lambda item: -item[1]):
+            count = self.counts[phase]
+            mean = f'{total / count * 1e6 :8.1f}us each' if count else ''
+            lines.append(f'  {phase :<20} {total :8.3f}s {total / elapsed * 100 if elapsed else 0.0 :5.1f}% '
+                         f'{count :8d} {mean}')
+        for name, sample in sorted(self.samples.items()):
+            lines.append(f'  {name}: {sample.count} samples, mean {sample.total / sample.count * 1e3 :.2f}ms '
+                         f'max {sample.max * 1e3 :.2f}ms')
+        return lines
+
+
+def run_cprofile(path: str, func, top: int = 25) -> list[str]:
+    """
+    Call func() under cProfile, write the stats to path, and return the top functions by cumulative time.
+    """
+    profile = cProfile.Profile()
+    try:
+        profile.runcall(func)
+    finally:
+        profile.dump_stats(path)
+    out = io.StringIO()
+    pstats.Stats(profile, stream=out).sort_stats('cumulative').print_stats(top)
+    return [f'cprofile: stats written to {path}'] + out.getvalue().rstrip().splitlines()
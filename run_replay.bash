@@ -1,6 +1,6 @@
 #!/bin/bash
 
-# Run sim_replay and use ardusub_log_tools to process the files
+# Run sim_replay and summarize the results
 
 # Usage:
 # run_replay.bash <params> <run_name> <speedup> <tlog_to_replay>
@@ -21,9 +21,8 @@ echo "############################"
 echo ">>> PROCESSING LOG FILES <<<"
 echo "############################"
 
-# Using pymavlink tools
-mavlogdump.py --types GPS_INPUT --format csv /tmp/${RUN_NAME}.tlog > /tmp/${RUN_NAME}_GPS_INPUT.csv
-mavlogdump.py --types GLOBAL_POSITION_INT --format csv /tmp/${RUN_NAME}.tlog > /tmp/${RUN_NAME}_GLOBAL_POSITION_INT.csv
+# Summarize the EKF error
+python analysis.py /tmp/${RUN_NAME}.tlog
 
 # Using https://github.com/clydemcqueen/ardusub_log_tools
 # show_types.py /tmp/${RUN_NAME}.tlog
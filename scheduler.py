@@ -0,0 +1,127 @@
+"""
+Run simulated sensors at their own rates on absolute deadlines.
+
+Tick k of a task is due at start + k * period (sim time), where start is when run() was called, plus an optional random
+delay that models delivery jitter. Because deadlines are absolute, time spent sending and receiving does not accumulate
+as drift. If a task falls more than a period behind it skips ahead to the current tick; the skipped ticks are counted so
+the report shows what was lost.
+"""
+
+import heapq
+import math
+from typing import Callable
+
+import numpy as np
+
+
+class Task:
+    def __init__(self, name: str, rate: float, callback: Callable[[int], None], jitter: float,
+                 rng: np.random.Generator):
+        self.name = name
+        self.phase = f'task {name}'
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.callback = callback
+        self.jitter = jitter
+        self.rng = rng
+
+        self.tick = 0
+        self.start = 0.0
+        self.deadline = 0.0
+        self.schedule(0)
+
+        # Stats
+        self.runs = 0
+        self.misses = 0
+        self.skipped = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+
+    def schedule(self, tick: int):
+        """
+        Set the deadline for a tick. Jitter is a one-sided Gaussian delay, clipped to half a period.
+        """
+        self.tick = tick
+        self.deadline = self.start + tick * self.period
+        if self.jitter > 0.0:
+            self.deadline += min(abs(self.rng.normal(0.0, self.jitter)), self.period / 2.0)
+
+    def report(self, elapsed: float) -> str:
+        achieved = self.runs / elapsed if elapsed > 0.0 else 0.0
+        mean_lateness = self.total_lateness / self.runs if self.runs else 0.0
+        return (f'{self.name}: {self.runs} runs, {achieved :.2f}Hz of {self.rate :.2f}Hz, '
+                f'{self.misses} misses, {self.skipped} skipped, '
+                f'lateness mean {mean_lateness * 1e3 :.1f}ms max {self.max_lateness * 1e3 :.1f}ms')
+
+
+class Scheduler:
+    """
+    clock() returns sim time in seconds, and wait(t) returns when clock() >= t.
+    Callbacks are passed the tick number, so a sensor knows which sample it is sending even if ticks were skipped.
+    If a profiler is given, the time in each callback is charged to 'task <name>', see profiler.py.
+    """
+
+    def __init__(self, clock: Callable[[], float], wait: Callable[[float], None], seed: int | None = None,
+                 profiler=None):
+        self.clock = clock
+        self.wait = wait
+        self.profiler = profiler
+        self.rng = np.random.default_rng(seed)
+        self.tasks: list[Task] = []
+        self.elapsed = 0.0
+
+    def add(self, name: str, rate: float, callback: Callable[[int], None], jitter: float = 0.0) -> Task:
+        """
+        Add a task that runs at rate Hz. jitter is the standard deviation of the delivery delay in seconds.
+        """
+        task = Task(name, rate, callback, jitter, self.rng)
+        self.tasks.append(task)
+        return task
+
+    def run(self, duration: float, until: Callable[[], bool] | None = None):
+        """
+        Run all tasks for duration seconds of sim time. Time spent before run() (connecting, setting params) doesn't
+        count against the deadlines. If until() returns True the run ends before the next tick.
+        """
+        start = self.clock()
+        for task in self.tasks:
+            task.start = start
+            task.schedule(task.tick)
+        queue = [(task.deadline, i, task) for i, task in enumerate(self.tasks)]
+        heapq.heapify(queue)
+
+        while queue and queue[0][0] < start + duration:
+            deadline, i, task = heapq.heappop(queue)
+            self.wait(deadline)
+            if until is not None and until():
+                break
+
+            now = self.clock()
+            lateness = max(0.0, now - deadline)
+            task.runs += 1
+            task.total_lateness += lateness
+            task.max_lateness = max(task.max_lateness, lateness)
+            if lateness >= task.period:
+                task.misses += 1
+
+            if self.profiler:
+                self.profiler.enter(task.phase)
+                task.callback(task.tick)
+                self.profiler.exit()
+            else:
+                task.callback(task.tick)
+
+            # Skip ahead if we're more than a period behind
+            next_tick = task.tick + 1
+            current_tick = int(math.floor((self.clock() - start) / task.period))
+            if current_tick > next_tick:
+                task.skipped += current_tick - next_tick
+                next_tick = current_tick
+
+            task.schedule(next_tick)
+            heapq.heappush(queue, (task.deadline, i, task))
+
+        self.elapsed = self.clock() - start
+
+    def report(self) -> list[str]:
+        return [task.report(self.elapsed) for task in self.tasks]
@@ -1,67 +1,118 @@
 #!/usr/bin/env python3
 
 """
-Replay VISION_POSITION_DELTA and GPS_INPUT sensor messages.
+Replay VISION_POSITION_DELTA and GPS_INPUT sensor messages. The ground truth in a tlog from sim_sensors.py is copied
+to the new log, but not sent, so analysis.py measures the replay against it too.
+
+Messages are sent on the sim clock, spaced as they were in the source tlog. Normally the sim clock is wall time scaled
+by --speedup. With --lockstep the sim clock is ArduSub's clock, so the replay keeps time with SITL however fast it
+runs, and SIM_SPEEDUP can be as high as the CPU allows.
+
+The timestamps in a tlog recorded at --speedup N are compressed N times, unless it was recorded with
+--sim-timestamps (sim_sensors.py, sim_replay.py, matrix.py). Such a tlog can't be replayed faithfully: the message
+spacing is scaled by --speedup like any other, so it plays N times too fast in sim time whatever --speedup is. Record
+it again with --sim-timestamps, or rescale the timestamps first. Tlogs from real dives and tlogs with sim time
+timestamps can be replayed at any speed.
 
 Caveat: I've tested speedup as high as 10.0. I am seeing odd / missing messages from mavproxy when speedup > 1.0, but
-results are still interesting.
+results are still interesting. To watch a replay in QGC without mavproxy in the path, use --route, see mav_router.py.
 """
 
 import argparse
-import os
 import time
 
-# Use MAVLink2 wire protocol, must include this before importing pymavlink.mavutil
-os.environ['MAVLINK20'] = '1'
-
-# Late import
-from pymavlink import mavutil
+import numpy as np
 
+import analysis
+import cache
+import latency
+import live_analysis
+import mav_router
+import msg_template
+import profiler
 import sim_runner
+import stop_conditions
+import tlog_columns
+import tlog_index
 
-# TODO the delay between GPS_RAW_INT and GLOBAL_POSITION_INT is large... what is going on?
-# TODO is it possible to run simulation using the timestamps from the tlog file we're reading?
+# TODO the delay between GPS_RAW_INT and GLOBAL_POSITION_INT is large... what is going on? Measure it with --latency
 
 
 class SimReplay(sim_runner.SimRunner):
-    REPLAY_MSGS = ['VISION_POSITION_DELTA', 'GPS_INPUT']
-
-    def __init__(self, replay_path: str, params_path: str | None, log_path: str | None, speedup: float):
-        super().__init__(params_path, log_path, speedup)
-        self.replay_tlog = mavutil.mavlink_connection(replay_path)
+    REPLAY_MSGS = ['VISION_POSITION_DELTA', 'GPS_INPUT', analysis.TRUTH_MSG]
+
+    def __init__(self, replay_path: str, params_path: str | None, log_path: str | None, speedup: float,
+                 instance: int = 0, cwd: str | None = None, start: float | None = None, end: float | None = None,
+                 ardusub: sim_runner.ArduSubInstance | None = None, dataflash: bool = False, lockstep: bool = False,
+                 sim_timestamps: bool = False, profile: bool = False, routes: list[str] | None = None):
+        super().__init__(params_path, log_path, speedup, instance, cwd, lockstep, ardusub, dataflash=dataflash,
+                         sim_timestamps=sim_timestamps, profile=profile, routes=routes)
+        self.replay_tlog = tlog_columns.TlogColumns(replay_path)
+        self.replay_start = start
+        self.replay_end = end
+        if start is not None or end is not None:
+            self.print(f'replay from {start or 0.0 :.2f}s to {"the end" if end is None else f"{end :.2f}s"}')
+
+    def replay_msgs(self):
+        """
+        Yield (timestamp, message) in tlog order. Each message is a template that is refilled with the next payload,
+        so it is only valid until the next one is yielded.
+        """
+        templates = []
+        rows = []
+        usec = []
+        pos = []
+        for msg_type in SimReplay.REPLAY_MSGS:
+            type_rows, type_usec, type_pos = self.replay_tlog.select(msg_type, self.replay_start, self.replay_end)
+            templates.append(msg_template.MessageTemplate(msg_class=tlog_index.msg_class(msg_type)))
+            rows.append(type_rows)
+            usec.append(type_usec)
+            pos.append(type_pos)
+
+        # Merge the types back into file order
+        which = np.concatenate([np.full(len(p), i) for i, p in enumerate(pos)]).astype(np.int64)
+        row = np.concatenate([np.arange(len(p)) for p in pos]).astype(np.int64)
+        order = np.argsort(np.concatenate(pos), kind='stable')
+        for i, j in zip(which[order].tolist(), row[order].tolist()):
+            templates[i].set_payload(rows[i][j].tobytes())
+            yield usec[i][j] * 1e-6, templates[i]
 
     def run(self) -> None:
         self.print('replay started')
-        now_msg1 = None
+        sim_msg1 = None
         timestamp_msg1 = None
         msg_types = []
         msg_count = 0
 
-        while (msg := self.replay_tlog.recv_match(blocking=False, type=SimReplay.REPLAY_MSGS)) is not None:
+        for timestamp_msg, msg in self.replay_msgs():
             self.recv_messages_from_ardusub()
 
-            timestamp_msg = getattr(msg, '_timestamp', 0.0)
-            now = time.time()
-
-            if now_msg1 is None:
-                # Track the current time and the timestamp for msg1
-                now_msg1 = now
+            if sim_msg1 is None:
+                # Track the sim time and the timestamp for msg1
+                sim_msg1 = self.sim_time()
                 timestamp_msg1 = timestamp_msg
-                self.print(f'delta is {now_msg1 - timestamp_msg1 :.2f} seconds')
+                self.print(f'delta is {time.time() - timestamp_msg1 :.2f} seconds')
             else:
-                # Calc how long we'll need to wait to send this message
-                d_wait = (timestamp_msg - timestamp_msg1) / self.speedup - (now - now_msg1)
-                if d_wait > 0.0:
-                    time.sleep(d_wait)
-
-            self.send_to_ardusub(msg)
-            msg_count += 1
+                # Receive from ArduSub while we wait
+                self.wait_sim_time(sim_msg1 + timestamp_msg - timestamp_msg1)
+                if self.profiler:
+                    self.profiler.sample('replay lateness (sim time)',
+                                         self.sim_time() - (sim_msg1 + timestamp_msg - timestamp_msg1))
+                if self.stop_reason is not None:
+                    break
 
             msg_type = msg.get_type()
             if msg_type not in msg_types:
                 self.print(f'replay first {msg_type} message')
                 msg_types.append(msg_type)
 
+            if msg_type == analysis.TRUTH_MSG:
+                self.log_msg(msg)
+                continue
+
+            self.send_to_ardusub(msg)
+            msg_count += 1
+
             if msg_count % 1000 == 0:
                 elapsed_s = timestamp_msg - timestamp_msg1
                 elapsed_m = elapsed_s / 60.0
@@ -69,16 +120,71 @@ class SimReplay(sim_runner.SimRunner):
 
         self.print('simulation stopped')
 
+    def close(self):
+        self.replay_tlog.close()
+        super().close()
+
 
 def main():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
     parser.add_argument('--params', type=str, default=None, help='path of parameter file')
     parser.add_argument('--log', type=str, default=None, help='write a new log')
     parser.add_argument('--speedup', type=float, default=1.0, help='SIM_SPEEDUP value')
+    parser.add_argument('--instance', type=int, default=0, help='ArduSub SITL instance number, sets the port')
+    parser.add_argument('--start', type=float, default=None, help='start replay this many seconds into the tlog')
+    parser.add_argument('--end', type=float, default=None, help='stop replay this many seconds into the tlog')
+    parser.add_argument('--lockstep', action='store_true', help="pace the replay by ArduSub's clock")
+    parser.add_argument('--sim-timestamps', action='store_true', help='stamp the new log with sim time')
+    parser.add_argument('--latency', action='store_true', help='measure sensor to EKF latency')
+    parser.add_argument('--live', type=float, default=None,
+                        help='print the localization error every LIVE seconds of sim time while running')
+    parser.add_argument('--stop', type=str, action='append', default=[],
+                        help='end the run early when this condition holds, see stop_conditions.py')
+    parser.add_argument('--route', type=str, action='append', default=[],
+                        help='forward MAVLink to and from a ground station, e.g., udpout:127.0.0.1:14550, see '
+                             'mav_router.py')
+    parser.add_argument('--profile', action='store_true', help='print where the time went at the end of the run')
+    parser.add_argument('--cprofile', type=str, default=None, help='run under cProfile and write the stats here')
+    parser.add_argument('--dataflash', action='store_true',
+                        help="copy ArduSub's DataFlash log next to the tlog, as <log>.bin (requires --log)")
+    parser.add_argument('--cache', type=str, default=None,
+                        help='result cache directory, e.g., ~/.cache/ardusub_localization (requires --log)')
     parser.add_argument('path')
     args = parser.parse_args()
-    runner = SimReplay(args.path, args.params, args.log, args.speedup)
-    runner.run()
+    try:
+        conditions = stop_conditions.parse_conditions(args.stop)
+        for route in args.route:
+            mav_router.parse_address(route)
+    except ValueError as e:
+        parser.error(str(e))
+
+    def run():
+        runner = SimReplay(args.path, args.params, args.log, args.speedup, args.instance, start=args.start,
+                           end=args.end, dataflash=args.dataflash, lockstep=args.lockstep,
+                           sim_timestamps=args.sim_timestamps, profile=args.profile, routes=args.route)
+        try:
+            if args.latency:
+                runner.add_listener(latency.LatencyTracker(runner.sim_time))
+            if args.live:
+                runner.add_listener(live_analysis.LiveListener(runner, interval=args.live))
+            if conditions:
+                runner.add_listener(stop_conditions.StopMonitor(runner, conditions))
+            if args.cprofile:
+                for line in profiler.run_cprofile(args.cprofile, runner.run):
+                    print(line)
+            else:
+                runner.run()
+        finally:
+            # Write the rest of the tlog even if the run was interrupted
+            runner.close()
+
+    if args.cache:
+        key = cache.replay_key(args.params, args.path, speedup=args.speedup, start=args.start, end=args.end,
+                               lockstep=args.lockstep, sim_timestamps=args.sim_timestamps, stop=args.stop)
+        cache.run_cached(cache.ResultCache(args.cache), key, args.log, run,
+                         lambda path: analysis.analyze(path)._asdict(), args.dataflash)
+    else:
+        run()
 
 
 if __name__ == '__main__':
@@ -2,14 +2,21 @@
 Run an ArduSub simulation.
 """
 
+import glob
 import os
+import select
+import shutil
 import subprocess
 import time
 
 from pymavlink.dialects.v20 import ardupilotmega as apm2
 
+import dataflash
 import position
 import log_writer
+import mav_frame
+import mav_router
+import profiler
 
 # Use MAVLink2 wire protocol, must include this before importing pymavlink.mavutil
 os.environ['MAVLINK20'] = '1'
@@ -18,23 +25,46 @@ os.environ['MAVLINK20'] = '1'
 from pymavlink import mavutil
 
 import param
+import param_upload
 
 
-def run_cmd(cmd):
+# SITL moves every port up by 10 for each instance, see -I in ArduPilot's SITL_cmdline
+ARDUSUB_BASE_PORT = 5760
+ARDUSUB_PORT_STRIDE = 10
+
+
+def ardusub_port(instance: int) -> int:
+    """
+    Return the SERIAL0 TCP port for an ArduSub SITL instance.
+    """
+    return ARDUSUB_BASE_PORT + ARDUSUB_PORT_STRIDE * instance
+
+
+def run_cmd(cmd, cwd: str | None = None) -> subprocess.Popen | None:
+    """
+    Start a process. If cwd is set the process runs there, and stdout/stderr go to a file in cwd.
+    """
     try:
-        p = subprocess.Popen(cmd)
-        return p.pid
+        if cwd:
+            os.makedirs(cwd, exist_ok=True)
+            with open(os.path.join(cwd, 'ardusub.txt'), 'w') as out:
+                return subprocess.Popen(cmd, cwd=cwd, stdout=out, stderr=subprocess.STDOUT)
+        return subprocess.Popen(cmd)
     except Exception as e:
         print(f"SIM RUNNER: exception occurred with command: '{' '.join(cmd)}'")
         print(f'SIM RUNNER: {e}')
-        return 0
+        return None
 
 
 # TODO the origin is off by the radius
-def start_ardusub(speedup: float):
+def start_ardusub(speedup: float, instance: int = 0, cwd: str | None = None) -> subprocess.Popen:
+    """
+    Start ArduSub SITL. Each instance gets its own port set, and if cwd is set, its own eeprom.bin and logs.
+    Raises RuntimeError if it can't be started, e.g., ARDUPILOT_HOME isn't set or ArduSub hasn't been built.
+    """
     ardupilot_home = os.environ.get('ARDUPILOT_HOME')
-    print('SIM RUNNER: starting ArduSub')
-    pid = run_cmd([
+    print(f'SIM RUNNER: starting ArduSub instance {instance}')
+    proc = run_cmd([
         f'{ardupilot_home}/build/sitl/bin/ardusub',
         '-S',
         '-w',
@@ -43,23 +73,143 @@ def start_ardusub(speedup: float):
         '--slave', '0',
         '--defaults', f'{ardupilot_home}/Tools/autotest/default_params/sub.parm',
         '--sim-address=127.0.0.1',
-        '-I0',
+        f'-I{instance}',
         '--home', f'{position.Position.ORIGIN.lat},{position.Position.ORIGIN.lon},-0.1,0.0',
-    ])
+    ], cwd)
+
+    if proc is None:
+        raise RuntimeError(f'ArduSub instance {instance} failed to start, check ARDUPILOT_HOME')
+    return proc
+
+
+def stop_ardusub(proc: subprocess.Popen):
+    """
+    Stop ArduSub SITL, killing it if it doesn't exit promptly.
+    """
+    if proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(timeout=5.0)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
 
-    if pid == 0:
-        print('SIM RUNNER: ArduSub failed to start')
-        exit(1)
-    else:
-        return pid
+
+class ArduSubInstance:
+    """
+    An ArduSub SITL process and the connection to it. A SimRunner normally starts and stops its own instance, but an
+    instance can also be kept running and handed to several SimRunners in turn, see ardusub_pool.py.
+
+    If connect_only is set, no process is started; something else must be listening on the port, e.g., FakeArduSub.
+    """
+
+    # Wall time to wait for ArduSub to come back after a reboot
+    REBOOT_TIMEOUT = 60.0  # s
+
+    def __init__(self, speedup: float, instance: int = 0, cwd: str | None = None, connect_only: bool = False):
+        self.speedup = speedup
+        self.instance = instance
+        self.cwd = cwd
+        self.proc = None if connect_only else start_ardusub(speedup, instance, cwd)
+
+        print(f'SIM RUNNER: connecting to ArduSub instance {instance}...')
+        self.conn = mavutil.mavlink_connection(
+            f'tcp:127.0.0.1:{ardusub_port(instance)}', source_system=255, source_component=0, autoreconnect=True)
+
+        print('SIM RUNNER: connected, waiting for a HEARTBEAT message...')
+        self.conn.wait_heartbeat()
+        print('SIM RUNNER: HEARTBEAT received')
+
+        # Number of runs that have used this instance
+        self.uses = 0
+
+        # Param values from the first fetch, before any run changed them, and the names of params set since then
+        self.baseline: dict[str, param.Param] | None = None
+        self.changed: set[str] = set()
+
+    def alive(self) -> bool:
+        return self.proc is None or self.proc.poll() is None
+
+    def record_params(self, uploader: param_upload.ParamUploader, params: list[param.Param]):
+        """
+        Remember the values ArduSub had before the first upload, and which params have been set since.
+        """
+        if self.baseline is None:
+            self.baseline = {name: param.Param(bytes(name, 'ascii'), value, uploader.types[name])
+                             for name, value in uploader.fetched.items()}
+        self.changed.update(p.id.decode('ascii') for p in params)
+
+    def restore_params(self, params: list[param.Param]) -> list[param.Param]:
+        """
+        Add the baseline value of every param that an earlier run set and this run doesn't, so a reused instance
+        starts from the same params as a fresh one.
+        """
+        if self.baseline is None:
+            return params
+        names = {p.id.decode('ascii') for p in params}
+        return params + [self.baseline[name] for name in sorted(self.changed - names) if name in self.baseline]
+
+    def drain(self):
+        """
+        Discard anything ArduSub sent between runs.
+        """
+        while self.conn.recv_match():
+            pass
+
+    def reboot(self) -> bool:
+        """
+        Reboot ArduSub, which resets the EKF and picks up params that only take effect at boot. SITL re-executes
+        itself without -w, so the params survive. Returns False if ArduSub didn't come back.
+        """
+        print(f'SIM RUNNER: rebooting ArduSub instance {self.instance}')
+        self.conn.mav.send(apm2.MAVLink_command_long_message(
+            1, 1, apm2.MAV_CMD_PREFLIGHT_REBOOT_SHUTDOWN, 0, 1, 0, 0, 0, 0, 0, 0))
+
+        deadline = time.time() + ArduSubInstance.REBOOT_TIMEOUT
+        while time.time() < deadline and self.alive():
+            msg = self.conn.recv_match(type='STATUSTEXT', blocking=True, timeout=1.0)
+            if msg is not None and msg.text == 'ArduPilot Ready':
+                return True
+        print(f'SIM RUNNER: ArduSub instance {self.instance} did not come back after a reboot')
+        return False
+
+    def dataflash_log(self, since: float = 0.0) -> str | None:
+        """
+        Path of the newest DataFlash log that SITL has written to since `since` (wall time), or None. SITL writes its
+        logs to logs/ in its working directory, and starts a new one each time it boots.
+        """
+        logs = glob.glob(os.path.join(self.cwd or os.getcwd(), 'logs', '*.BIN'))
+        logs = [path for path in logs if os.path.getmtime(path) >= since]
+        return max(logs, key=os.path.getmtime) if logs else None
+
+    def close(self):
+        self.conn.close()
+        if self.proc is not None:
+            stop_ardusub(self.proc)
+
+
+def poll(runners: list['SimRunner'], timeout: float):
+    """
+    Wait until any of several runners has data from ArduSub, or the timeout expires, then receive on those runners.
+    This lets one process drive several SITL instances.
+    """
+    # {socket: runner}, including the ground stations attached to each runner
+    owners = {runner: runner for runner in runners}
+    for runner in runners:
+        if runner.router:
+            owners.update((sock, runner) for sock in runner.router.sockets())
+    ready, _, _ = select.select(list(owners), [], [], max(timeout, 0.0))
+    for runner in dict.fromkeys(owners[sock] for sock in ready):
+        runner.recv_messages_from_ardusub()
 
 
 class SimRunner:
     """
-    Manage a simulation. Subclasses should call receive_all_messages() periodically.
+    Manage a simulation. Subclasses should wait with wait_sim_time() or wait_wall_time(), which receive messages from
+    ArduSub as soon as they arrive, or call recv_messages_from_ardusub() periodically.
 
-    Limitation: this class connects directly to ArduSub and does not route MAVLink messages.
-    I.e., you cannot use this class with another ground control station like QGroundControl.
+    Ground control stations like QGroundControl can't connect to ArduSub directly while a SimRunner is connected, pass
+    routes to forward MAVLink to them, see mav_router.py.
     """
 
     REQUEST_MSG_IDS = [
@@ -71,38 +221,73 @@ class SimRunner:
 
     REQUEST_MSG_RATE = 3  # Hz
 
+    # In lockstep mode the clock comes from SYSTEM_TIME.time_boot_ms, so request it often enough to pace sensors
+    LOCKSTEP_CLOCK_RATE = 20  # Hz
+
+    # ArduSub messages with a time_boot_ms field that advance the lockstep clock
+    CLOCK_MSGS = ['SYSTEM_TIME', 'GLOBAL_POSITION_INT', 'LOCAL_POSITION_NED']
+
     GPS_MSGS = ['GPS_RAW_INT', 'GLOBAL_POSITION_INT']
 
+    # Messages that recv_messages_from_ardusub() decodes. Others are logged as raw frames, or dropped, see drop_msgs().
+    # Listeners add the types in their recv_types.
+    DECODE_MSGS = ['HEARTBEAT', 'PARAM_VALUE', 'COMMAND_ACK', 'STATUSTEXT', 'HOME_POSITION', 'GPS_GLOBAL_ORIGIN']
+
+    # Read at most this many bytes per recv_messages_from_ardusub(), so a flood can't starve the sensors
+    RECV_MAX_BYTES = 1 << 20
+
     SPAMMY_PARAMS = ['BARO1_GND_PRESS', 'BARO2_GND_PRESS', 'STAT_RUNTIME', 'STAT_FLTTIME']
 
-    def __init__(self, params_path: str or None, log_path: str or None, speedup: float):
+    def __init__(self, params_path: str or None, log_path: str or None, speedup: float,
+                 instance: int = 0, cwd: str | None = None, lockstep: bool = False,
+                 ardusub: ArduSubInstance | None = None, reboot: bool = True, dataflash: bool = False,
+                 sim_timestamps: bool = False, profile: bool = False, routes: list[str] | None = None):
         # Start the clock
         self.start = time.time()
 
+        # Where the time goes, see profiler.py. Created once the setup is done, so it only covers the run
+        self.profiler = None
+
+        # Copy ArduSub's DataFlash log next to the tlog when the run is done, see close()
+        self.log_path = log_path
+        self.dataflash = dataflash and bool(log_path)
+
+        # In lockstep mode sim_time() follows ArduSub's clock rather than wall time
+        self.lockstep = lockstep
+        self.ardusub_boot_ms = None
+        self.ardusub_boot_ms_start = None
+
         self.speedup = speedup
-        self.print(f'run at {speedup}X wall time')
+        if lockstep:
+            self.print(f'run in lockstep with ArduSub, SIM_SPEEDUP is {speedup}')
+        else:
+            self.print(f'run at {speedup}X wall time')
 
         if log_path:
-            self.print(f'logging to {log_path}')
-            self.log_writer = log_writer.LogWriter(log_path)
+            self.print(f'logging to {log_path}{" with sim time timestamps" if sim_timestamps else ""}')
+            self.log_writer = log_writer.LogWriter(log_path, clock=self.log_time if sim_timestamps else None)
         else:
             self.print('not logging')
             self.log_writer = None
 
-        self.ardusub_pid = start_ardusub(speedup)
-
-        self.print('connecting to ArduSub...')
-        self.ardusub = mavutil.mavlink_connection(
-            'tcp:127.0.0.1:5760', source_system=255, source_component=0, autoreconnect=True)
-
-        self.print('connected, waiting for a HEARTBEAT message...')
-        self.ardusub.wait_heartbeat()
-        self.print('HEARTBEAT received')
-
-        if params_path:
-            self.set_params(param.parse_params(params_path))
+        if ardusub is None:
+            try:
+                self.ardusub_instance = ArduSubInstance(speedup, instance, cwd)
+            except Exception:
+                if self.log_writer:
+                    self.log_writer.close()
+                raise
+            self.owns_ardusub = True
+        else:
+            self.print(f'using ArduSub instance {ardusub.instance}, run {ardusub.uses + 1}')
+            ardusub.drain()
+            self.ardusub_instance = ardusub
+            self.owns_ardusub = False
+        self.instance = self.ardusub_instance.instance
+        self.ardusub = self.ardusub_instance.conn
 
-        self.request_msgs()
+        # Ground stations to forward MAVLink to and from, see route()
+        self.router = mav_router.Router(routes, output=self.print) if routes else None
 
         # True if we've seen the "ArduPilot ready" message
         self.ardusub_ready = False
@@ -110,9 +295,196 @@ class SimRunner:
         # True if the AHRS origin has been set
         self.ardusub_origin = False
 
+        # Print PARAM_VALUE messages as they arrive, turned off during a param upload
+        self.print_params = True
+
+        # Objects with on_send(msg, wall), on_recv(msg, wall) and report(), see add_listener()
+        self.listeners = []
+
+        # Set by request_stop(), e.g., by a stop_conditions.StopMonitor
+        self.stop_reason = None
+        self.stop_time = None
+
+        # Receive filter, see recv_messages_from_ardusub()
+        self.recv_buf = bytearray()
+        self.decode_ids = mav_frame.msg_ids(SimRunner.DECODE_MSGS + (SimRunner.CLOCK_MSGS if lockstep else []))
+        self.decode_all = False
+        self.drop_ids = set()
+        self.gps_ids = mav_frame.msg_ids(SimRunner.GPS_MSGS)
+        self.recv_decoded = 0
+        self.recv_raw = 0
+        self.recv_dropped = 0
+        self.recv_bad = 0
+
+        # Track the time between receive polls, this is the most time a message can sit in the socket buffer
+        self.last_recv = time.time()
+        self.recv_polls = 0
+        self.recv_gap_total = 0.0
+        self.recv_gap_max = 0.0
+
+        params = param.parse_params(params_path) if params_path else []
+        if self.dataflash:
+            # SITL is never armed, so it only writes a DataFlash log if told to log while disarmed
+            params.append(param.Param(b'LOG_DISARMED', 1, apm2.MAV_PARAM_TYPE_INT8))
+        try:
+            # A reused instance may have params from the previous run even if this run sets none
+            if params or self.ardusub_instance.changed:
+                self.set_params(params)
+
+            # A reused instance has the EKF state of the previous run, start over
+            if self.ardusub_instance.uses > 0 and reboot:
+                self.reboot_ardusub()
+        except RuntimeError:
+            # Nothing to keep from a run that never started. If the instance came from a pool the caller discards it
+            self.dataflash = False
+            self.close()
+            raise
+
+        self.request_msgs()
+
+        if lockstep:
+            self.print('waiting for the ArduSub clock...')
+            while self.ardusub_boot_ms is None:
+                self.wait_for_messages(1.0)
+
+        if profile:
+            self.profiler = profiler.Profiler()
+
     def sim_time(self):
+        """
+        Return seconds since the start of the simulation.
+        In lockstep mode this is ArduSub time since the first clock message, otherwise it is scaled wall time.
+        """
+        if self.lockstep:
+            if self.ardusub_boot_ms is None:
+                return 0.0
+            return (self.ardusub_boot_ms - self.ardusub_boot_ms_start) * 1e-3
         return (time.time() - self.start) * self.speedup
 
+    def log_time(self) -> float:
+        """
+        Sim time as seconds since the epoch, the run starts at the wall time it was started.
+        """
+        return self.start + self.sim_time()
+
+    def update_clock(self, time_boot_ms: int):
+        if self.ardusub_boot_ms is None:
+            self.ardusub_boot_ms_start = time_boot_ms
+            self.ardusub_boot_ms = time_boot_ms
+        elif time_boot_ms > self.ardusub_boot_ms:
+            self.ardusub_boot_ms = time_boot_ms
+
+    def add_listener(self, listener):
+        """
+        Add a listener. on_send() and on_recv() are called with every message sent to and received from ArduSub,
+        on_send() also with the messages that are only logged, see log_msg(). The lines returned by report() are
+        printed by close().
+
+        A listener with a recv_types attribute (a list of message names) only needs those messages, and only those
+        are decoded for it. Without recv_types every message is decoded.
+        """
+        self.listeners.append(listener)
+        recv_types = getattr(listener, 'recv_types', None)
+        if recv_types is None:
+            self.decode_all = True
+        else:
+            self.decode_ids |= mav_frame.msg_ids(recv_types)
+
+    def request_stop(self, reason: str):
+        """
+        Ask the run to end early. Subclasses check stop_reason between sensor ticks.
+        """
+        if self.stop_reason is None:
+            self.stop_reason = reason
+            self.stop_time = self.sim_time()
+            self.print(f'stopping early: {reason}')
+
+    def drop_msgs(self, msg_types: list[str]):
+        """
+        Neither decode nor log these messages. Messages that SimRunner itself needs can't be dropped.
+        """
+        self.drop_ids |= mav_frame.msg_ids(msg_types) - mav_frame.msg_ids(SimRunner.DECODE_MSGS)
+
+    def fileno(self) -> int:
+        """
+        The ArduSub socket, for select().
+        """
+        return self.ardusub.port.fileno()
+
+    def wait_for_messages(self, timeout: float):
+        """
+        Block until ArduSub sends something or the wall-time timeout expires, then receive all queued messages.
+        """
+        if self.profiler:
+            self.profiler.enter('wait')
+        select.select([self] + self.router.sockets() if self.router else [self], [], [], max(timeout, 0.0))
+        if self.profiler:
+            self.profiler.exit()
+        self.recv_messages_from_ardusub()
+
+    def wait_wall_time(self, t: float):
+        """
+        Wait until time.time() >= t, receiving messages from ArduSub as they arrive.
+        Always polls at least once, so a loop that is running late still hears from ArduSub.
+        """
+        while True:
+            self.wait_for_messages(t - time.time())
+            if time.time() >= t:
+                break
+        if self.profiler:
+            self.profiler.sample('wait overshoot', time.time() - t)
+
+    def wait_sim_time(self, t: float):
+        """
+        Wait until sim_time() >= t, receiving messages from ArduSub as they arrive.
+        In lockstep mode this waits on ArduSub's clock, so it runs as fast as SITL does.
+        """
+        if self.lockstep:
+            while self.sim_time() < t:
+                self.wait_for_messages(0.1)
+            if self.profiler:
+                self.profiler.sample('wait overshoot (sim time)', self.sim_time() - t)
+        else:
+            self.wait_wall_time(self.start + t / self.speedup)
+
+    def close(self):
+        """
+        Disconnect from ArduSub and stop it, unless the ArduSub instance was handed to us by a pool.
+        """
+        for listener in self.listeners:
+            for line in listener.report():
+                self.print(line)
+        if self.recv_polls:
+            self.print(f'recv: {self.recv_polls} polls, gap between polls mean '
+                       f'{self.recv_gap_total / self.recv_polls * 1e3 :.1f}ms max {self.recv_gap_max * 1e3 :.1f}ms')
+            self.print(f'recv: {self.recv_decoded} decoded, {self.recv_raw} logged raw, {self.recv_dropped} dropped, '
+                       f'{self.recv_bad} bad frames')
+        if self.profiler:
+            for line in self.profiler.report():
+                self.print(line)
+        if self.router:
+            for line in self.router.report():
+                self.print(line)
+            self.router.close()
+        if self.owns_ardusub:
+            self.ardusub_instance.close()
+        if self.log_writer:
+            self.log_writer.close()
+        if self.dataflash:
+            self.copy_dataflash_log()
+
+    def copy_dataflash_log(self):
+        """
+        Copy the DataFlash log of this run next to the tlog, see dataflash.bin_path(). If the instance belongs to a pool
+        it is still running, and the copy has what SITL has flushed so far.
+        """
+        source = self.ardusub_instance.dataflash_log(self.start)
+        if source is None:
+            self.print('no DataFlash log found')
+            return
+        shutil.copyfile(source, dataflash.bin_path(self.log_path))
+        self.print(f'copied DataFlash log {source} to {dataflash.bin_path(self.log_path)}')
+
     def print(self, message):
         print(f'[{self.sim_time() :.2f}] {message}')
 
@@ -124,14 +496,63 @@ class SimRunner:
         Send a message to ArduSub.
         send() will pack the message as a side effect, so call it first.
         """
+        if self.profiler:
+            self.profiler.enter('send')
         self.ardusub.mav.send(msg)
+        if self.profiler:
+            self.profiler.exit()
         if self.log_writer:
+            if self.profiler:
+                self.profiler.enter('log')
             self.log_writer.write(msg)
+            if self.profiler:
+                self.profiler.exit()
+        if self.listeners:
+            if self.profiler:
+                self.profiler.enter('listeners')
+            wall = time.time()
+            for listener in self.listeners:
+                listener.on_send(msg, wall)
+            if self.profiler:
+                self.profiler.exit()
+
+    def log_msg(self, msg):
+        """
+        Log a message and show it to the listeners without sending it to ArduSub, e.g., the ground truth.
+        """
+        if self.log_writer:
+            self.log_writer.write_buf(msg.pack(self.ardusub.mav))
+        if self.listeners:
+            wall = time.time()
+            for listener in self.listeners:
+                listener.on_send(msg, wall)
+
+    def reboot_ardusub(self):
+        """
+        Reboot a reused ArduSub instance, see ArduSubInstance.reboot(). Raises RuntimeError if it didn't come back.
+        """
+        if not self.ardusub_instance.reboot():
+            raise RuntimeError(f'ArduSub instance {self.instance} did not come back after a reboot')
+        self.ardusub_ready = True
+
+        # time_boot_ms starts over, and reboot() read from the connection behind the receive filter's back, so a
+        # partial frame in recv_buf is stale
+        self.ardusub_boot_ms = None
+        self.ardusub_boot_ms_start = None
+        self.recv_buf.clear()
 
     def set_params(self, params: list[param.Param]):
+        """
+        Set params and wait until ArduSub has confirmed every value. Raises RuntimeError if some could not be set, so a
+        run with the wrong params is never analyzed or cached.
+        """
         self.print('setting parameters')
-        for p in params:
-            self.send_to_ardusub(p.get_set_param_msg())
+        params = self.ardusub_instance.restore_params(params)
+        uploader = param_upload.ParamUploader(self)
+        ok = uploader.upload(params)
+        self.ardusub_instance.record_params(uploader, params)
+        if not ok:
+            raise RuntimeError(f'ArduSub did not accept {", ".join(uploader.failed)}')
 
     def request_msg(self, msg_id: int, msg_rate: int):
         self.print(f'request {msg_rate}Hz rate for message id {msg_id}')
@@ -145,6 +566,8 @@ class SimRunner:
         """
         for msg_type in SimRunner.REQUEST_MSG_IDS:
             self.request_msg(msg_type, SimRunner.REQUEST_MSG_RATE)
+        if self.lockstep:
+            self.request_msg(apm2.MAVLINK_MSG_ID_SYSTEM_TIME, SimRunner.LOCKSTEP_CLOCK_RATE)
 
     @staticmethod
     def severity_name(severity: int) -> str:
@@ -161,27 +584,135 @@ class SimRunner:
         """
         Receive all queued messages and log them.
         Normally this is pretty quick, but if QGC starts up we will see a zillion PARAM_VALUE messages.
+
+        Frames are split on the raw header. Only the message types that SimRunner or a listener reacts to are decoded,
+        the others are logged as raw bytes, or dropped (see drop_msgs()), without parsing the payload. Every frame with
+        a good CRC is forwarded to the ground stations, if any, see route().
+        """
+        now = time.time()
+        gap = now - self.last_recv
+        self.last_recv = now
+        self.recv_polls += 1
+        self.recv_gap_total += gap
+        self.recv_gap_max = max(self.recv_gap_max, gap)
+
+        profiler = self.profiler
+        if profiler:
+            profiler.enter('recv')
+
+        buf = self.recv_buf
+        start_len = len(buf)
+        while len(buf) - start_len < SimRunner.RECV_MAX_BYTES and (data := self.ardusub.recv(65536)):
+            buf += data
+
+        i = 0
+        end = len(buf)
+        while end - i >= 3:
+            length = mav_frame.frame_length(buf, i)
+            if length == 0:
+                # Not a frame, resync
+                i += 1
+                continue
+            if i + length > end:
+                # Wait for the rest of the frame
+                break
+            msg_id = mav_frame.msg_id(buf, i)
+            if not mav_frame.crc_ok(buf, i, msg_id):
+                self.recv_bad += 1
+                i += 1
+                continue
+
+            frame = bytes(buf[i:i + length])
+            i += length
+
+            if self.router:
+                self.router.forward(frame)
+
+            if msg_id in self.drop_ids:
+                self.recv_dropped += 1
+            elif self.decode_all or msg_id in self.decode_ids:
+                self.recv_decoded += 1
+                if profiler:
+                    profiler.enter('decode')
+                try:
+                    msg = self.ardusub.mav.decode(bytearray(frame))
+                except apm2.MAVError as e:
+                    self.print(f'failed to decode message {msg_id}: {e}')
+                    msg = None
+                if msg is not None:
+                    self.ardusub.post_message(msg)
+                    self.handle_msg(msg, frame)
+                if profiler:
+                    profiler.exit()
+            elif self.log_writer and (self.ardusub_origin or msg_id not in self.gps_ids):
+                self.recv_raw += 1
+                if profiler:
+                    profiler.enter('log')
+                self.log_writer.write_buf(frame)
+                if profiler:
+                    profiler.exit()
+
+        del buf[:i]
+
+        if self.router:
+            if profiler:
+                profiler.enter('route')
+            self.route()
+            if profiler:
+                profiler.exit()
+
+        if profiler:
+            profiler.exit()
+
+    def route(self):
+        """
+        Send the frames queued for the ground stations, and pass the frames they sent on to ArduSub, as is.
+        """
+        self.router.flush()
+        for frame in self.router.poll():
+            self.ardusub.write(frame)
+            if self.log_writer:
+                self.log_writer.write_buf(frame)
+
+    def handle_msg(self, msg, frame: bytes):
+        """
+        React to a decoded message, pass it to the listeners and log it.
         """
-        while msg := self.ardusub.recv_match():
-            msg_type: str = msg.get_type()
-            if msg_type == 'PARAM_VALUE':
-                if msg.param_id not in SimRunner.SPAMMY_PARAMS:
-                    self.print(f'{msg.param_id} = {msg.param_value}')
-            elif msg_type == 'COMMAND_ACK':
-                # Ignore MAV_CMD_GET_HOME_POSITION errors -- spammy
-                if msg.command != apm2.MAV_CMD_GET_HOME_POSITION:
-                    self.print(f'command {msg.command} was acknowledged with result {msg.result}')
-            elif msg_type == 'STATUSTEXT':
-                if msg.text == 'ArduPilot Ready':
-                    self.ardusub_ready = True
-                if msg.text != 'Field Elevation Set: 0m':
-                    self.print_ardusub(SimRunner.severity_name(msg.severity), msg.text)
-            elif msg_type == 'HOME_POSITION':
-                self.print_ardusub(msg_type, f'({msg.latitude}, {msg.longitude}), ({msg.x}, {msg.y})')
-                self.ardusub_origin = True
-            elif msg_type == 'GPS_GLOBAL_ORIGIN':
-                self.print_ardusub(msg_type, f'({msg.latitude}, {msg.longitude})')
-                self.ardusub_origin = True
-
-            if self.log_writer and (self.ardusub_origin or msg.get_type() not in SimRunner.GPS_MSGS):
-                self.log_writer.write(msg)
+        msg_type: str = msg.get_type()
+        if msg_type == 'PARAM_VALUE':
+            if self.print_params and msg.param_id not in SimRunner.SPAMMY_PARAMS:
+                self.print(f'{msg.param_id} = {msg.param_value}')
+        elif msg_type == 'COMMAND_ACK':
+            # Ignore MAV_CMD_GET_HOME_POSITION errors -- spammy
+            if msg.command != apm2.MAV_CMD_GET_HOME_POSITION:
+                self.print(f'command {msg.command} was acknowledged with result {msg.result}')
+        elif msg_type == 'STATUSTEXT':
+            if msg.text == 'ArduPilot Ready':
+                self.ardusub_ready = True
+            if msg.text != 'Field Elevation Set: 0m':
+                self.print_ardusub(SimRunner.severity_name(msg.severity), msg.text)
+        elif msg_type == 'HOME_POSITION':
+            self.print_ardusub(msg_type, f'({msg.latitude}, {msg.longitude}), ({msg.x}, {msg.y})')
+            self.ardusub_origin = True
+        elif msg_type == 'GPS_GLOBAL_ORIGIN':
+            self.print_ardusub(msg_type, f'({msg.latitude}, {msg.longitude})')
+            self.ardusub_origin = True
+
+        if self.lockstep and msg_type in SimRunner.CLOCK_MSGS:
+            self.update_clock(msg.time_boot_ms)
+
+        if self.listeners:
+            if self.profiler:
+                self.profiler.enter('listeners')
+            wall = time.time()
+            for listener in self.listeners:
+                listener.on_recv(msg, wall)
+            if self.profiler:
+                self.profiler.exit()
+
+        if self.log_writer and (self.ardusub_origin or msg_type not in SimRunner.GPS_MSGS):
+            if self.profiler:
+                self.profiler.enter('log')
+            self.log_writer.write_buf(frame)
+            if self.profiler:
+                self.profiler.exit()
@@ -3,6 +3,10 @@
 """
 Demonstrate sensor fusion with two sensors: a MAVLink DVL and a MAVLink UGPS (Underwater GPS).
 
+The sub follows a trajectory (a circle by default, see position.py). The track and the GPS noise are precomputed for
+the whole run, use --seed to make the noise repeatable. The true position is logged as HIL_STATE_QUATERNION at every
+track tick, for analysis.py; it is not sent to ArduSub.
+
 Sensor modes:
     UGPS_AND_INTERMITTENT_DVL = 0 (default) -- the UGPS is always on and the DVL turns on/off
     UGPS_ONLY = 1
@@ -12,14 +16,23 @@ Sensor modes:
 
 import argparse
 import math
-import time
 from enum import IntEnum
+from typing import NamedTuple
 
 from pymavlink.dialects.v20 import ardupilotmega as apm2
 
+import analysis
+import cache
+import latency
+import live_analysis
+import mav_router
+import msg_template
 import param
 import position
+import profiler
+import scheduler
 import sim_runner
+import stop_conditions
 
 
 def default_heartbeat_msg() -> apm2.MAVLink_heartbeat_message:
@@ -34,10 +47,10 @@ def default_heartbeat_msg() -> apm2.MAVLink_heartbeat_message:
 
 def default_vision_position_delta_msg() -> apm2.MAVLink_vision_position_delta_message:
     time_usec = 0  # Same as WL DVL extension
-    time_delta_usec = int(1000000 * SimSensors.FAST_LOOP_PERIOD)
     confidence = 99.8
 
     # Updated per tick:
+    time_delta_usec = 0
     angle_delta = [0.0, 0.0, 0.0]
     position_delta = [0.0, 0.0, 0.0]
 
@@ -85,6 +98,14 @@ def default_gps_input_msg() -> apm2.MAVLink_gps_input_message:
                                           satellites_visible, yaw)
 
 
+def default_truth_msg() -> apm2.MAVLink_hil_state_quaternion_message:
+    """
+    The ground truth. Only time_usec (sim time), attitude_quaternion (yaw only), lat and lon are filled in.
+    """
+    return apm2.MAVLink_hil_state_quaternion_message(
+        0, [1.0, 0.0, 0.0, 0.0], 0.0, 0.0, 0.0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+
+
 class SensorMode(IntEnum):
     UGPS_AND_INTERMITTENT_DVL = 0
     UGPS_ONLY = 1
@@ -92,29 +113,67 @@ class SensorMode(IntEnum):
     UGPS_AND_DVL = 3
 
 
-class SimSensors(sim_runner.SimRunner):
-    FAST_LOOP_PERIOD = 0.2
-    SLOW_LOOP_COUNT = 5
+class SensorRates(NamedTuple):
+    """
+    Sensor rates in Hz, and delivery jitter (standard deviation in seconds), see scheduler.py.
+    """
+    dvl: float = 5.0
+    gps: float = 1.0
+    heartbeat: float = 1.0
+    dvl_jitter: float = 0.0
+    gps_jitter: float = 0.0
 
+
+class SimSensors(sim_runner.SimRunner):
     def __init__(self,
                  params_path: str | None,
                  log_path: str | None,
                  speedup: float,
                  duration: int,
                  switch: bool,
-                 mode: SensorMode):
-        super().__init__(params_path, log_path, speedup)
+                 mode: SensorMode,
+                 instance: int = 0,
+                 cwd: str | None = None,
+                 lockstep: bool = False,
+                 trajectory: str = 'circle',
+                 seed: int | None = None,
+                 rates: SensorRates = SensorRates(),
+                 ardusub: sim_runner.ArduSubInstance | None = None,
+                 dataflash: bool = False,
+                 sim_timestamps: bool = False,
+                 profile: bool = False,
+                 routes: list[str] | None = None):
+        super().__init__(params_path, log_path, speedup, instance, cwd, lockstep, ardusub, dataflash=dataflash,
+                         sim_timestamps=sim_timestamps, profile=profile, routes=routes)
         self.print(f'run for {duration}s')
         self.duration = duration
         self.switch = switch
         self.mode = mode
         self.dvl_is_active = True if mode in [SensorMode.DVL_ONLY, SensorMode.UGPS_AND_DVL] else False
-        self.heartbeat_msg = default_heartbeat_msg()
-        self.vision_position_delta_msg = default_vision_position_delta_msg()
-        self.gps_input_msg = default_gps_input_msg()
-        self.position = position.Position()
+
+        # Templates patch the changed fields into a pre-built frame rather than packing the message on every send
+        self.heartbeat_msg = msg_template.MessageTemplate(default_heartbeat_msg())
+        self.vision_position_delta_msg = msg_template.MessageTemplate(default_vision_position_delta_msg())
+        self.gps_input_msg = msg_template.MessageTemplate(default_gps_input_msg())
+        self.truth_msg = msg_template.MessageTemplate(default_truth_msg())
+        self.print(f'trajectory {trajectory}, seed {seed}')
+
+        # Step the track at the fastest sensor rate
+        self.position = position.Position(position.make_trajectory(trajectory), 1.0 / max(rates.dvl, rates.gps),
+                                          duration, seed)
+        self.dvl_index = 0
         # self.armed = False
 
+        self.rates = rates
+        self.print(f'DVL {rates.dvl}Hz, UGPS {rates.gps}Hz, HEARTBEAT {rates.heartbeat}Hz')
+        self.scheduler = scheduler.Scheduler(self.sim_time, self.wait_sim_time, seed, self.profiler)
+        self.scheduler.add('heartbeat', rates.heartbeat, self.heartbeat_task)
+        self.scheduler.add('truth', 1.0 / self.position.dt, self.truth_task)
+        if mode in [SensorMode.UGPS_ONLY, SensorMode.UGPS_AND_DVL, SensorMode.UGPS_AND_INTERMITTENT_DVL]:
+            self.scheduler.add('ugps', rates.gps, self.gps_task, rates.gps_jitter)
+        if mode in [SensorMode.DVL_ONLY, SensorMode.UGPS_AND_DVL, SensorMode.UGPS_AND_INTERMITTENT_DVL]:
+            self.scheduler.add('dvl', rates.dvl, self.dvl_task, rates.dvl_jitter)
+
     def set_ekf_src(self, n: int):
         """
         Select an EKF source set. Is this supported on the Sub-4.1 branch?
@@ -136,14 +195,8 @@ class SimSensors(sim_runner.SimRunner):
             self.ardusub.target_system, self.ardusub.target_component, apm2.MAV_CMD_COMPONENT_ARM_DISARM,
             0, 1, 0, 0, 0, 0, 0, 0))
 
-    def slow_loop(self):
+    def heartbeat_task(self, tick: int):
         self.send_to_ardusub(self.heartbeat_msg)
-        if self.mode in [SensorMode.UGPS_ONLY, SensorMode.UGPS_AND_DVL, SensorMode.UGPS_AND_INTERMITTENT_DVL]:
-            self.gps_input_msg.lat, self.gps_input_msg.lon = self.position.noisy_gps()
-            self.send_to_ardusub(self.gps_input_msg)
-
-    def fast_loop(self):
-        self.recv_messages_from_ardusub()
 
         # Experiment: use RC overrides to move in a circle to see if the IMU improves the results.
         # Results so far: the circle is too tight, and the RC inputs are hitting the deadzones.
@@ -155,10 +208,25 @@ class SimSensors(sim_runner.SimRunner):
         # if self.armed:
         #     self.set_rc_channels(1510, 1505)
 
-        self.position.update(SimSensors.FAST_LOOP_PERIOD)
+    def truth_task(self, tick: int):
+        self.position.seek(tick)
+        msg = self.truth_msg
+        msg.time_usec = int(self.position.t * 1e6)
+        msg.attitude_quaternion = [math.cos(self.position.yaw / 2.0), 0.0, 0.0, math.sin(self.position.yaw / 2.0)]
+        msg.lat, msg.lon = self.position.true_gps()
+        self.log_msg(msg)
+
+    def gps_task(self, tick: int):
+        self.position.seek(self.position.index(tick / self.rates.gps))
+        self.gps_input_msg.lat, self.gps_input_msg.lon = self.position.noisy_gps()
+        self.send_to_ardusub(self.gps_input_msg)
+
+    def dvl_task(self, tick: int):
+        self.position.seek(self.position.index(tick / self.rates.dvl))
 
         if self.mode == SensorMode.UGPS_AND_INTERMITTENT_DVL:
-            dvl_should_be_active = self.position.theta > math.pi
+            # DVL is on for the second half of each lap
+            dvl_should_be_active = self.position.phase > 0.5
             if self.dvl_is_active != dvl_should_be_active:
                 if dvl_should_be_active:
                     self.print('DVL on')
@@ -170,26 +238,25 @@ class SimSensors(sim_runner.SimRunner):
                         self.set_ekf_src(param.MULTI_SRC_DVL_OFF)
                 self.dvl_is_active = dvl_should_be_active
 
-        if self.dvl_is_active:
-            self.vision_position_delta_msg.angle_delta = self.position.angle_delta
-            self.vision_position_delta_msg.position_delta = self.position.position_delta
-            self.send_to_ardusub(self.vision_position_delta_msg)
+        if self.dvl_is_active and self.position.i > self.dvl_index:
+            msg = self.vision_position_delta_msg
+            msg.angle_delta, msg.position_delta = self.position.deltas_since(self.dvl_index)
+            msg.time_delta_usec = int(1e6 * (self.position.i - self.dvl_index) * self.position.dt)
+            self.send_to_ardusub(msg)
+
+        self.dvl_index = self.position.i
 
     def run(self) -> None:
         self.print(f'sensors started')
-        count = 0
 
         # Hack: switch to SRC2 to work around DVL extension bug
         # self.set_ekf_src(2)
 
-        while self.sim_time() < self.duration:
-            time.sleep(SimSensors.FAST_LOOP_PERIOD / self.speedup)
-            if count % SimSensors.SLOW_LOOP_COUNT == 0:
-                self.slow_loop()
-            self.fast_loop()
-            count += 1
+        self.scheduler.run(self.duration, until=lambda: self.stop_reason is not None)
 
         self.print(f'simulation stopped')
+        for line in self.scheduler.report():
+            self.print(line)
 
 
 def main():
@@ -200,9 +267,73 @@ def main():
     parser.add_argument('--time', type=int, default=60, help='how long to run the simulation')
     parser.add_argument('--switch', action='store_true', help='switch EKF sources when DVL goes on/off')
     parser.add_argument('--mode', type=int, default=0, help='sensor mode (see above)')
+    parser.add_argument('--instance', type=int, default=0, help='ArduSub SITL instance number, sets the port')
+    parser.add_argument('--lockstep', action='store_true', help="drive the sensors from ArduSub's clock")
+    parser.add_argument('--sim-timestamps', action='store_true',
+                        help='stamp the log with sim time, so it can be replayed at any speed')
+    parser.add_argument('--trajectory', type=str, default='circle',
+                        help='circle, lawnmower, or path of a waypoint file')
+    parser.add_argument('--seed', type=int, default=None, help='seed for the sensor noise')
+    parser.add_argument('--dvl-rate', type=float, default=5.0, help='DVL rate in Hz')
+    parser.add_argument('--gps-rate', type=float, default=1.0, help='UGPS rate in Hz')
+    parser.add_argument('--dvl-jitter', type=float, default=0.0, help='DVL delivery jitter (std dev) in seconds')
+    parser.add_argument('--gps-jitter', type=float, default=0.0, help='UGPS delivery jitter (std dev) in seconds')
+    parser.add_argument('--latency', action='store_true', help='measure sensor to EKF latency')
+    parser.add_argument('--live', type=float, default=None,
+                        help='print the localization error every LIVE seconds of sim time while running')
+    parser.add_argument('--stop', type=str, action='append', default=[],
+                        help='end the run early when this condition holds, see stop_conditions.py')
+    parser.add_argument('--route', type=str, action='append', default=[],
+                        help='forward MAVLink to and from a ground station, e.g., udpout:127.0.0.1:14550, see '
+                             'mav_router.py')
+    parser.add_argument('--profile', action='store_true', help='print where the time went at the end of the run')
+    parser.add_argument('--cprofile', type=str, default=None, help='run under cProfile and write the stats here')
+    parser.add_argument('--dataflash', action='store_true',
+                        help="copy ArduSub's DataFlash log next to the tlog, as <log>.bin (requires --log)")
+    parser.add_argument('--cache', type=str, default=None,
+                        help='result cache directory, e.g., ~/.cache/ardusub_localization (requires --seed and --log)')
     args = parser.parse_args()
-    runner = SimSensors(args.params, args.log, args.speedup, args.time, args.switch, args.mode)
-    runner.run()
+    try:
+        conditions = stop_conditions.parse_conditions(args.stop)
+        for route in args.route:
+            mav_router.parse_address(route)
+        position.make_trajectory(args.trajectory)
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
+    rates = SensorRates(args.dvl_rate, args.gps_rate, 1.0, args.dvl_jitter, args.gps_jitter)
+
+    def run():
+        runner = SimSensors(args.params, args.log, args.speedup, args.time, args.switch, args.mode, args.instance,
+                            lockstep=args.lockstep, trajectory=args.trajectory, seed=args.seed, rates=rates,
+                            dataflash=args.dataflash, sim_timestamps=args.sim_timestamps, profile=args.profile,
+                            routes=args.route)
+        try:
+            if args.latency:
+                runner.add_listener(latency.LatencyTracker(runner.sim_time))
+            if args.live:
+                runner.add_listener(live_analysis.LiveListener(runner, interval=args.live))
+            if conditions:
+                runner.add_listener(stop_conditions.StopMonitor(runner, conditions))
+            if args.cprofile:
+                for line in profiler.run_cprofile(args.cprofile, runner.run):
+                    print(line)
+            else:
+                runner.run()
+        finally:
+            # Write the rest of the tlog even if the run was interrupted
+            runner.close()
+
+    if args.cache and args.seed is not None:
+        key = cache.sensors_key(args.params, args.mode, args.time, args.seed, speedup=args.speedup,
+                                switch=args.switch, lockstep=args.lockstep,
+                                trajectory=cache.file_hash(args.trajectory) or args.trajectory, rates=rates,
+                                sim_timestamps=args.sim_timestamps, stop=args.stop)
+        cache.run_cached(cache.ResultCache(args.cache), key, args.log, run,
+                         lambda path: analysis.analyze(path)._asdict(), args.dataflash)
+    else:
+        if args.cache:
+            print('not caching, runs without --seed are not reproducible')
+        run()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,160 @@
+"""
+End a run early once its outcome is clear, rather than running for the full --time or the whole replay.
+
+StopMonitor is a SimRunner listener that checks each condition as ArduSub output arrives. When one holds it calls
+SimRunner.request_stop(), and SimSensors and SimReplay finish at the next sensor tick. The tlog is complete up to that
+point, so analysis.py works as usual, but the metrics cover a shorter run.
+
+Conditions, given with --stop (repeat it for several, the first one to hold stops the run):
+    converged:X:N   the horizontal error has stayed below X meters for N seconds
+    diverged:X:N    the horizontal error has stayed above X meters for N seconds, N may be 0
+    ekf:N           the EKF has reported a bad solution for N seconds, after it had a good one: no absolute horizontal
+                    position in EKF_STATUS_REPORT.flags, or a horizontal position test ratio above 1
+    text:REGEX      ArduSub sent a STATUSTEXT that matches REGEX, ignoring case, e.g., text:'EKF.*(fail|lost)'
+    critical        ArduSub sent a STATUSTEXT with severity CRITICAL or worse
+
+Tools that rank runs against each other (matrix.py, batch_replay.py, sweep.py, monte_carlo.py) refuse converged: it
+ends the best runs first, so they would be scored on a shorter window than the rest. diverged only ends runs that have
+already lost.
+
+The horizontal error is GLOBAL_POSITION_INT vs the most recent ground truth, or GPS_INPUT if there is no truth (e.g.,
+a replay of a real dive), as in analysis.py and live_analysis.py. It is only checked once ArduSub has an origin.
+Seconds are sim time.
+
+Example, give up on a run once the error has been above 20m for 30s, and stop 60s after it settles below 1m:
+    python sim_sensors.py --params params/fusion.params --time 1200 --stop diverged:20:30 --stop converged:1:60
+"""
+
+import re
+from typing import NamedTuple
+
+from pymavlink.dialects.v20 import ardupilotmega as apm2
+
+import analysis
+import live_analysis
+
+
+class Condition(NamedTuple):
+    spec: str  # As given, e.g., diverged:20:30
+    kind: str
+    threshold: float = 0.0  # m
+    duration: float = 0.0  # s
+    pattern: str | None = None
+
+
+def parse_condition(spec: str) -> Condition:
+    """
+    Parse a --stop value, see above. Raises ValueError if it doesn't make sense.
+    """
+    kind, _, rest = spec.partition(':')
+    try:
+        if kind in ['converged', 'diverged']:
+            threshold, duration = rest.split(':')
+            return Condition(spec, kind, float(threshold), float(duration))
+        elif kind == 'ekf':
+            return Condition(spec, kind, duration=float(rest))
+        elif kind == 'text':
+            re.compile(rest)
+            if rest:
+                return Condition(spec, kind, pattern=rest)
+        elif kind == 'critical' and not rest:
+            return Condition(spec, kind)
+    except (ValueError, re.error):
+        pass
+    raise ValueError(f'bad stop condition {spec}, expected one of converged:X:N, diverged:X:N, ekf:N, text:REGEX, '
+                     f'critical')
+
+
+def parse_conditions(specs: list[str], ranking: bool = False) -> list[Condition]:
+    """
+    Parse --stop values. If ranking is set the runs will be ranked, and converged raises ValueError, see above.
+    """
+    conditions = [parse_condition(spec) for spec in specs]
+    if ranking:
+        for condition in conditions:
+            if condition.kind == 'converged':
+                raise ValueError(f'stop condition {condition.spec} would score the best runs on a shorter window, '
+                                 f'converged can only be used with sim_sensors.py and sim_replay.py')
+    return conditions
+
+
+class StopMonitor:
+    """
+    A SimRunner listener, see SimRunner.add_listener().
+    """
+
+    recv_types = ['GLOBAL_POSITION_INT', 'EKF_STATUS_REPORT', 'STATUSTEXT']
+
+    def __init__(self, runner, conditions: list[Condition]):
+        self.runner = runner
+        self.conditions = conditions
+
+        # Most recent reference position (lat, lon), and True once it is the ground truth
+        self.reference = None
+        self.truth = False
+
+        # {condition index: sim time when the condition started to hold}
+        self.since = {}
+
+        # True once the EKF has reported a good solution
+        self.ekf_good = False
+
+        if any(condition.kind == 'ekf' for condition in conditions):
+            runner.request_msg(apm2.MAVLINK_MSG_ID_EKF_STATUS_REPORT, runner.REQUEST_MSG_RATE)
+
+    def held(self, i: int, t: float, holds: bool) -> bool:
+        """
+        Track how long condition i has held, return True once it has held for its duration.
+        """
+        if not holds:
+            self.since.pop(i, None)
+            return False
+        return t - self.since.setdefault(i, t) >= self.conditions[i].duration
+
+    def check(self, i: int, msg, t: float) -> str | None:
+        """
+        Check condition i against a message, return why the run should stop, or None.
+        """
+        condition = self.conditions[i]
+        msg_type = msg.get_type()
+        if msg_type == 'GLOBAL_POSITION_INT' and condition.kind in ['converged', 'diverged']:
+            if self.reference is None or not self.runner.ardusub_origin:
+                return None
+            error = live_analysis.horizontal_error(msg.lat, msg.lon, *self.reference)
+            below = error < condition.threshold
+            if self.held(i, t, below if condition.kind == 'converged' else not below):
+                return f'error {error :.2f}m'
+        elif msg_type == 'EKF_STATUS_REPORT' and condition.kind == 'ekf':
+            good = bool(msg.flags & apm2.EKF_POS_HORIZ_ABS) and msg.pos_horiz_variance <= 1.0
+            self.ekf_good |= good
+            if self.held(i, t, self.ekf_good and not good):
+                return f'flags {msg.flags :#x}, horizontal position test ratio {msg.pos_horiz_variance :.2f}'
+        elif msg_type == 'STATUSTEXT':
+            if condition.kind == 'text' and re.search(condition.pattern, msg.text, re.IGNORECASE):
+                return msg.text
+            if condition.kind == 'critical' and msg.severity <= apm2.MAV_SEVERITY_CRITICAL:
+                return msg.text
+        return None
+
+    def on_send(self, msg, wall: float):
+        msg_type = msg.get_type()
+        if msg_type == analysis.TRUTH_MSG:
+            self.reference = (msg.lat, msg.lon)
+            self.truth = True
+        elif msg_type == analysis.REFERENCE_MSG and not self.truth:
+            self.reference = (msg.lat, msg.lon)
+
+    def on_recv(self, msg, wall: float):
+        if self.runner.stop_reason is not None:
+            return
+        t = self.runner.sim_time()
+        for i, condition in enumerate(self.conditions):
+            reason = self.check(i, msg, t)
+            if reason is not None:
+                self.runner.request_stop(f'{condition.spec}, {reason}')
+                return
+
+    def report(self) -> list[str]:
+        if self.runner.stop_reason is None:
+            return ['stop: no condition held, ran to the end']
+        return [f'stop: stopped early at {self.runner.stop_time :.1f}s, {self.runner.stop_reason}']
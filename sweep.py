@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+Search over EKF parameters by running SimSensors experiments on a pool of ArduSub instances.
+
+Each candidate is the --params file with some values replaced. A candidate is scored by the mean RMS horizontal error
+(see analysis.py) across the --modes; lower is better. The best candidate is written to --best. If no candidate has
+metrics in every mode (e.g., the runs failed, or ArduSub never had a position), nothing is written and the exit status
+is 1.
+
+Ranges:
+    NAME=lo:hi:n        n values from lo to hi
+    NAME=lo:hi:n:log    n values from lo to hi, evenly spaced on a log scale
+    NAME=a,b,c          a list of values
+
+Searches:
+    grid        run every combination of the range values for --time seconds
+    halving     successive halving: run --samples random candidates (or the whole grid if --samples is 0) for
+                --min-time seconds, keep the best 1/--eta, multiply the time by --eta, repeat until one is left
+                or --time is reached
+
+Example:
+    python sweep.py --params params/fusion.params --range EK3_POSNE_M_NSE=0.5:5:6:log \\
+        --range EK3_SRC_OPTIONS=0,1 --modes 0 1 --search halving --min-time 100 --time 400 --best /tmp/best.params
+"""
+
+import argparse
+import itertools
+import math
+import os
+from typing import NamedTuple
+
+import numpy as np
+
+import cache
+import matrix
+import param
+import stop_conditions
+
+
+class Range(NamedTuple):
+    name: str
+    values: list[float]  # Grid values
+    lo: float
+    hi: float
+    log: bool
+    discrete: bool
+
+    def sample(self, rng: np.random.Generator) -> float:
+        if self.discrete:
+            return float(rng.choice(self.values))
+        elif self.log:
+            return float(math.exp(rng.uniform(math.log(self.lo), math.log(self.hi))))
+        else:
+            return float(rng.uniform(self.lo, self.hi))
+
+
+def parse_range(spec: str) -> Range:
+    name, values = spec.split('=', 1)
+    if ':' in values:
+        fields = values.split(':')
+        lo, hi, n = float(fields[0]), float(fields[1]), int(fields[2])
+        log = len(fields) > 3 and fields[3] == 'log'
+        grid = np.geomspace(lo, hi, n) if log else np.linspace(lo, hi, n)
+        return Range(name, [float(v) for v in grid], lo, hi, log, False)
+    else:
+        grid = [float(v) for v in values.split(',')]
+        return Range(name, grid, min(grid), max(grid), False, True)
+
+
+def grid_candidates(ranges: list[Range]) -> list[dict[str, float]]:
+    return [dict(zip([r.name for r in ranges], values)) for values in itertools.product(*[r.values for r in ranges])]
+
+
+def random_candidates(ranges: list[Range], n: int, seed: int | None) -> list[dict[str, float]]:
+    rng = np.random.default_rng(seed)
+    return [{r.name: r.sample(rng) for r in ranges} for _ in range(n)]
+
+
+def score(results: list[dict]) -> float:
+    """
+    Mean RMS error across modes, see analysis.Metrics. Runs with no EKF output score infinity.
+    """
+    rms = [m['rms'] for m in results]
+    if not rms or any(math.isnan(r) for r in rms):
+        return math.inf
+    return float(np.mean(rms))
+
+
+class Sweep:
+    def __init__(self, params_path: str, modes: list[int], options: matrix.Options, out_dir: str, jobs: int):
+        self.base_params = param.parse_params(params_path)
+        self.modes = modes
+        self.options = options
+        self.out_dir = out_dir
+        self.jobs = jobs
+
+        # {candidate: modes with no metrics in the most recent evaluate()}
+        self.missing: dict[int, list[int]] = {}
+        os.makedirs(out_dir, exist_ok=True)
+
+    def candidate_path(self, i: int) -> str:
+        return os.path.join(self.out_dir, f'candidate_{i}.params')
+
+    def evaluate(self, candidates: dict[int, dict[str, float]], duration: int, label: str) -> dict[int, float]:
+        """
+        Run every candidate in every mode for duration seconds, in parallel. Return {candidate: score}.
+        """
+        experiments = []
+        for i, overrides in candidates.items():
+            param.write_params(self.candidate_path(i), param.apply_overrides(self.base_params, overrides),
+                               f'candidate {i}: {overrides}')
+            for mode in self.modes:
+                experiments.append(matrix.Experiment(f'{label}_candidate_{i}_mode_{mode}', self.candidate_path(i),
+                                                     mode, duration))
+
+        print(f'SWEEP: {label}: {len(candidates)} candidates x {len(self.modes)} modes for {duration}s')
+        results = matrix.run_matrix(experiments, self.options, self.out_dir, self.jobs)
+        metrics = {result.name: result.metrics for result in results}
+
+        scores = {}
+        for i, overrides in candidates.items():
+            # A failed run scores infinity
+            runs = [metrics.get(f'{label}_candidate_{i}_mode_{mode}') for mode in self.modes]
+            scores[i] = score(runs) if None not in runs else math.inf
+            self.missing[i] = [mode for mode, run in zip(self.modes, runs) if run is None or math.isnan(run['rms'])]
+            if self.missing[i]:
+                print(f'SWEEP: candidate {i} {overrides} has no metrics for modes {self.missing[i]}')
+            print(f'SWEEP: candidate {i} {overrides} scored {scores[i] :.3f}')
+        return scores
+
+    def grid(self, candidates: list[dict[str, float]], duration: int) -> tuple[int, float]:
+        scores = self.evaluate(dict(enumerate(candidates)), duration, 'grid')
+        best = min(scores, key=scores.get)
+        return best, scores[best]
+
+    def halving(self, candidates: list[dict[str, float]], min_duration: int, max_duration: int,
+                eta: int) -> tuple[int, float]:
+        alive = dict(enumerate(candidates))
+        duration = min_duration
+        rung = 0
+        while True:
+            scores = self.evaluate(alive, duration, f'rung_{rung}')
+            ranked = sorted(scores, key=scores.get)
+            if len(ranked) == 1 or duration >= max_duration:
+                return ranked[0], scores[ranked[0]]
+            keep = max(1, len(ranked) // eta)
+            alive = {i: alive[i] for i in ranked[:keep]}
+            duration = min(duration * eta, max_duration)
+            rung += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--params', type=str, required=True, help='base parameter file')
+    parser.add_argument('--range', type=str, action='append', required=True, help='parameter range, see above')
+    parser.add_argument('--search', choices=['grid', 'halving'], default='grid', help='search strategy')
+    parser.add_argument('--modes', type=int, nargs='+', default=[0], help='sensor modes, see sim_sensors.py')
+    parser.add_argument('--time', type=int, default=400, help='simulation time (max time for halving)')
+    parser.add_argument('--min-time', type=int, default=100, help='first rung simulation time for halving')
+    parser.add_argument('--eta', type=int, default=3, help='halving keeps 1/eta of the candidates per rung')
+    parser.add_argument('--samples', type=int, default=0, help='random candidates for halving, 0 means the grid')
+    parser.add_argument('--speedup', type=float, default=1.0, help='SIM_SPEEDUP value')
+    parser.add_argument('--lockstep', action='store_true', help="drive the sensors from ArduSub's clock")
+    parser.add_argument('--seed', type=int, default=0, help='seed for sensor noise and random candidates')
+    parser.add_argument('--cache', type=str, default=cache.DEFAULT_DIR, help='result cache directory')
+    parser.add_argument('--max-uses', type=int, default=10,
+                        help='reuse each ArduSub instance for up to this many runs, 0 to start a new one each')
+    parser.add_argument('--out', type=str, default='/tmp/sweep', help='directory for candidates and tlogs')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of simulations to run at once')
+    parser.add_argument('--best', type=str, required=True, help='write the best parameters here')
+    parser.add_argument('--stop', type=str, action='append', default=[],
+                        help='end each run early when this condition holds, see stop_conditions.py')
+    args = parser.parse_args()
+    try:
+        stop_conditions.parse_conditions(args.stop, ranking=True)
+    except ValueError as e:
+        parser.error(str(e))
+
+    ranges = [parse_range(spec) for spec in args.range]
+    if args.search == 'halving' and args.samples > 0:
+        candidates = random_candidates(ranges, args.samples, args.seed)
+    else:
+        candidates = grid_candidates(ranges)
+
+    options = matrix.Options(args.speedup, lockstep=args.lockstep, seed=args.seed, cache_dir=args.cache,
+                             max_uses=args.max_uses, stop=tuple(args.stop))
+    sweep = Sweep(args.params, args.modes, options, args.out, args.jobs)
+    if args.search == 'grid':
+        best, best_score = sweep.grid(candidates, args.time)
+    else:
+        best, best_score = sweep.halving(candidates, args.min_time, args.time, args.eta)
+
+    if not math.isfinite(best_score):
+        missing = sorted(set(mode for modes in sweep.missing.values() for mode in modes))
+        print(f'SWEEP: no candidate has metrics in every mode, modes {missing} produced none, not writing {args.best}')
+        exit(1)
+
+    print(f'SWEEP: best is candidate {best} {candidates[best]}, score {best_score :.3f}')
+    param.write_params(args.best, param.apply_overrides(sweep.base_params, candidates[best]),
+                       f'best of {len(candidates)} candidates, mean RMS {best_score :.3f}m: {candidates[best]}')
+
+
+if __name__ == '__main__':
+    main()
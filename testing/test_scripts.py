@@ -7,9 +7,48 @@
 # Run a particular test:
 # python -m pytest -rP testing/test_scripts.py::TestScripts::test_param_parsing
 
+import gzip
+import math
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+# Use MAVLink2 wire protocol, must include this before importing pymavlink.mavutil
+os.environ['MAVLINK20'] = '1'
+
+import numpy as np
 import pytest
+from pymavlink import mavutil
+from pymavlink.dialects.v20 import ardupilotmega as apm2
 
+import analysis
+import ardusub_pool
+import batch_replay
+import cache
+import dataflash
+import fake_ardusub
+import latency
+import live_analysis
+import log_writer
+import mav_router
+import matrix
+import monte_carlo
+import msg_template
 import param
+import param_upload
+import position
+import scheduler
+import sim_replay
+import sim_runner
+import sim_sensors
+import stop_conditions
+import sweep
+import tlog_columns
+import tlog_index
 
 
 class TestScripts:
@@ -20,3 +59,874 @@ class TestScripts:
 
         fusion_params = param.parse_params('params/fusion.params')
         assert len(fusion_params) == 21
+
+    def test_matrix_no_ardusub(self, monkeypatch, tmp_path):
+        # Without an ArduSub build every run fails, with or without a warm pool, and the matrix still finishes
+        monkeypatch.setenv('ARDUPILOT_HOME', str(tmp_path / 'missing'))
+        experiments = matrix.build_matrix(['params/fusion.params'], [0, 1], [10])
+        for max_uses in [0, 2]:
+            assert matrix.run_matrix(experiments, matrix.Options(max_uses=max_uses), str(tmp_path / 'out'), 2) == []
+
+    def test_build_matrix(self):
+        experiments = matrix.build_matrix(['params/lutris.params', 'params/fusion.params'], [0, 1, 2, 3], [400])
+        assert len(experiments) == 8
+        assert experiments[0].name == 'mode_0_lutris'
+        assert experiments[-1].name == 'mode_3_fusion'
+
+        experiments = matrix.build_matrix(['params/fusion.params'], [0], [100, 400])
+        assert [e.name for e in experiments] == ['mode_0_fusion_100s', 'mode_0_fusion_400s']
+
+    @pytest.mark.parametrize('suffix', ['.tlog', '.tlog.gz'])
+    def test_log_writer(self, tmp_path, suffix):
+        path = str(tmp_path / f'test{suffix}')
+        writer = log_writer.LogWriter(path)
+        for i in range(1000):
+            msg = apm2.MAVLink_param_set_message(1, 1, b'SIM_BARO_RND', float(i), 9)
+            msg.pack(apm2.MAVLink(None, 255, 0))
+            writer.write(msg)
+        writer.close()
+
+        if suffix.endswith('.gz'):
+            with gzip.open(path) as src, open(str(tmp_path / 'test.tlog'), 'wb') as dst:
+                dst.write(src.read())
+            path = str(tmp_path / 'test.tlog')
+
+        tlog = mavutil.mavlink_connection(path)
+        values = []
+        while (msg := tlog.recv_match(type='PARAM_SET')) is not None:
+            values.append(msg.param_value)
+        assert values == [float(i) for i in range(1000)]
+
+    def test_log_writer_exit(self, tmp_path):
+        # A writer that is never closed still writes everything, and a complete .gz, when the interpreter exits
+        path = str(tmp_path / 'test.tlog.gz')
+        code = ('import log_writer\n'
+                'from pymavlink.dialects.v20 import ardupilotmega as apm2\n'
+                f'writer = log_writer.LogWriter({path!r})\n'
+                'for i in range(10):\n'
+                '    writer.write_buf(apm2.MAVLink_heartbeat_message(6, 8, 0, 0, 0, 3).pack(apm2.MAVLink(None)))\n')
+        subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(os.path.dirname(__file__)))
+        with gzip.open(path) as f:
+            assert len(f.read()) == 10 * (8 + 21)
+
+    def test_tlog_index(self, tmp_path):
+        # 100 seconds of GPS_INPUT at 1Hz mixed with HEARTBEATs, plus some garbage that should be skipped
+        mav = apm2.MAVLink(None, 255, 0)
+        path = str(tmp_path / 'test.tlog')
+        with open(path, 'wb') as f:
+            f.write(b'\x00\x01\x02')
+            for i in range(100):
+                usec = int((1000.0 + i) * 1e6)
+                gps = apm2.MAVLink_gps_input_message(i, 0, 0, 0, 0, 3, i, -i, 0, 1, 4, 0, 0, 0, 0, 0, 0, 10, 0)
+                hb = apm2.MAVLink_heartbeat_message(apm2.MAV_TYPE_CAMERA, apm2.MAV_AUTOPILOT_INVALID, 0, 0, 0, 3)
+                f.write(struct.pack('>Q', usec) + gps.pack(mav))
+                f.write(struct.pack('>Q', usec) + hb.pack(mav))
+
+        for use_cache in [True, True, False]:
+            reader = tlog_index.TlogReader(path, use_cache)
+            msgs = list(reader.messages(['GPS_INPUT']))
+            assert [m.lat for m in msgs] == list(range(100))
+            assert msgs[10]._timestamp == 1010.0
+
+            msgs = list(reader.messages(['GPS_INPUT', 'HEARTBEAT'], 10.0, 19.0))
+            assert len(msgs) == 20
+            assert msgs[0].lat == 10
+            reader.close()
+
+        assert os.path.exists(path + '.idx.npz')
+
+    def test_position(self):
+        # Same seed, same noise
+        a = position.Position(seed=1)
+        b = position.Position(seed=1)
+        assert np.array_equal(a.track.gps_noise, b.track.gps_noise)
+
+        # The circle starts at (r, 0) facing east, and the deltas add up to the position
+        p = position.Position(position.Circle(), 0.2, 10.0, seed=1)
+        assert p.x == pytest.approx(10.0)
+        assert p.yaw == pytest.approx(math.pi / 2.0)
+        x, y, yaw = p.x, p.y, p.yaw
+        for _ in range(200):  # Runs past the precomputed 10s
+            p.update()
+            x += p.position_delta[0]
+            y += p.position_delta[1]
+            yaw += p.angle_delta[2]
+        assert (x, y) == pytest.approx((p.x, p.y))
+        assert position.wrap_angle(yaw - p.yaw) == pytest.approx(0.0)
+
+    def test_trajectories(self, tmp_path):
+        path = tmp_path / 'square.txt'
+        path.write_text('# north east\n0 0\n10 0\n10 10\n0 10\n')
+        for trajectory in [position.Lawnmower(), position.Waypoints(str(path))]:
+            t = np.linspace(0.0, trajectory.period, 1000)
+            x, y, yaw = trajectory.sample(t)
+            # Closed path at a constant velocity
+            assert (x[0], y[0]) == pytest.approx((x[-1], y[-1]))
+            assert np.hypot(np.diff(x), np.diff(y)).max() <= 0.5 * (t[1] - t[0]) + 1e-9
+
+        for points in ['5 5\n', '5 5\n5 5\n5 5\n']:
+            path.write_text(points)
+            with pytest.raises(ValueError, match='two distinct points'):
+                position.make_trajectory(str(path))
+
+    def test_scheduler(self):
+        # Fake sim clock, each callback takes 10ms
+        clock = [0.0]
+
+        def wait(t):
+            clock[0] = max(clock[0], t)
+
+        def work(tick):
+            clock[0] += 0.01
+
+        s = scheduler.Scheduler(lambda: clock[0], wait)
+        dvl = s.add('dvl', 10.0, work)
+        gps = s.add('gps', 1.0, work, jitter=0.1)
+        s.run(100.0)
+
+        # No drift: every tick runs on time
+        assert dvl.runs == 1000 and dvl.misses == 0 and dvl.skipped == 0
+        assert gps.runs == 100 and gps.max_lateness < 0.05
+
+        # A slow callback falls behind and skips ticks
+        slow = scheduler.Scheduler(lambda: clock[0], wait)
+        clock[0] = 0.0
+        task = slow.add('slow', 10.0, lambda tick: wait(clock[0] + 0.25))
+        slow.run(10.0)
+        assert task.skipped > 0
+        assert task.runs + task.skipped == pytest.approx(100, abs=3)
+
+    def test_latency(self):
+        clock = [0.0]
+        tracker = latency.LatencyTracker(lambda: clock[0])
+
+        gps = apm2.MAVLink_gps_input_message(0, 0, 0, 0, 0, 3, 100, 200, 0, 1, 4, 0, 0, 0, 0, 0, 0, 10, 0)
+        vpd = apm2.MAVLink_vision_position_delta_message(0, 200000, [0.0] * 3, [0.0] * 3, 99.8)
+        raw = apm2.MAVLink_gps_raw_int_message(0, 3, 100, 200, 0, 0, 0, 0, 0, 10)
+        gpi = apm2.MAVLink_global_position_int_message(0, 100, 200, 0, 0, 0, 0, 0, 0)
+
+        tracker.on_send(gps, 10.0)
+        tracker.on_send(vpd, 10.0)
+        clock[0] = 0.1
+        tracker.on_recv(raw, 10.1)
+        clock[0] = 0.4
+        tracker.on_recv(gpi, 10.4)
+
+        assert tracker.stages['GPS_INPUT -> GPS_RAW_INT'].sim == [pytest.approx(0.1)]
+        assert tracker.stages['GPS_INPUT -> GLOBAL_POSITION_INT'].wall == [pytest.approx(0.4)]
+        assert tracker.stages['GPS_RAW_INT -> GLOBAL_POSITION_INT'].sim == [pytest.approx(0.3)]
+        assert tracker.stages['VISION_POSITION_DELTA -> GLOBAL_POSITION_INT'].sim == [pytest.approx(0.4)]
+        assert 'VISION_POSITION_DELTA -> LOCAL_POSITION_NED' not in tracker.stages
+        assert len(tracker.report()) > 5
+
+        # LOCAL_POSITION_NED never arrives, the sends waiting for it are capped
+        for _ in range(latency.MAX_PENDING_EKF * 2):
+            tracker.on_send(vpd, 11.0)
+        assert len(tracker.pending_ekf['LOCAL_POSITION_NED']) == latency.MAX_PENDING_EKF
+
+    def test_analysis(self, tmp_path):
+        # EKF is 10m north of GPS_INPUT for 10s, then 1m north
+        mav = apm2.MAVLink(None, 255, 0)
+        path = str(tmp_path / 'test.tlog')
+        lat0, lon0 = position.Position.origin_int()
+        m_per_deg_e7 = math.radians(1e-7) * analysis.EARTH_RADIUS
+        with open(path, 'wb') as f:
+            for i in range(100):
+                usec = int((1000.0 + i * 0.5) * 1e6)
+                offset = 10.0 if i < 20 else 1.0
+                gps = apm2.MAVLink_gps_input_message(0, 0, 0, 0, 0, 3, lat0, lon0, 0, 1, 4, 0, 0, 0, 0, 0, 0, 10, 0)
+                gpi = apm2.MAVLink_global_position_int_message(
+                    i, lat0 + int(round(offset / m_per_deg_e7)), lon0, 0, 0, 0, 0, 0, 0)
+                vpd = apm2.MAVLink_vision_position_delta_message(i, 0, [0.0, 0.0, 0.5], [1.0, 0.0, 0.0], 0.0)
+                f.write(struct.pack('>Q', usec) + gps.pack(mav))
+                f.write(struct.pack('>Q', usec + 1000) + gpi.pack(mav))
+                f.write(struct.pack('>Q', usec + 2000) + vpd.pack(mav))
+
+        columns = analysis.load_columns(path, ['GLOBAL_POSITION_INT', 'VISION_POSITION_DELTA'])
+        assert list(columns['GLOBAL_POSITION_INT']['time_boot_ms']) == list(range(100))
+        assert columns['VISION_POSITION_DELTA']['angle_delta'].shape == (100, 3)
+        assert columns['VISION_POSITION_DELTA']['confidence'][5] == 0.0  # Truncated by MAVLink2
+        assert columns['VISION_POSITION_DELTA']['position_delta'][5][0] == 1.0
+
+        metrics = analysis.analyze(path, threshold=2.0)
+        assert metrics.samples == 100
+        assert metrics.max == pytest.approx(10.0, abs=0.01)
+        assert metrics.convergence == pytest.approx(10.0)
+        assert len(analysis.format_table([metrics])) == 2
+
+        # Following the tlog as it is written gives the same numbers, with a summary every 10s
+        with open(path, 'rb') as f:
+            data = f.read()
+        growing = str(tmp_path / 'growing.tlog')
+        summaries = []
+        analyzer = live_analysis.LiveAnalyzer(growing, threshold=2.0, interval=10.0, output=summaries.append)
+        with open(growing, 'wb') as f:
+            follower = live_analysis.TlogFollower(growing, analyzer)
+            for chunk in range(0, len(data), 1000):
+                f.write(data[chunk:chunk + 1000])
+                f.flush()
+                follower.read()
+            follower.close()
+        live = analyzer.metrics()
+        assert live.samples == metrics.samples and live.convergence == pytest.approx(metrics.convergence)
+        assert live.rms == pytest.approx(metrics.rms) and live.max == pytest.approx(metrics.max)
+        assert len(summaries) == 4 and 'converged at 10.0s' in summaries[-1]
+
+        # With ground truth the error is measured against it, and GPS_INPUT (here 10m off, and rare) is ignored
+        path = str(tmp_path / 'truth.tlog')
+        with open(path, 'wb') as f:
+            for i in range(100):
+                usec = int((1000.0 + i * 0.5) * 1e6)
+                truth = apm2.MAVLink_hil_state_quaternion_message(0, [1.0, 0.0, 0.0, 0.0], 0, 0, 0, lat0, lon0, 0,
+                                                                  0, 0, 0, 0, 0, 0, 0, 0)
+                gps = apm2.MAVLink_gps_input_message(0, 0, 0, 0, 0, 3, lat0 + int(round(10.0 / m_per_deg_e7)), lon0,
+                                                     0, 1, 4, 0, 0, 0, 0, 0, 0, 10, 0)
+                gpi = apm2.MAVLink_global_position_int_message(
+                    i, lat0 + int(round(1.0 / m_per_deg_e7)), lon0, 0, 0, 0, 0, 0, 0)
+                f.write(struct.pack('>Q', usec) + truth.pack(mav))
+                if i % 10 == 5:
+                    f.write(struct.pack('>Q', usec) + gps.pack(mav))
+                f.write(struct.pack('>Q', usec + 1000) + gpi.pack(mav))
+
+        metrics = analysis.analyze(path)
+        assert metrics.samples == 100 and metrics.max == pytest.approx(1.0, abs=0.01)
+        analyzer = live_analysis.LiveAnalyzer(path)
+        live_analysis.follow(path, analyzer)
+        assert analyzer.metrics()[1:] == pytest.approx(metrics[1:])
+
+    def test_sweep_ranges(self, monkeypatch, tmp_path):
+        ranges = [sweep.parse_range('EK3_POSNE_M_NSE=0.5:2:4'), sweep.parse_range('EK3_SRC_OPTIONS=0,1')]
+        assert ranges[0].values == [0.5, 1.0, 1.5, 2.0]
+        assert sweep.parse_range('A=1:100:3:log').values == pytest.approx([1.0, 10.0, 100.0])
+        assert len(sweep.grid_candidates(ranges)) == 8
+        for candidate in sweep.random_candidates(ranges, 10, 0):
+            assert 0.5 <= candidate['EK3_POSNE_M_NSE'] <= 2.0
+            assert candidate['EK3_SRC_OPTIONS'] in [0.0, 1.0]
+
+        # Round trip a candidate through a param file
+        params = param.apply_overrides(param.parse_params('params/fusion.params'),
+                                       {'EK3_POSNE_M_NSE': 0.75, 'EK3_VELNE_M_NSE': 0.3})
+        path = str(tmp_path / 'candidate.params')
+        param.write_params(path, params, 'test')
+        assert param.parse_params(path) == params
+        assert len(params) == 22
+
+        # A mode with no metrics scores infinity, and is reported
+        def run_matrix(experiments, options, out_dir, jobs):
+            return [matrix.Result(e.name, 0, '', 0.0, {'rms': math.nan if e.mode == 2 else 1.0}) for e in experiments]
+
+        monkeypatch.setattr(matrix, 'run_matrix', run_matrix)
+        search = sweep.Sweep('params/fusion.params', [0, 2], matrix.Options(1.0), str(tmp_path / 'sweep'), 1)
+        assert search.grid([{'EK3_POSNE_M_NSE': 0.5}], 10) == (0, math.inf)
+        assert search.missing == {0: [2]}
+
+    def test_monte_carlo_stopping(self, monkeypatch, tmp_path):
+        assert monte_carlo.t_quantile(0.975, 1) == pytest.approx(12.706, rel=1e-4)
+        assert monte_carlo.t_quantile(0.975, 2) == pytest.approx(4.303, rel=1e-4)
+        assert monte_carlo.t_quantile(0.975, 4) == pytest.approx(2.776, rel=1e-3)
+        assert monte_carlo.t_quantile(0.975, 1000) == pytest.approx(1.962, rel=1e-3)
+        s = monte_carlo.summarize('a', [1.0, 2.0, 3.0, 4.0, 5.0], 0.95)
+        assert s.mean == 3.0 and s.half_width == pytest.approx(2.776 * s.std / 5 ** 0.5, rel=1e-3)
+
+        experiments = matrix.build_matrix(['params/lutris.params', 'params/fusion.params'], [0], [400])
+        study = monte_carlo.Study(experiments, matrix.Options(), '/tmp', 1, precision=0.01, min_runs=5, max_runs=20)
+        lutris, fusion = [e.name for e in experiments]
+        assert monte_carlo.replication_name(experiments[0], 3) == 'mode_0_lutris_seed_3'
+        assert study.stop_reason(lutris) is None
+
+        # Paired by seed: the noise both runs share cancels, so fusion is separated even though the intervals overlap
+        noise = [0.0, 1.0, -1.0, 0.5, -0.5]
+        study.values[lutris] = {seed: 3.0 + n for seed, n in enumerate(noise)}
+        study.values[fusion] = {seed: 2.9 + n + 0.01 * (seed % 2) for seed, n in enumerate(noise)}
+        study.runs = {lutris: 5, fusion: 5}
+        assert study.summary(fusion).high() > study.summary(lutris).low()
+        assert monte_carlo.is_separated(study.difference(fusion, lutris))
+        assert study.stop_reason(fusion) == 'separated'
+
+        # Not separated, stops at max runs; a tight interval stops it early
+        study.values[fusion] = dict(study.values[lutris])
+        assert study.stop_reason(fusion) is None
+        study.runs[fusion] = 20
+        assert study.stop_reason(fusion) == 'max runs'
+        study.values[fusion] = {seed: 2.0 for seed in range(5)}
+        assert study.stop_reason(fusion) == 'tight'
+        assert len(monte_carlo.format_summaries(study)) == 3
+        assert 'not separated' not in monte_carlo.format_differences(study)[0]
+
+        # Every round runs on one pool. lutris never has EKF output and stops after the first round, fusion runs until
+        # its interval is tight
+        pools = []
+
+        class WorkerPool:
+            def __init__(self, options, out_dir, jobs, first_instance=0, label='MATRIX'):
+                pools.append(self)
+                self.rounds = 0
+
+            def run(self, target, items):
+                self.rounds += 1
+                return [matrix.Result(item.name, 0, '', 0.0, {'rms': math.nan if 'lutris' in item.name else
+                                                               2.0 + 0.1 * (item.seed % 2)}) for item in items]
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                pass
+
+        monkeypatch.setattr(matrix, 'WorkerPool', WorkerPool)
+        study = monte_carlo.Study(experiments, matrix.Options(), str(tmp_path), 2, precision=0.05, min_runs=4,
+                                  max_runs=50)
+        assert study.run() == {lutris: 'no data', fusion: 'tight'}
+        assert len(pools) == 1 and pools[0].rounds > 1
+        assert study.runs[lutris] == 4
+
+    def test_result_cache(self, tmp_path):
+        result_cache = cache.ResultCache(str(tmp_path / 'cache'), max_bytes=2500)
+        key = cache.sensors_key('params/fusion.params', 0, 400, 1, speedup=20.0)
+        assert key == cache.sensors_key('params/fusion.params', 0, 400, 1, speedup=20.0)
+        assert key != cache.sensors_key('params/lutris.params', 0, 400, 1, speedup=20.0)
+        assert key != cache.sensors_key('params/fusion.params', 0, 400, 2, speedup=20.0)
+
+        runs = []
+
+        def run():
+            runs.append(1)
+            with open(log_path, 'wb') as f:
+                f.write(b'x' * 1000)
+
+        log_path = str(tmp_path / 'run.tlog')
+        metrics = cache.run_cached(result_cache, key, log_path, run, lambda path: {'rms': 1.5})
+        assert metrics['rms'] == 1.5
+        os.remove(log_path)
+        metrics = cache.run_cached(result_cache, key, log_path, run, lambda path: {'rms': 1.5})
+        assert metrics['rms'] == 1.5 and len(runs) == 1
+        assert os.path.getsize(log_path) == 1000
+
+        # Two more entries push the first one out
+        for other in ['a', 'b']:
+            cache.run_cached(result_cache, other, log_path, run, lambda path: {'rms': 2.0})
+        assert result_cache.get(key, None) is None
+        assert result_cache.get('b', None) is not None
+
+    def test_batch_replay(self, tmp_path):
+        for name in ['dive1.tlog', 'dive2.tlog', 'notes.txt']:
+            (tmp_path / name).write_bytes(b'x' * 100)
+        paths = batch_replay.find_tlogs([str(tmp_path), str(tmp_path / 'dive1.*')])
+        assert [os.path.basename(p) for p in paths] == ['dive1.tlog', 'dive2.tlog']
+
+        jobs = batch_replay.build_jobs(paths, ['params/lutris.params', 'params/fusion.params'])
+        assert [job.name for job in jobs] == ['dive1_lutris', 'dive1_fusion', 'dive2_lutris', 'dive2_fusion']
+        with pytest.raises(ValueError):
+            batch_replay.build_jobs(paths + [str(tmp_path / 'old' / 'dive1.tlog')], ['params/fusion.params'])
+
+        # Each dive is converted once before the workers start, they only read it
+        batch_replay.prepare_dives(jobs)
+        for path in paths:
+            assert tlog_columns.TlogColumns(path).manifest['types'] == sorted(sim_replay.SimReplay.REPLAY_MSGS)
+
+        # A cached result is current and is reported without starting a worker
+        options = batch_replay.Options(speedup=10.0, cache_dir=str(tmp_path / 'cache'))
+        source = str(tmp_path / 'dive1.tlog')
+        cache.ResultCache(options.cache_dir).put(batch_replay.job_key(jobs[0], options), source, {'rms': 1.5})
+        out_dir = str(tmp_path / 'out')
+        results = batch_replay.run_batch(jobs[:1], options, out_dir, 1)
+        assert results[0].metrics['rms'] == 1.5 and os.path.exists(results[0].log_path)
+        assert batch_replay.current_results(jobs[:1], options._replace(speedup=20.0), out_dir) == {}
+
+        lines = batch_replay.format_comparison(jobs, results)
+        assert lines[0].split() == ['rms', 'm', 'lutris', 'fusion']
+        assert lines[1].split() == ['dive1', '1.50', '-']
+        assert lines[2].split() == ['dive2', '-', '-']
+        assert lines[3].split() == ['mean', '1.50', '-']
+
+    def test_param_upload(self, monkeypatch, tmp_path):
+        class FakeArduSub:
+            """
+            Loses every 7th PARAM_VALUE in the list and the first reply to each PARAM_SET. Clamps SIM_BARO_RND.
+            """
+
+            def __init__(self):
+                self.params = {f'P{i}': float(i) for i in range(50)}
+                self.params['EK3_SRC1_POSXY'] = 0.0
+                self.params['SIM_BARO_RND'] = 0.0
+                self.outbox = []
+                self.listeners = []
+                self.print_params = True
+                self.sets = []
+
+            def value_msg(self, name):
+                names = list(self.params)
+                return apm2.MAVLink_param_value_message(name.encode(), self.params[name], 9, len(names),
+                                                        names.index(name))
+
+            def send_to_ardusub(self, msg):
+                if msg.get_type() == 'PARAM_REQUEST_LIST':
+                    self.outbox += [self.value_msg(n) for i, n in enumerate(self.params) if i % 7 != 3]
+                elif msg.get_type() == 'PARAM_REQUEST_READ':
+                    self.outbox.append(self.value_msg(list(self.params)[msg.param_index]))
+                elif msg.get_type() == 'PARAM_SET':
+                    name = msg.param_id
+                    self.sets.append(name)
+                    self.params[name] = 0.0 if name == 'SIM_BARO_RND' else msg.param_value
+                    if self.sets.count(name) > 1:
+                        self.outbox.append(self.value_msg(name))
+
+            def wait_for_messages(self, timeout):
+                msgs, self.outbox = self.outbox, []
+                for msg in msgs:
+                    for listener in list(self.listeners):
+                        listener.on_recv(msg, time.time())
+
+            def add_listener(self, listener):
+                self.listeners.append(listener)
+
+            def print(self, message):
+                print(message)
+
+        ardusub = FakeArduSub()
+        uploader = param_upload.ParamUploader(ardusub)
+        monkeypatch.setattr(param_upload.ParamUploader, 'TIMEOUT', 0.01)
+        params = [param.Param(b'P1', 1.0, 9), param.Param(b'P2', 22.0, 9),
+                  param.Param(b'EK3_SRC1_POSXY', 3.0, 2), param.Param(b'SIM_BARO_RND', 0.01, 9)]
+        assert not uploader.upload(params)
+
+        assert len(uploader.values) == 52
+        assert 'P1' not in ardusub.sets  # Already set
+        assert sorted(uploader.confirmed) == ['EK3_SRC1_POSXY', 'P2']
+        assert uploader.failed == ['SIM_BARO_RND']
+        assert ardusub.listeners == [] and ardusub.print_params
+
+        # A failed upload ends the run before it starts, and nothing is cached
+        def upload(self, params):
+            self.failed = ['EK3_SRC1_POSXY']
+            return False
+
+        monkeypatch.setattr(param_upload.ParamUploader, 'upload', upload)
+        fake = fake_ardusub.FakeArduSub(instance=46, telemetry_rate=0.0)
+        result_cache = cache.ResultCache(str(tmp_path / 'cache'))
+        log_path = str(tmp_path / 'test.tlog')
+
+        def run():
+            sim_runner.SimRunner('params/fusion.params', log_path, 1.0,
+                                 ardusub=sim_runner.ArduSubInstance(1.0, 46, connect_only=True))
+
+        try:
+            with pytest.raises(RuntimeError, match='EK3_SRC1_POSXY'):
+                cache.run_cached(result_cache, 'key', log_path, run, lambda path: {})
+        finally:
+            fake.close()
+        assert result_cache.get('key', None) is None
+
+    def test_msg_template(self, tmp_path):
+        mav = apm2.MAVLink(None, 255, 0)
+        rx = apm2.MAVLink(None)
+        path = str(tmp_path / 'test.tlog')
+        writer = log_writer.LogWriter(path)
+
+        gps = msg_template.MessageTemplate(sim_sensors.default_gps_input_msg())
+        vpd = msg_template.MessageTemplate(sim_sensors.default_vision_position_delta_msg())
+        for i in range(10):
+            gps.lat, gps.lon = np.int64(-i * 1000), i * 1000
+            vpd.angle_delta, vpd.position_delta = np.array([0.0, 0.0, 0.1 * i]), [1.0, 2.0, 3.0]
+            vpd.time_delta_usec = 200_000
+            for template in [gps, vpd]:
+                buf = template.pack(mav)
+                mav.seq = (mav.seq + 1) % 256
+                writer.write(template)
+
+                # Same fields as the message packed by pymavlink
+                msg = rx.decode(bytearray(buf))
+                assert msg.get_type() == template.get_type()
+                for name in msg.get_fieldnames():
+                    assert getattr(msg, name) == getattr(template, name)
+        writer.close()
+
+        reader = tlog_index.TlogReader(path)
+        try:
+            columns = reader.columns('GPS_INPUT')
+            assert list(columns['lon']) == [i * 1000 for i in range(10)]
+            assert len(reader.columns('VISION_POSITION_DELTA')['confidence']) == 10
+        finally:
+            reader.close()
+
+    def test_fake_ardusub(self, tmp_path):
+        # Run SimSensors against FakeArduSub: upload params, send sensors for 3s of sim time at 10x
+        fake = fake_ardusub.FakeArduSub(instance=40, speedup=10.0, telemetry_rate=30.0)
+        ardusub = sim_runner.ArduSubInstance(10.0, 40, connect_only=True)
+        try:
+            runner = sim_sensors.SimSensors('params/fusion.params', str(tmp_path / 'test.tlog'), 10.0, 3, False,
+                                            sim_sensors.SensorMode.UGPS_AND_DVL, 40, ardusub=ardusub,
+                                            profile=True)
+            try:
+                runner.run()
+            finally:
+                runner.close()
+        finally:
+            ardusub.close()
+            fake.close()
+
+        params = param.parse_params('params/fusion.params')
+        assert all(fake.params[p.id.decode('ascii')] == pytest.approx(p.value) for p in params)
+        assert fake.recv_counts['GPS_INPUT'] == 3
+        assert fake.recv_counts['VISION_POSITION_DELTA'] >= 13
+        assert sum(task.misses for task in runner.scheduler.tasks) == 0
+
+        # Every sensor tick is charged to its task
+        profile = runner.profiler
+        assert profile.counts['task ugps'] == 3
+        assert profile.counts['send'] >= fake.recv_counts['VISION_POSITION_DELTA']
+        assert profile.totals['wait'] > 0.0
+
+        columns = analysis.load_columns(str(tmp_path / 'test.tlog'),
+                                        ['GPS_INPUT', 'LOCAL_POSITION_NED', analysis.TRUTH_MSG])
+        assert len(columns['GPS_INPUT']['lat']) == 3
+        assert len(columns['LOCAL_POSITION_NED']['x']) > 0
+
+        # The ground truth is logged at every track tick, but not sent
+        truth = columns[analysis.TRUTH_MSG]
+        assert len(truth['lat']) == 15 and analysis.TRUTH_MSG not in fake.recv_counts
+        track = runner.position.track
+        assert list(truth['lat']) == [position.Position.xy_gps(x, y).lat for x, y in zip(track.x[:15], track.y[:15])]
+
+    def test_stop_conditions(self, tmp_path):
+        assert stop_conditions.parse_condition('diverged:20:30') == ('diverged:20:30', 'diverged', 20.0, 30.0, None)
+        for spec in ['converged:1', 'ekf:', 'text:', 'text:(', 'critical:1', 'settled:1:2']:
+            with pytest.raises(ValueError):
+                stop_conditions.parse_condition(spec)
+        assert len(stop_conditions.parse_conditions(['diverged:20:30', 'critical'], ranking=True)) == 2
+        with pytest.raises(ValueError, match='shorter window'):
+            stop_conditions.parse_conditions(['diverged:20:30', 'converged:1:60'], ranking=True)
+        with pytest.raises(ValueError):
+            monte_carlo.Study([], matrix.Options(1.0, stop=('converged:1:60',)), '/tmp', 1)
+
+        class Runner:
+            REQUEST_MSG_RATE = 3
+
+            def __init__(self):
+                self.t = 0.0
+                self.ardusub_origin = True
+                self.stop_reason = None
+                self.requested = []
+
+            def sim_time(self):
+                return self.t
+
+            def request_msg(self, msg_id, rate):
+                self.requested.append(msg_id)
+
+            def request_stop(self, reason):
+                self.stop_reason = reason
+
+        def feed(conditions, errors, status=None):
+            # One GPS_INPUT and one GLOBAL_POSITION_INT per second, errors are north offsets in meters
+            runner = Runner()
+            monitor = stop_conditions.StopMonitor(runner, stop_conditions.parse_conditions(conditions))
+            lat, lon = position.Position.origin_int()
+            for t, error in enumerate(errors):
+                runner.t = float(t)
+                monitor.on_send(apm2.MAVLink_gps_input_message(0, 0, 0, 0, 0, 0, lat, lon, *[0] * 10), 0.0)
+                offset = round(error / live_analysis.DEGE7_TO_M)
+                monitor.on_recv(apm2.MAVLink_global_position_int_message(0, lat + offset, lon, 0, 0, 0, 0, 0, 0), 0.0)
+                if status is not None:
+                    monitor.on_recv(status(t), 0.0)
+                if runner.stop_reason:
+                    return t, runner
+            return None, runner
+
+        # Error settles at t=3, stops once it has been below 1m for 5s
+        assert feed(['converged:1:5'], [10, 5, 2, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5, 0.5])[0] == 8
+        # A spike resets the divergence timer
+        assert feed(['diverged:20:2'], [25, 25, 5, 25, 25, 25])[0] == 5
+        assert feed(['diverged:20:2', 'converged:1:5'], [1, 2, 3, 4])[0] is None
+
+        # A bad EKF status only counts after a good one
+        good = apm2.EKF_POS_HORIZ_ABS | apm2.EKF_VELOCITY_HORIZ
+
+        def status(t):
+            return apm2.MAVLink_ekf_status_report_message(good if 2 <= t < 4 else 0, 0, 0.1, 0, 0, 0)
+
+        t, runner = feed(['ekf:1'], [1] * 8, status)
+        assert t == 5 and apm2.MAVLINK_MSG_ID_EKF_STATUS_REPORT in runner.requested
+
+        # Once there is ground truth GPS_INPUT is ignored
+        monitor = stop_conditions.StopMonitor(Runner(), [])
+        lat, lon = position.Position.origin_int()
+        truth = sim_sensors.default_truth_msg()
+        truth.lat, truth.lon = lat, lon + 100
+        monitor.on_send(truth, 0.0)
+        monitor.on_send(apm2.MAVLink_gps_input_message(0, 0, 0, 0, 0, 0, lat, lon, *[0] * 10), 0.0)
+        assert monitor.reference == (lat, lon + 100)
+
+        # End a SimSensors run on a STATUSTEXT from ArduSub
+        fake = fake_ardusub.FakeArduSub(instance=44, speedup=10.0, telemetry_rate=10.0)
+        ardusub = sim_runner.ArduSubInstance(10.0, 44, connect_only=True)
+        timer = threading.Timer(1.0, fake.send, [apm2.MAVLink_statustext_message(apm2.MAV_SEVERITY_CRITICAL,
+                                                                                 b'EKF3 lane 0 lost position')])
+        try:
+            runner = sim_sensors.SimSensors(None, str(tmp_path / 'test.tlog'), 10.0, 60, False,
+                                            sim_sensors.SensorMode.UGPS_AND_DVL, 44, ardusub=ardusub)
+            runner.add_listener(stop_conditions.StopMonitor(runner, [stop_conditions.parse_condition('critical')]))
+            timer.start()
+            start = time.time()
+            try:
+                runner.run()
+            finally:
+                runner.close()
+        finally:
+            timer.cancel()
+            ardusub.close()
+            fake.close()
+
+        assert runner.stop_reason == 'critical, EKF3 lane 0 lost position'
+        assert time.time() - start < 3.0
+        assert runner.scheduler.elapsed < 30.0
+
+    def test_recv_filter(self, tmp_path):
+        fake = fake_ardusub.FakeArduSub(instance=41, telemetry_rate=0.0)
+        ardusub = sim_runner.ArduSubInstance(1.0, 41, connect_only=True)
+        runner = sim_runner.SimRunner(None, str(tmp_path / 'test.tlog'), 1.0, ardusub=ardusub)
+        try:
+            runner.drop_msgs(['SYSTEM_TIME'])
+            mav = apm2.MAVLink(None, 1, 1)
+            frames = [apm2.MAVLink_local_position_ned_message(i, i, 0, 0, 0, 0, 0).pack(mav) for i in range(100)]
+            corrupt = bytearray(frames[50])
+            corrupt[-1] ^= 0xFF
+            frames[50] = bytes(corrupt)
+            frames.append(apm2.MAVLink_system_time_message(0, 0).pack(mav))
+            fake.flood(b'\x00garbage' + b''.join(frames))
+
+            deadline = time.time() + 5.0
+            while runner.recv_raw + runner.recv_dropped < 100 and time.time() < deadline:
+                runner.wait_for_messages(0.1)
+            assert runner.recv_raw == 99 and runner.recv_dropped == 1 and runner.recv_bad > 0
+        finally:
+            runner.close()
+            ardusub.close()
+            fake.close()
+
+        # Raw frames are logged as-is
+        columns = analysis.load_columns(str(tmp_path / 'test.tlog'), ['LOCAL_POSITION_NED', 'SYSTEM_TIME'])
+        assert list(columns['LOCAL_POSITION_NED']['x']) == [float(i) for i in range(100) if i != 50]
+        assert len(columns['SYSTEM_TIME']['time_boot_ms']) == 0
+
+    def test_warm_pool(self, monkeypatch, tmp_path):
+        # Two lockstep runs on one pooled instance: the second restores the params and reboots
+        fake = fake_ardusub.FakeArduSub(instance=47, speedup=10.0, telemetry_rate=20.0)
+        pool = ardusub_pool.WarmPool(10.0, [47], connect_only=True)
+        (tmp_path / 'first.params').write_text('1\t1\tFAKE_1\t100\t9\n1\t1\tFAKE_2\t200\t9\n')
+        (tmp_path / 'second.params').write_text('1\t1\tFAKE_2\t5\t9\n')
+
+        def run(params_path: str) -> tuple[int, float]:
+            ardusub = pool.acquire()
+            runner = sim_runner.SimRunner(params_path, None, 10.0, lockstep=True, ardusub=ardusub)
+            try:
+                deadline = time.time() + 5.0
+                while runner.sim_time() < 2.0 and time.time() < deadline:
+                    runner.wait_for_messages(0.1)
+                return runner.ardusub_boot_ms_start, runner.sim_time()
+            finally:
+                runner.close()
+                pool.release(ardusub)
+
+        try:
+            assert run(str(tmp_path / 'first.params'))[1] >= 2.0
+            assert fake.reboots == 0 and fake.params['FAKE_1'] == 100.0
+            start, end = run(str(tmp_path / 'second.params'))
+            assert fake.reboots == 1
+            assert fake.params['FAKE_1'] == 1.0 and fake.params['FAKE_2'] == 5.0
+            # The clock starts from ArduSub's time_boot_ms after the reboot, not from before it
+            assert start < 1000 and end >= 2.0
+
+            # An instance that doesn't come back ends the run, and the caller discards it
+            fake.reboot_ok = False
+            monkeypatch.setattr(sim_runner.ArduSubInstance, 'REBOOT_TIMEOUT', 0.5)
+            ardusub = pool.acquire()
+            with pytest.raises(RuntimeError, match='did not come back'):
+                sim_runner.SimRunner(None, None, 10.0, ardusub=ardusub)
+            assert ardusub.uses == 2
+        finally:
+            pool.close()
+            fake.close()
+
+    def test_mav_router(self, tmp_path):
+        port = sim_runner.ardusub_port(45)
+        fake = fake_ardusub.FakeArduSub(instance=45, telemetry_rate=20.0)
+        ardusub = sim_runner.ArduSubInstance(1.0, 45, connect_only=True)
+        runner = sim_runner.SimRunner(None, str(tmp_path / 'test.tlog'), 1.0, ardusub=ardusub,
+                                      routes=[f'tcpin:127.0.0.1:{port + 5}', f'udpin:127.0.0.1:{port + 6}'])
+        tcp_gcs = socket.create_connection(('127.0.0.1', port + 5))
+        udp_gcs = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        gcs = apm2.MAVLink(None, 255, 0)
+        try:
+            tcp_gcs.sendall(apm2.MAVLink_manual_control_message(1, 0, 0, 500, 0, 0).pack(gcs))
+            udp_gcs.sendto(apm2.MAVLink_rc_channels_override_message(1, 1, *[65535] * 18).pack(gcs),
+                           ('127.0.0.1', port + 6))
+            runner.wait_wall_time(time.time() + 0.5)
+
+            # Telemetry reaches both ground stations, and their messages reach ArduSub
+            def received(sock) -> list[str]:
+                sock.settimeout(0.2)
+                data = b''
+                try:
+                    while chunk := sock.recv(65536):
+                        data += chunk
+                except socket.timeout:
+                    pass
+                return [m.get_type() for m in apm2.MAVLink(None).parse_buffer(data) or []]
+
+            assert 'GLOBAL_POSITION_INT' in received(tcp_gcs)
+            assert 'GLOBAL_POSITION_INT' in received(udp_gcs)
+            assert fake.recv_counts['MANUAL_CONTROL'] == 1
+            assert fake.recv_counts['RC_CHANNELS_OVERRIDE'] == 1
+        finally:
+            tcp_gcs.close()
+            udp_gcs.close()
+            runner.close()
+            fake.close()
+
+        # A ground station that doesn't read loses frames, and never blocks the sender
+        router = mav_router.Router([f'tcpin:127.0.0.1:{port + 7}'], max_bytes=4096, output=lambda line: None)
+        stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        stalled.connect(('127.0.0.1', port + 7))
+        try:
+            deadline = time.time() + 1.0
+            while not router.endpoints and time.time() < deadline:
+                router.poll()
+            router.endpoints[0].sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 4096)
+            frame = apm2.MAVLink_local_position_ned_message(0, 0, 0, 0, 0, 0, 0).pack(gcs)
+            start = time.time()
+            for _ in range(100000):
+                router.forward(frame)
+                router.flush()
+            assert time.time() - start < 5.0
+            client = router.endpoints[0]
+            assert client.dropped_frames > 0 and client.queued_bytes <= 4096
+            assert client.sent_frames + client.dropped_frames + len(client.queue) == 100000
+        finally:
+            stalled.close()
+            router.close()
+
+    def test_tlog_columns(self, tmp_path):
+        # GPS_INPUT and VISION_POSITION_DELTA at 2Hz, with a corrupt frame
+        mav = apm2.MAVLink(None, 255, 0)
+        path = str(tmp_path / 'dive.tlog')
+        with open(path, 'wb') as f:
+            for i in range(20):
+                usec = int((1000.0 + i * 0.5) * 1e6)
+                gps = apm2.MAVLink_gps_input_message(i, 0, 0, 0, 0, 3, i, -i, 0, 1, 4, 0, 0, 0, 0, 0, 0, 10, 0)
+                vpd = apm2.MAVLink_vision_position_delta_message(i, 500000, [0.0] * 3, [float(i), 0.0, 0.0], 99.8)
+                frame = bytearray(gps.pack(mav))
+                if i == 5:
+                    frame[-1] ^= 0xFF
+                f.write(struct.pack('>Q', usec) + frame)
+                f.write(struct.pack('>Q', usec + 1000) + vpd.pack(mav))
+
+        columns = tlog_columns.TlogColumns(path)
+        gps = columns.columns('GPS_INPUT', ['lat'], start=1.0)
+        assert list(gps['lat']) == [i for i in range(2, 20) if i != 5]
+        assert gps['timestamp'][0] == pytest.approx(1001.0)
+        columns.close()
+        assert os.path.exists(path + '.cols/GPS_INPUT.npy')
+
+        # Second open maps the converted files, without reading the tlog
+        columns = tlog_columns.TlogColumns(path)
+        rows, _, _ = columns.arrays('GPS_INPUT')
+        assert columns.reader is None and isinstance(rows, np.memmap) and len(rows) == 19
+        vpd = columns.columns('VISION_POSITION_DELTA')
+        assert list(vpd['position_delta'][:, 0]) == [float(i) for i in range(20)]
+        columns.close()
+
+        # Replay sends the payloads in file order
+        fake = fake_ardusub.FakeArduSub(instance=42, telemetry_rate=0.0)
+        ardusub = sim_runner.ArduSubInstance(50.0, 42, connect_only=True)
+        replay = sim_replay.SimReplay(path, None, str(tmp_path / 'replay.tlog'), 50.0, 42, ardusub=ardusub,
+                                      sim_timestamps=True)
+        try:
+            sent = [(msg.get_type(), timestamp) for timestamp, msg in replay.replay_msgs()]
+            assert len(sent) == 39 and sent[0] == ('GPS_INPUT', 1000.0) and sent[1][0] == 'VISION_POSITION_DELTA'
+            replay.run()
+        finally:
+            replay.close()
+            ardusub.close()
+            fake.close()
+        assert fake.recv_counts['GPS_INPUT'] == 19 and fake.recv_counts['VISION_POSITION_DELTA'] == 20
+        replayed = analysis.load_columns(str(tmp_path / 'replay.tlog'), ['GPS_INPUT'])
+        assert list(replayed['GPS_INPUT']['lon']) == [-i for i in range(20) if i != 5]
+
+        # The new log has the spacing of the source, not compressed by the speedup
+        spacing = np.diff(replayed['GPS_INPUT']['timestamp'])
+        assert np.median(spacing) == pytest.approx(0.5, abs=0.1)
+
+        # Touching the tlog makes the converted files stale: they are ignored, not deleted, and converted again
+        os.utime(path, ns=(0, 0))
+        columns = tlog_columns.TlogColumns(path)
+        assert columns.manifest['types'] == [] and os.path.exists(path + '.cols/GPS_INPUT.npy')
+        assert len(columns.arrays('GPS_INPUT')[0]) == 19 and columns.manifest['types'] == ['GPS_INPUT']
+        columns.close()
+
+        # A damaged index or type file, e.g., half written by another process, is a cache miss
+        with open(path + '.idx.npz', 'wb') as f:
+            f.write(b'PK\x03\x04')
+        with open(path + '.cols/GPS_INPUT.pos.npy', 'wb') as f:
+            f.write(b'\x93NUMPY')
+        reader = tlog_index.TlogReader(path)
+        assert len(reader.index['msg_ids']) == 40
+        reader.close()
+        columns = tlog_columns.TlogColumns(path)
+        assert len(columns.arrays('GPS_INPUT')[2]) == 19
+        columns.close()
+        assert not any(name.endswith('.tmp') for name in os.listdir(path + '.cols'))
+
+    def test_dataflash(self, tmp_path):
+        def record(msg_type: int, fmt: str, *values) -> bytes:
+            return bytes([dataflash.HEAD1, dataflash.HEAD2, msg_type]) + struct.pack('<' + fmt, *values)
+
+        def fmt_record(msg_type: int, name: str, fmt: str, columns: str, struct_fmt: str) -> bytes:
+            length = dataflash.HEADER_LEN + struct.calcsize('<' + struct_fmt)
+            return record(dataflash.FMT_TYPE, 'BB4s16s64s', msg_type, length, name.encode(), fmt.encode(),
+                          columns.encode())
+
+        # XKF1 at 100Hz and POS at 10Hz, with stray bytes, a header inside a payload and a truncated record at the end
+        buf = bytearray(fmt_record(dataflash.FMT_TYPE, 'FMT', 'BBnNZ', 'Type,Length,Name,Format,Columns', 'BB4s16s64s'))
+        buf += fmt_record(200, 'XKF1', 'QBfff', 'TimeUS,C,PN,PE,PD', 'QBfff')
+        buf += fmt_record(201, 'POS', 'QLLc', 'TimeUS,Lat,Lng,Alt', 'Qiih')
+        for i in range(1000):
+            buf += record(200, 'QBfff', i * 10000, 0, i * 0.5, -float(i), 0.0)
+            if i % 10 == 0:
+                buf += record(201, 'Qiih', i * 10000, 470000000 + i, -1220000000, -150)
+            if i == 500:
+                buf += b'\xa3\x95\xc8junk'
+        buf += record(201, 'Qiih', 0, int.from_bytes(b'\xa3\x95\xc8\x00', 'little', signed=True), 0, 0)
+        buf += record(200, 'QBfff', 0, 0, 0.0, 0.0, 0.0)[:10]
+        path = str(tmp_path / 'run.bin')
+        with open(path, 'wb') as f:
+            f.write(buf)
+
+        reader = dataflash.DataflashReader(path)
+        try:
+            assert reader.names() == ['POS', 'XKF1']
+            assert reader.count('XKF1') == 1000 and reader.count('POS') == 101
+            xkf1 = reader.columns('XKF1', ['PN'], start=1.0, end=2.0)
+            assert list(xkf1['PN']) == [i * 0.5 for i in range(100, 201)]
+            pos = reader.columns('POS')
+            assert pos['Lat'][1] == pytest.approx(47.000010) and pos['Alt'][0] == pytest.approx(-1.5)
+            assert pos['timestamp'][1] == pytest.approx(0.1)
+        finally:
+            reader.close()
+
+        # SimRunner turns on logging while disarmed, and copies the newest log next to the tlog
+        os.makedirs(tmp_path / 'sitl' / 'logs')
+        fake = fake_ardusub.FakeArduSub(instance=43, telemetry_rate=0.0)
+        ardusub = sim_runner.ArduSubInstance(1.0, 43, str(tmp_path / 'sitl'), connect_only=True)
+        runner = sim_runner.SimRunner(None, str(tmp_path / 'run.tlog'), 1.0, ardusub=ardusub, dataflash=True)
+        try:
+            assert fake.params['LOG_DISARMED'] == 1
+            with open(tmp_path / 'sitl' / 'logs' / '00000001.BIN', 'wb') as f:
+                f.write(buf)
+        finally:
+            runner.close()
+            ardusub.close()
+            fake.close()
+        with open(dataflash.bin_path(str(tmp_path / 'run.tlog')), 'rb') as f:
+            assert f.read() == buf
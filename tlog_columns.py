@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+"""
+Convert a tlog into per-message-type NumPy arrays that can be memory-mapped.
+
+The arrays are kept in <tlog>.cols/, next to the tlog:
+    manifest.json       size and mtime of the tlog, the time of its first message, and the types converted so far
+    <TYPE>.npy          payloads as a structured array, one field per message field, see tlog_index.payload_dtype()
+    <TYPE>.usec.npy     tlog timestamps in usec
+    <TYPE>.pos.npy      position of each message in the tlog, to merge several types back into file order
+
+A type is converted the first time it is asked for, using the tlog index (see tlog_index.py), and only frames with a
+good CRC are kept. If the tlog changes, the manifest starts over with no types, and each type is converted again when
+it is asked for. Every file is written to a temp file and renamed, and nothing is deleted, so several processes can
+share a directory. Loading a type maps the files, so only the fields that are used are read from disk.
+
+Example, convert every message type in some dives ahead of time:
+    python tlog_columns.py dive1.tlog dive2.tlog
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+import tlog_index
+
+VERSION = 2
+
+
+class TlogColumns:
+    def __init__(self, path: str, use_cache: bool = True):
+        self.path = path
+        self.dir = path + '.cols'
+        self.use_cache = use_cache
+        self.reader = None
+
+        # Converted types, for use_cache=False or if the directory can't be written: {type: (rows, usec, pos)}
+        self.memory = {}
+
+        stat = os.stat(path)
+        source = [stat.st_size, stat.st_mtime_ns]
+        manifest = self.read_manifest()
+        if manifest is not None and manifest.get('version') == VERSION and manifest['source'] == source:
+            self.manifest = manifest
+        else:
+            index = self.open_reader().index
+            t0 = int(index['timestamps'][0]) if len(index['timestamps']) else 0
+            self.manifest = {'version': VERSION, 'source': source, 't0': t0, 'types': []}
+            if use_cache:
+                self.write_manifest()
+        self.t0 = self.manifest['t0']
+
+    def read_manifest(self) -> dict | None:
+        try:
+            with open(os.path.join(self.dir, 'manifest.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write_manifest(self):
+        """
+        Write self.manifest. Files of types that it doesn't list may be from an older tlog, and are ignored.
+        """
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            tmp_path = os.path.join(self.dir, f'manifest.json.{os.getpid()}.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(self.manifest, f)
+            os.replace(tmp_path, os.path.join(self.dir, 'manifest.json'))
+        except OSError as e:
+            print(f'TLOG COLUMNS: could not write {self.dir}: {e}')
+            self.use_cache = False
+
+    def open_reader(self) -> tlog_index.TlogReader:
+        if self.reader is None:
+            self.reader = tlog_index.TlogReader(self.path)
+        return self.reader
+
+    def types(self) -> list[str]:
+        """
+        All known message types in the tlog.
+        """
+        reader = self.open_reader()
+        ids = np.unique(reader.index['msg_ids'])
+        return sorted(tlog_index.apm2.mavlink_map[i].msgname for i in ids if i in tlog_index.apm2.mavlink_map)
+
+    def file(self, msg_type: str, suffix: str) -> str:
+        return os.path.join(self.dir, f'{msg_type}{suffix}.npy')
+
+    def convert(self, msg_type: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        reader = self.open_reader()
+        pos = reader.select([msg_type])
+        pos = pos[reader.crc_ok(pos)]
+        arrays = (reader.rows(pos, tlog_index.payload_dtype(tlog_index.msg_class(msg_type))),
+                  reader.index['timestamps'][pos], pos.astype(np.int64))
+
+        if self.use_cache:
+            try:
+                # Write to temp files and rename, so a reader never sees a partial file
+                for array, suffix in zip(arrays, ['', '.usec', '.pos']):
+                    tmp_path = self.file(msg_type, suffix) + f'.{os.getpid()}.tmp'
+                    with open(tmp_path, 'wb') as f:
+                        np.save(f, array)
+                    os.replace(tmp_path, self.file(msg_type, suffix))
+            except OSError as e:
+                print(f'TLOG COLUMNS: could not write {msg_type}: {e}')
+                self.use_cache = False
+            else:
+                # Add the type to the manifest only once its files are in place. Another process may have added
+                # types since this one read it, keep those too
+                manifest = self.read_manifest()
+                if manifest is not None and manifest.get('version') == VERSION and \
+                        manifest['source'] == self.manifest['source']:
+                    self.manifest['types'] = sorted(set(self.manifest['types']) | set(manifest['types']))
+                self.manifest['types'] = sorted(set(self.manifest['types']) | {msg_type})
+                self.write_manifest()
+        return arrays
+
+    def arrays(self, msg_type: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return (rows, usec, pos) for one type, memory-mapped if possible.
+        """
+        if msg_type in self.memory:
+            return self.memory[msg_type]
+        if self.use_cache and msg_type in self.manifest['types']:
+            try:
+                return tuple(np.load(self.file(msg_type, suffix), mmap_mode='r') for suffix in ['', '.usec', '.pos'])
+            except (OSError, ValueError):
+                # Missing or damaged, convert it again
+                pass
+
+        arrays = self.convert(msg_type)
+        if not self.use_cache:
+            self.memory[msg_type] = arrays
+        return arrays
+
+    def select(self, msg_type: str, start: float | None = None,
+               end: float | None = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Return (rows, usec, pos) for the messages of one type between start and end, seconds from the first message.
+        """
+        rows, usec, pos = self.arrays(msg_type)
+        if start is not None or end is not None:
+            mask = np.ones(len(usec), dtype=bool)
+            if start is not None:
+                mask &= usec >= self.t0 + int(start * 1e6)
+            if end is not None:
+                mask &= usec <= self.t0 + int(end * 1e6)
+            rows, usec, pos = rows[mask], usec[mask], pos[mask]
+        return rows, usec, pos
+
+    def columns(self, msg_type: str, fields: list[str] | None = None, start: float | None = None,
+                end: float | None = None) -> dict[str, np.ndarray]:
+        """
+        Same as TlogReader.columns(), but only the fields asked for (all if None) are read.
+        """
+        rows, usec, _ = self.select(msg_type, start, end)
+        result = {'timestamp': usec * 1e-6}
+        for name in fields if fields is not None else tlog_index.msg_class(msg_type).fieldnames:
+            result[name] = rows[name]
+        return result
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=__doc__)
+    parser.add_argument('--types', type=str, nargs='+', default=None, help='message types to convert, default all')
+    parser.add_argument('paths', nargs='+')
+    args = parser.parse_args()
+
+    for path in args.paths:
+        columns = TlogColumns(path)
+        try:
+            for msg_type in args.types or columns.types():
+                rows, _, _ = columns.arrays(msg_type)
+                print(f'TLOG COLUMNS: {path} {msg_type} {len(rows)} messages')
+        finally:
+            columns.close()
+
+
+if __name__ == '__main__':
+    main()
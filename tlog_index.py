@@ -0,0 +1,211 @@
+"""
+Read selected messages from a tlog without parsing the whole file.
+
+The tlog is memory-mapped and scanned once to build an index of (offset, timestamp, message id) for every frame. The
+index is cached next to the tlog in <tlog>.idx.npz and rebuilt if the tlog changes. Only the frames that are asked
+for are decoded.
+
+columns() decodes all messages of one type at once into NumPy arrays, one per field, without building message objects.
+It does not check the CRC.
+"""
+
+import mmap
+import os
+import re
+import zipfile
+
+import numpy as np
+from pymavlink.dialects.v20 import ardupilotmega as apm2
+
+import mav_frame
+
+# Each tlog record is a 64-bit big-endian timestamp (usec) followed by a MAVLink frame
+TIMESTAMP_LEN = 8
+
+
+def scan_tlog(buf) -> dict[str, np.ndarray]:
+    """
+    Find every frame in a tlog buffer. Skips over bytes that aren't the start of a record.
+    """
+    offsets = []
+    timestamps = []
+    ids = []
+    lengths = []
+
+    end = len(buf)
+    i = 0
+    while i + TIMESTAMP_LEN + mav_frame.MIN_HEADER_LEN <= end:
+        frame = i + TIMESTAMP_LEN
+        length = mav_frame.frame_length(buf, frame)
+        if length == 0:
+            # Resync
+            i += 1
+            continue
+        if frame + length > end:
+            # Truncated record at the end of the file
+            break
+        offsets.append(frame)
+        timestamps.append(int.from_bytes(buf[i:frame], 'big'))
+        ids.append(mav_frame.msg_id(buf, frame))
+        lengths.append(length)
+        i = frame + length
+
+    return {
+        'offsets': np.array(offsets, dtype=np.int64),
+        'timestamps': np.array(timestamps, dtype=np.int64),
+        'msg_ids': np.array(ids, dtype=np.uint32),
+        'lengths': np.array(lengths, dtype=np.uint16),
+    }
+
+
+# Map struct format codes to NumPy types
+NUMPY_TYPES = {
+    'b': 'i1', 'B': 'u1', 'h': '<i2', 'H': '<u2', 'i': '<i4', 'I': '<u4', 'q': '<i8', 'Q': '<u8',
+    'f': '<f4', 'd': '<f8', 'c': 'S1',
+}
+
+
+def payload_dtype(msg_class) -> np.dtype:
+    """
+    Build a packed NumPy dtype matching the wire layout of a MAVLink message payload.
+    """
+    fields = []
+    codes = re.findall(r'(\d*)([a-zA-Z])', msg_class.unpacker.format)
+    for name, (count, code) in zip(msg_class.ordered_fieldnames, codes):
+        if code == 's':
+            fields.append((name, f'S{count}'))
+        elif count:
+            fields.append((name, NUMPY_TYPES[code], (int(count),)))
+        else:
+            fields.append((name, NUMPY_TYPES[code]))
+    dtype = np.dtype(fields)
+    assert dtype.itemsize == msg_class.unpacker.size
+    return dtype
+
+
+def msg_class(msg_type: str):
+    return apm2.mavlink_map[getattr(apm2, f'MAVLINK_MSG_ID_{msg_type}')]
+
+
+class TlogReader:
+    def __init__(self, path: str, use_cache: bool = True):
+        self.path = path
+        self.file = open(path, 'rb')
+        # mmap can't map an empty file
+        if os.path.getsize(path):
+            self.buf = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buf = b''
+        self.index = self.load_index(use_cache)
+        self.mav = apm2.MAVLink(None)
+
+    def index_path(self) -> str:
+        return self.path + '.idx.npz'
+
+    def load_index(self, use_cache: bool) -> dict[str, np.ndarray]:
+        stat = os.stat(self.path)
+        source = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+        if use_cache:
+            try:
+                with np.load(self.index_path()) as cached:
+                    if np.array_equal(cached['source'], source):
+                        return {key: cached[key] for key in cached.files if key != 'source'}
+            except (OSError, ValueError, EOFError, KeyError, zipfile.BadZipFile):
+                # No cached index, or a damaged one: index again
+                pass
+
+        print(f'TLOG INDEX: indexing {self.path}')
+        index = scan_tlog(self.buf)
+
+        if use_cache:
+            try:
+                # Write to a temp file and rename, so a reader never sees a partial file. Pass a file object so
+                # np.savez doesn't append .npz
+                tmp_path = self.index_path() + f'.{os.getpid()}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    np.savez(f, source=source, **index)
+                os.replace(tmp_path, self.index_path())
+            except OSError as e:
+                print(f'TLOG INDEX: could not cache index: {e}')
+
+        return index
+
+    def close(self):
+        if isinstance(self.buf, mmap.mmap):
+            self.buf.close()
+        self.file.close()
+
+    def select(self, types: list[str], start: float | None = None, end: float | None = None) -> np.ndarray:
+        """
+        Return the positions in the index of messages with these types.
+        start and end are seconds from the first message in the tlog.
+        """
+        mask = np.isin(self.index['msg_ids'], list(mav_frame.msg_ids(types)))
+        t0 = int(self.index['timestamps'][0]) if len(self.index['timestamps']) else 0
+        if start is not None:
+            mask &= self.index['timestamps'] >= t0 + int(start * 1e6)
+        if end is not None:
+            mask &= self.index['timestamps'] <= t0 + int(end * 1e6)
+        return np.flatnonzero(mask)
+
+    def rows(self, pos: np.ndarray, dtype: np.dtype) -> np.ndarray:
+        """
+        Copy the payloads at these positions in the index into a structured array with the payload_dtype() layout.
+        """
+        if not len(pos):
+            return np.zeros(0, dtype=dtype)
+
+        offsets = self.index['offsets'][pos]
+        buf = np.frombuffer(self.buf, dtype=np.uint8)
+        header_len = np.where(buf[offsets] == mav_frame.MAGIC_V2, mav_frame.HEADER_LEN_V2, mav_frame.HEADER_LEN_V1)
+        payload_len = buf[offsets + 1].astype(np.int64)
+
+        # MAVLink2 drops trailing zeros from the payload, so pad each payload back to full size
+        i = np.arange(dtype.itemsize)
+        index = (offsets + header_len)[:, None] + i
+        present = i < payload_len[:, None]
+        payloads = np.where(present, buf[np.where(present, index, 0)], 0).astype(np.uint8)
+        return payloads.view(dtype).reshape(len(pos))
+
+    def columns(self, msg_type: str, start: float | None = None, end: float | None = None) -> dict[str, np.ndarray]:
+        """
+        Decode every message of one type into a dict of field name -> array. 'timestamp' is the tlog time in seconds.
+        """
+        cls = msg_class(msg_type)
+        pos = self.select([msg_type], start, end)
+        rows = self.rows(pos, payload_dtype(cls))
+
+        result = {'timestamp': self.index['timestamps'][pos] * 1e-6}
+        for name in cls.fieldnames:
+            result[name] = rows[name]
+        return result
+
+    def crc_ok(self, pos: np.ndarray) -> np.ndarray:
+        """
+        Check the CRC of the frames at these positions in the index, return a bool mask.
+        """
+        return np.array([mav_frame.crc_ok(self.buf, int(self.index['offsets'][p]), int(self.index['msg_ids'][p]))
+                         for p in pos], dtype=bool)
+
+    def decode(self, pos: int):
+        """
+        Decode one message. Returns None if the frame is corrupt.
+        """
+        offset = int(self.index['offsets'][pos])
+        length = int(self.index['lengths'][pos])
+        try:
+            msg = self.mav.decode(bytearray(self.buf[offset:offset + length]))
+        except apm2.MAVError:
+            return None
+        msg._timestamp = float(self.index['timestamps'][pos]) * 1e-6
+        return msg
+
+    def messages(self, types: list[str], start: float | None = None, end: float | None = None):
+        """
+        Yield the messages with these types in file order. start and end are seconds from the first message.
+        """
+        for pos in self.select(types, start, end):
+            msg = self.decode(pos)
+            if msg is not None:
+                yield msg